@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+
+"""Cold-start benchmark.
+
+Measures the time it takes a fresh instance to import `fileset.server.main`
+and serve its first (and second) request. Every run happens in a new
+subprocess. The child seeds the testbed stubs with a published manifest (as
+another instance would have), then drops every `fileset` module from
+`sys.modules` so that the timed import starts cold.
+
+Usage:
+
+    python -m benchmarks.coldstart [--sdk=PATH] [--runs=10] [--paths=10000]
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import subprocess
+import sys
+import time
+from benchmarks import common
+
+NUM_REDIRECTS = 1000
+
+
+def run_child(args):
+    common.setup_sdk(args.sdk)
+    common.install_appengine_config(
+        REDIRECTS=common.make_redirects(NUM_REDIRECTS))
+
+    with common.Testbed():
+        from benchmarks import serving
+        paths = common.make_paths(args.paths)
+        serving.write_error_page(paths)
+        serving.publish_manifest(paths, manifest_id=1)
+        requests = common.make_requests(paths, 2, hit_ratio=1.0)
+
+        for name in list(sys.modules):
+            if name == 'fileset' or name.startswith('fileset.'):
+                del sys.modules[name]
+        num_modules = len(sys.modules)
+
+        start = time.time()
+        from fileset.server import main
+        import_seconds = time.time() - start
+        call = serving.make_wsgi_caller(main.app)
+
+        start = time.time()
+        call(requests[0])
+        first_seconds = time.time() - start
+
+        start = time.time()
+        call(requests[1])
+        second_seconds = time.time() - start
+
+    print(json.dumps({
+        'import_ms': import_seconds * 1000,
+        'first_response_ms': first_seconds * 1000,
+        'second_response_ms': second_seconds * 1000,
+        'modules_imported': len(sys.modules) - num_modules,
+    }))
+
+
+def run_parent(args):
+    command = [sys.executable, '-m', 'benchmarks.coldstart', '--child',
+               '--paths={}'.format(args.paths)]
+    if args.sdk:
+        command.append('--sdk={}'.format(args.sdk))
+
+    results = []
+    for _ in range(args.runs):
+        output = subprocess.check_output(command).decode('utf-8')
+        results.append(json.loads(output.strip().splitlines()[-1]))
+
+    print('{:<24} {:>12} {:>12} {:>12}'.format(
+        'cold start', 'min', 'median', 'max'))
+    for key in ('import_ms', 'first_response_ms', 'second_response_ms',
+                'modules_imported'):
+        values = sorted(result[key] for result in results)
+        print('{:<24} {:>12.1f} {:>12.1f} {:>12.1f}'.format(
+            key, values[0], values[len(values) // 2], values[-1]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sdk', help='path to the App Engine SDK')
+    parser.add_argument('--runs', type=int, default=10,
+                        help='number of cold starts to measure')
+    parser.add_argument('--paths', type=int, default=10000,
+                        help='number of paths in the manifest')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        run_child(args)
+    else:
+        run_parent(args)
+
+
+if __name__ == '__main__':
+    main()
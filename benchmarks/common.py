@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+
+"""Shared setup for the benchmarks.
+
+Benchmarks run offline against the App Engine SDK's testbed stubs (datastore,
+memcache, blobstore/GCS, task queue). The SDK is located with the
+`APPENGINE_SDK` environment variable, or the `--sdk` flag, e.g.:
+
+    APPENGINE_SDK=$(gcloud info --format='value(installation.sdk_root)')/platform/google_appengine \\
+        python -m benchmarks.serving
+
+Dependencies that are normally vendored into `extensions/` (e.g.
+cloudstorage) must be importable, e.g. by adding them to PYTHONPATH.
+"""
+
+from __future__ import print_function
+
+import gc
+import hashlib
+import os
+import random
+import sys
+import time
+import types
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+APP_ID = 'fileset-bench'
+HOST = 'localhost:8080'
+
+LANGS = ('en', 'fr', 'de', 'ja', 'es', 'es-419', 'pt-br', 'zh-hant', 'ko')
+COUNTRIES = ('US', 'CA', 'FR', 'DE', 'JP', 'MX', 'BR', 'TW', 'KR', 'IN')
+ACCEPT_LANGUAGES = (
+    None,
+    'en-US,en;q=0.9',
+    'fr-CA,fr;q=0.9,en;q=0.8',
+    'de-DE,de;q=0.9',
+    'ja,en-US;q=0.9,en;q=0.8',
+    'es-MX,es;q=0.9,en;q=0.8',
+    'pt-BR,pt;q=0.9',
+    'zh-TW,zh;q=0.9,en;q=0.8',
+)
+
+
+def setup_sdk(sdk_path=None):
+    """Adds the App Engine SDK (and its bundled libraries) to sys.path."""
+    sdk_path = sdk_path or os.environ.get('APPENGINE_SDK')
+    if not sdk_path:
+        raise SystemExit('set APPENGINE_SDK or pass --sdk')
+    sys.path.insert(0, sdk_path)
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+
+
+def install_appengine_config(**settings):
+    """Installs an in-memory `appengine_config` module.
+
+    Must be called before importing any `fileset.server` module, since config
+    values are read at import time. Settings are given without the `fileset_`
+    prefix, e.g. `install_appengine_config(REDIRECTS=(...))`.
+    """
+    module = types.ModuleType('appengine_config')
+    for key, value in settings.items():
+        setattr(module, 'fileset_' + key, value)
+    sys.modules['appengine_config'] = module
+    return module
+
+
+class Testbed(object):
+    """Context manager that activates the testbed service stubs."""
+
+    def __enter__(self):
+        from google.appengine.ext import ndb
+        from google.appengine.ext import testbed
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.setup_env(app_id=APP_ID, http_host=HOST, overwrite=True)
+        self.testbed.init_app_identity_stub()
+        self.testbed.init_blobstore_stub()
+        self.testbed.init_datastore_v3_stub()
+        self.testbed.init_memcache_stub()
+        self.testbed.init_taskqueue_stub()
+        self.testbed.init_urlfetch_stub()
+        self.testbed.init_user_stub()
+        ndb.get_context().set_cache_policy(False)
+        ndb.get_context().clear_cache()
+        return self
+
+    def __exit__(self, *args):
+        self.testbed.deactivate()
+
+
+def fake_sha(value):
+    return hashlib.sha1(str(value).encode('utf-8')).hexdigest()
+
+
+def make_paths(num_paths, intl_ratio=0.2, seed=0):
+    """Returns a synthetic manifest `paths` dict with `num_paths` entries.
+
+    Roughly half of the paths are HTML pages, and `intl_ratio` of the pages
+    also have localized variants under `/intl/<locale>/`.
+    """
+    rand = random.Random(seed)
+    paths = {}
+    i = 0
+    while len(paths) < num_paths:
+        section = 'section{}'.format(i % 100)
+        if i % 2:
+            path = '/static/{}/asset{}.{}'.format(
+                section, i, rand.choice(('css', 'js', 'png', 'svg')))
+            paths[path] = fake_sha(path)
+        else:
+            page = '/{}/page{}/index.html'.format(section, i)
+            paths[page] = fake_sha(page)
+            if rand.random() < intl_ratio:
+                for lang in rand.sample(LANGS, 3):
+                    intl_path = '/intl/{}{}'.format(lang.replace('-', '_'), page)
+                    paths[intl_path] = fake_sha(intl_path)
+        i += 1
+    paths['/index.html'] = fake_sha('/index.html')
+    paths['/404.html'] = fake_sha('/404.html')
+    return paths
+
+
+def make_requests(paths, num_requests, hit_ratio=0.8, not_found_ratio=0.1,
+                  seed=0):
+    """Returns a list of `(path, headers)` tuples.
+
+    `hit_ratio` of requests are for existing paths, `not_found_ratio` are for
+    paths that 404, and the rest are for pages that only exist localized (so
+    the intl fallbacks are probed until a localized variant matches).
+    """
+    rand = random.Random(seed)
+    root_paths = [path for path in paths if not path.startswith('/intl/')]
+    intl_paths = [path for path in paths if path.startswith('/intl/')]
+    requests = []
+    for i in range(num_requests):
+        roll = rand.random()
+        if roll < hit_ratio or not intl_paths:
+            path = rand.choice(root_paths)
+        elif roll < hit_ratio + not_found_ratio:
+            path = '/missing/page{}/'.format(i)
+        else:
+            # Request the unlocalized URL of a localized page.
+            path = '/' + rand.choice(intl_paths).split('/', 3)[3]
+        if path.endswith('/index.html'):
+            path = path[:-len('index.html')]
+        headers = {'X-AppEngine-Country': rand.choice(COUNTRIES)}
+        accept_language = rand.choice(ACCEPT_LANGUAGES)
+        if accept_language:
+            headers['Accept-Language'] = accept_language
+        requests.append((path, headers))
+    return requests
+
+
+def make_redirects(num_redirects, seed=0):
+    """Returns a REDIRECTS config with static, param and wildcard rules."""
+    rand = random.Random(seed)
+    redirects = []
+    for i in range(num_redirects):
+        kind = rand.random()
+        if kind < 0.8:
+            redirects.append((301, '/old/page{}/'.format(i),
+                              '/section{}/page{}/'.format(i % 100, i)))
+        elif kind < 0.95:
+            redirects.append((302, '/old/param{}/:slug/'.format(i),
+                              '/new/param{}/$slug/'.format(i)))
+        else:
+            redirects.append((302, '/old/wild{}/*rest'.format(i),
+                              '/new/wild{}/$rest'.format(i)))
+    return tuple(redirects)
+
+
+class Result(object):
+
+    def __init__(self, name, ops, seconds, allocs=None):
+        self.name = name
+        self.ops = ops
+        self.seconds = seconds
+        self.allocs = allocs
+
+    @property
+    def ops_per_sec(self):
+        return self.ops / self.seconds if self.seconds else 0
+
+    def format(self):
+        allocs = '-' if self.allocs is None else '{:.1f}'.format(self.allocs)
+        return '{:<48} {:>12.1f} {:>12.1f} {:>12}'.format(
+            self.name, self.ops_per_sec,
+            1e6 * self.seconds / self.ops if self.ops else 0, allocs)
+
+
+def print_header():
+    print('{:<48} {:>12} {:>12} {:>12}'.format(
+        'scenario', 'ops/sec', 'us/op', 'allocs/op'))
+
+
+def count_allocations(func, items):
+    """Returns the average net number of allocations per call of `func`.
+
+    Counts memory blocks with tracemalloc when available (Python 3), and
+    GC-tracked objects on Python 2. Both count allocations still alive after
+    the call, so short-lived temporaries are not included.
+    """
+    gc.collect()
+    if tracemalloc:
+        tracemalloc.start()
+        before = tracemalloc.take_snapshot()
+        for item in items:
+            func(item)
+        after = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        stats = after.compare_to(before, 'filename')
+        blocks = sum(stat.count_diff for stat in stats)
+        return float(blocks) / len(items)
+
+    gc.disable()
+    try:
+        before = gc.get_count()[0]
+        for item in items:
+            func(item)
+        after = gc.get_count()[0]
+    finally:
+        gc.enable()
+    return float(after - before) / len(items)
+
+
+def measure(name, func, items, min_seconds=1.0, allocs=True):
+    """Calls `func` for each item, repeating until `min_seconds` have passed."""
+    func(items[0])  # Warm up.
+    ops = 0
+    start = time.time()
+    while True:
+        for item in items:
+            func(item)
+        ops += len(items)
+        seconds = time.time() - start
+        if seconds >= min_seconds:
+            break
+    alloc_items = items[:min(len(items), 200)]
+    result = Result(name, ops, seconds,
+                    count_allocations(func, alloc_items) if allocs else None)
+    print(result.format())
+    sys.stdout.flush()
+    return result
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+
+"""Deploy throughput benchmark.
+
+Deploys synthetic files with the real deploy code (`fileset/client/deploy.py`
+and `FilesetClient`) to an in-memory fake server (`benchmarks/fakeserver.py`)
+and reports files/sec, uploaded bytes/sec and RPC counts for each worker
+count. Doesn't need the App Engine SDK or grow.
+
+File sizes follow a log-normal distribution around `--median-size`, and
+roughly a third of the files are HTML pages. `--warmth` is the fraction of
+files whose blobs are already on the server (e.g. unchanged files of a
+redeploy); with `--journal`, those blobs are also in the local journal, so
+the deploy doesn't have to ask the server about them.
+
+Usage:
+
+    python -m benchmarks.deploy [--files=2000] [--workers=1,5,20,50]
+        [--warmth=0,0.9] [--latency=0.02] [--error-rate=0.01]
+        [--max-concurrent=30]
+"""
+
+from __future__ import print_function
+
+import argparse
+import hashlib
+import logging
+import math
+import random
+import sys
+import time
+from benchmarks import fakeserver
+from fileset.client import deploy
+from fileset.client import fileset
+from fileset.client import journal
+
+BRANCH = 'master'
+MAX_SIZE = 10 * 1024 * 1024
+
+
+class Doc(object):
+    """A synthetic file, like a grow rendered document."""
+
+    def __init__(self, path, content):
+        self.path = path
+        self.content = content
+        self.hash = hashlib.sha1(content).hexdigest()
+
+    def read(self):
+        return self.content
+
+
+def make_docs(num_files, median_size, seed=0):
+    rand = random.Random(seed)
+    docs = []
+    for i in range(num_files):
+        size = int(min(MAX_SIZE, rand.lognormvariate(math.log(median_size), 1.0)))
+        section = 'section{}'.format(i % 50)
+        if i % 3 == 0:
+            path = '/{}/page{}/index.html'.format(section, i)
+            head = (
+                '<!doctype html><html><head>'
+                '<link rel="stylesheet" href="/static/main.css">'
+                '<script src="/static/main.js"></script>'
+                '</head><body>{}'.format(path)).encode('utf-8')
+        else:
+            path = '/static/{}/asset{}.{}'.format(
+                section, i, rand.choice(('css', 'js', 'png', 'svg')))
+            head = path.encode('utf-8')
+        docs.append(Doc(path, head + b'x' * max(0, size - len(head))))
+    return docs
+
+
+def run(docs, workers, warmth, use_journal, server_args):
+    server = fakeserver.FakeServer(**server_args)
+    host = server.start()
+    try:
+        warm = docs[:int(len(docs) * warmth)]
+        server.blobs.update(doc.hash for doc in warm)
+        local_journal = journal.Journal()
+        if use_journal:
+            local_journal.update(doc.hash for doc in warm)
+
+        fs = fileset.FilesetClient(host, '')
+        deployer = deploy.Deployer(fs, local_journal, max_workers=workers)
+        start = time.time()
+        deployer.deploy(docs, {'sha': 'bench'}, BRANCH)
+        seconds = time.time() - start
+    finally:
+        server.stop()
+    return seconds, server
+
+
+def print_header():
+    print('{:>7} {:>7} {:>9} {:>10} {:>10} {:>7} {:>7} {:>7} {:>7}'.format(
+        'workers', 'warmth', 'seconds', 'files/s', 'MB/s', 'rpcs', 'exists',
+        'uploads', 'errors'))
+
+
+def print_result(workers, warmth, seconds, num_files, server):
+    print('{:>7} {:>7.2f} {:>9.2f} {:>10.1f} {:>10.2f} {:>7} {:>7} {:>7} {:>7}'.format(
+        workers, warmth, seconds, num_files / seconds,
+        server.bytes_uploaded / seconds / 1e6, sum(server.rpcs.values()),
+        server.rpcs['blob.exists'], server.rpcs['blob.upload'],
+        sum(server.errors.values())))
+    sys.stdout.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--files', type=int, default=2000)
+    parser.add_argument('--median-size', type=int, default=16 * 1024,
+                        help='median file size in bytes')
+    parser.add_argument('--workers', default='1,5,20,50',
+                        help='comma-separated worker counts')
+    parser.add_argument('--warmth', default='0,0.9',
+                        help='comma-separated fractions of blobs already '
+                             'uploaded')
+    parser.add_argument('--journal', action='store_true',
+                        help='also record uploaded blobs in the local journal')
+    parser.add_argument('--latency', type=float, default=0.02,
+                        help='seconds added to every request')
+    parser.add_argument('--jitter', type=float, default=0.01,
+                        help='maximum random seconds added to every request')
+    parser.add_argument('--bandwidth', type=float, default=0,
+                        help='upload bytes per second per request (0 for '
+                             'unlimited)')
+    parser.add_argument('--error-rate', type=float, default=0,
+                        help='fraction of requests that fail with a 500')
+    parser.add_argument('--max-concurrent', type=int, default=0,
+                        help='requests in flight before the server throttles '
+                             '(0 for unlimited)')
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.ERROR)
+    server_args = {
+        'latency': args.latency,
+        'jitter': args.jitter,
+        'bandwidth': args.bandwidth,
+        'error_rate': args.error_rate,
+        'max_concurrent': args.max_concurrent,
+    }
+    docs = make_docs(args.files, args.median_size)
+    print('files: {}  total size: {:.1f} MB'.format(
+        len(docs), sum(len(doc.content) for doc in docs) / 1e6))
+    print()
+    print_header()
+    for warmth in [float(value) for value in args.warmth.split(',')]:
+        for workers in [int(value) for value in args.workers.split(',')]:
+            seconds, server = run(
+                docs, workers, warmth, args.journal, server_args)
+            print_result(workers, warmth, seconds, len(docs), server)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,282 @@
+#!/usr/bin/env python
+
+"""In-memory stand-in for the fileset server's `/_fs/api/*` endpoints.
+
+Implements the endpoints used by deploys (blobs, manifests, manifest trees
+and branches) with the same request and response formats as
+`fileset/server/api.py`, without App Engine. Every request can be delayed
+(`latency` seconds plus up to `jitter` seconds, plus the upload size divided
+by `bandwidth`), fail with a 500 (`error_rate`), or be throttled with a 429
+and a Retry-After header when more than `max_concurrent` requests are in
+flight. Requests are counted per API method. `fakeserver_test.py` checks that
+the fake only implements methods the server routes, and that it handles
+requests the way the server does.
+
+Usage:
+
+    server = fakeserver.FakeServer(latency=0.02, error_rate=0.01)
+    host = server.start()
+    ...
+    server.stop()
+    print(server.rpcs)
+"""
+
+import collections
+import json
+import random
+import threading
+import time
+from fileset import merkle
+from fileset.client import deploy
+try:
+    from http.server import BaseHTTPRequestHandler
+    from http.server import HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs
+    from urllib.parse import urlparse
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler
+    from BaseHTTPServer import HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qs
+    from urlparse import urlparse
+
+API_PREFIX = '/_fs/api/'
+
+# API methods implemented by `FakeServer.handle`; others return a 404.
+METHODS = frozenset([
+    'blob.exists',
+    'blob.upload',
+    'branch.get_manifest',
+    'branch.set_manifest',
+    'manifest.append',
+    'manifest.begin',
+    'manifest.commit',
+    'manifest.derive',
+    'manifest.tree',
+    'manifest.upload',
+])
+
+
+class FakeServer(object):
+
+    def __init__(self, latency=0, jitter=0, bandwidth=0, error_rate=0,
+                 max_concurrent=0, retry_after=1, seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.max_concurrent = max_concurrent
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+
+        self.lock = threading.RLock()
+        self.in_flight = 0
+        # Counts of requests per API method, and of injected failures.
+        self.rpcs = collections.Counter()
+        self.errors = collections.Counter()
+        self.bytes_uploaded = 0
+
+        self.blobs = set()
+        # Map of manifest id => {path: sha}, and of manifest id => {path: meta}.
+        self.manifests = {}
+        self.meta = {}
+        # Map of session id => {page: ({path: sha}, {path: meta})}.
+        self.sessions = {}
+        # Map of branch => manifest id.
+        self.branches = {}
+        self._trees = {}
+        self._next_id = 1
+        self._httpd = None
+
+    def start(self):
+        """Starts serving on a free local port and returns the host URL."""
+        self._httpd = _HTTPServer(('127.0.0.1', 0), _Handler)
+        self._httpd.fake = self
+        thread = threading.Thread(target=self._httpd.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return 'http://127.0.0.1:{}'.format(self._httpd.server_address[1])
+
+    def stop(self):
+        if self._httpd:
+            self._httpd.shutdown()
+            self._httpd.server_close()
+            self._httpd = None
+
+    def _allocate_id(self):
+        with self.lock:
+            manifest_id = self._next_id
+            self._next_id += 1
+        return manifest_id
+
+    def _save(self, paths, meta, manifest_id=None):
+        if manifest_id is None:
+            manifest_id = self._allocate_id()
+        self.manifests[manifest_id] = paths
+        self.meta[manifest_id] = meta
+        return manifest_id
+
+    def _get_tree(self, manifest_id):
+        tree = self._trees.get(manifest_id)
+        if tree is None:
+            tree = merkle.Tree(
+                self.manifests[manifest_id], meta=self.meta[manifest_id])
+            self._trees[manifest_id] = tree
+        return tree
+
+    def handle(self, method, query, body):
+        """Returns `(status, data)` for an API request."""
+        if method == 'blob.upload':
+            self.blobs.add(query['sha'][0])
+            return 200, {'success': True, 'sha': query['sha'][0]}
+
+        data = json.loads(body.decode('utf-8') or '{}')
+        if method == 'blob.exists':
+            # Like `BlobExistsHandler`, older clients send a query param.
+            sha = data.get('sha') or query.get('sha', [None])[0]
+            if not sha:
+                return 400, {
+                    'success': False,
+                    'error': 'missing required param: "sha"',
+                }
+            return 200, {'success': True, 'sha': sha, 'exists': sha in self.blobs}
+        if method == 'manifest.upload':
+            manifest_id = self._save(*_parse_files(data['files']))
+            return 200, {'success': True, 'manifest_id': manifest_id}
+        if method == 'manifest.begin':
+            session_id = self._allocate_id()
+            self.sessions[session_id] = {}
+            return 200, {'success': True, 'session_id': session_id}
+        if method == 'manifest.append':
+            pages = self.sessions[data['session_id']]
+            pages[data['page']] = _parse_files(data['files'])
+            return 200, {'success': True}
+        if method == 'manifest.commit':
+            pages = self.sessions.pop(data['session_id'])
+            if len(pages) != data['num_pages']:
+                return 400, {'success': False, 'error': 'missing pages'}
+            paths = {}
+            meta = {}
+            for page_paths, page_meta in pages.values():
+                paths.update(page_paths)
+                meta.update(page_meta)
+            manifest_id = self._save(paths, meta, manifest_id=data['session_id'])
+            return 200, {'success': True, 'manifest_id': manifest_id}
+        if method == 'manifest.tree':
+            dirs = data.get('dirs') or [merkle.ROOT]
+            if len(dirs) > merkle.MAX_TREE_DIRS:
+                return 400, {'success': False, 'error': 'too many dirs'}
+            manifest_id = data.get('manifest_id')
+            if manifest_id is None:
+                manifest_id = self.branches.get(data.get('branch'))
+            if manifest_id not in self.manifests:
+                return 200, {'success': True, 'manifest_id': None}
+            tree = self._get_tree(manifest_id)
+            return 200, {
+                'success': True,
+                'manifest_id': manifest_id,
+                'root': tree.root,
+                'nodes': dict((dirname, tree.get_children(dirname))
+                              for dirname in dirs),
+            }
+        if method == 'manifest.derive':
+            paths = dict(self.manifests[data['base_manifest_id']])
+            meta = dict(self.meta[data['base_manifest_id']])
+            for path in data.get('deleted') or []:
+                if path.endswith('/'):
+                    for existing in list(paths):
+                        if existing.startswith(path):
+                            del paths[existing]
+                            meta.pop(existing, None)
+                paths.pop(path, None)
+                meta.pop(path, None)
+            new_paths, new_meta = _parse_files(data.get('files') or [])
+            paths.update(new_paths)
+            meta.update(new_meta)
+            return 200, {'success': True, 'manifest_id': self._save(paths, meta)}
+        if method == 'branch.get_manifest':
+            manifest_id = self.branches.get(data['branch'])
+            manifest = None
+            if manifest_id is not None:
+                manifest = {'paths': self.manifests[manifest_id]}
+            return 200, {
+                'success': True,
+                'branch': data['branch'],
+                'manifest': manifest,
+            }
+        if method == 'branch.set_manifest':
+            self.branches[data['branch']] = data['manifest_id']
+            return 200, {
+                'success': True,
+                'branch': data['branch'],
+                'manifest_id': data['manifest_id'],
+            }
+        return 404, {'success': False, 'error': 'unknown method'}
+
+
+def _parse_files(files):
+    """Returns the `(paths, meta)` of a list of files in a request."""
+    paths = dict((data['path'], data['sha']) for data in files)
+    meta = dict((data['path'], deploy.get_file_meta(data)) for data in files)
+    return paths, meta
+
+
+class _HTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    request_queue_size = 256
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        fake = self.server.fake
+        url = urlparse(self.path)
+        method = url.path[len(API_PREFIX):]
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        with fake.lock:
+            fake.rpcs[method] += 1
+            fake.in_flight += 1
+            in_flight = fake.in_flight
+            delay = fake.latency + fake.random.uniform(0, fake.jitter)
+            fail = fake.random.random() < fake.error_rate
+            if method == 'blob.upload':
+                fake.bytes_uploaded += len(body)
+        try:
+            if fake.bandwidth:
+                delay += float(len(body)) / fake.bandwidth
+            if delay:
+                time.sleep(delay)
+            if fake.max_concurrent and in_flight > fake.max_concurrent:
+                with fake.lock:
+                    fake.errors['throttled'] += 1
+                return self._respond(429, {
+                    'success': False,
+                    'error': 'too many requests',
+                }, headers={'Retry-After': str(fake.retry_after)})
+            if fail:
+                with fake.lock:
+                    fake.errors['injected'] += 1
+                return self._respond(500, {
+                    'success': False,
+                    'error': 'injected error',
+                })
+            with fake.lock:
+                status, data = fake.handle(method, parse_qs(url.query), body)
+            return self._respond(status, data)
+        finally:
+            with fake.lock:
+                fake.in_flight -= 1
+
+    def _respond(self, status, data, headers=None):
+        payload = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args):
+        pass
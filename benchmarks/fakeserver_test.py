@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+
+import json
+import os
+import re
+import unittest
+from benchmarks import fakeserver
+
+API_PATH = os.path.join(
+    os.path.dirname(__file__), '..', 'fileset', 'server', 'api.py')
+
+SHA = 'a' * 40
+
+
+def _get_api_methods():
+    """Returns the API methods routed by the server.
+
+    `api.py` needs the App Engine SDK, so its routes are read from the source.
+    """
+    with open(API_PATH) as fp:
+        source = fp.read()
+    return set(re.findall(
+        r"Route\('{}([^']+)'".format(re.escape(fakeserver.API_PREFIX)),
+        source))
+
+
+def _handle(server, method, data=None, query=None):
+    body = json.dumps(data).encode('utf-8') if data is not None else b''
+    return server.handle(method, query or {}, body)
+
+
+class FakeServerTest(unittest.TestCase):
+
+    def test_methods(self):
+        api_methods = _get_api_methods()
+        self.assertIn('blob.exists', api_methods)
+        self.assertEqual(set(), fakeserver.METHODS - api_methods)
+        server = fakeserver.FakeServer()
+        for method in api_methods - fakeserver.METHODS:
+            status, _ = _handle(server, method)
+            self.assertEqual(404, status, method)
+
+    def test_blob_exists(self):
+        server = fakeserver.FakeServer()
+        self.assertEqual(
+            (200, {'success': True, 'sha': SHA, 'exists': False}),
+            _handle(server, 'blob.exists', {'sha': SHA}))
+        _handle(server, 'blob.upload', query={'sha': [SHA]})
+        self.assertEqual(
+            (200, {'success': True, 'sha': SHA, 'exists': True}),
+            _handle(server, 'blob.exists', {'sha': SHA}))
+        # Older clients send a query param.
+        self.assertEqual(
+            (200, {'success': True, 'sha': SHA, 'exists': True}),
+            _handle(server, 'blob.exists', query={'sha': [SHA]}))
+        status, data = _handle(server, 'blob.exists', {})
+        self.assertEqual(400, status)
+        self.assertFalse(data['success'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,262 @@
+#!/usr/bin/env python
+
+"""Access-log replay load test.
+
+Replays an access log against the WSGI `app` in `fileset/server/main.py`
+(with the App Engine SDK's testbed stubs) at a target request rate, and
+reports latency percentiles, throughput, response statuses and the time
+spent in each stage of a request (from the `Server-Timing` header).
+
+Requests are scheduled open-loop: request `i` is due at `i / rate` seconds,
+and its latency is measured from when it was due, so a server that falls
+behind shows up as queueing delay instead of a lower request rate.
+
+Logs are JSON lines with `path` and optional `host`, `accept_language`,
+`country` and `status` fields, e.g.:
+
+    {"path": "/foo/", "accept_language": "fr-CA,fr;q=0.9", "country": "CA"}
+
+Without a manifest (`--manifest`, a JSON map of path => SHA such as the
+`paths` of a branch.get_manifest response), one is built from the logged
+paths, leaving out paths logged with a 404 status. Without a log, a
+synthetic one is generated with a mix of hits, localized pages, 404 scans and
+redirects.
+
+Usage:
+
+    python -m benchmarks.replay [--sdk=PATH] [--log=FILE] [--manifest=FILE]
+        [--rate=200] [--requests=10000] [--threads=1]
+"""
+
+from __future__ import print_function
+
+import argparse
+import collections
+import json
+import random
+import sys
+import threading
+import time
+from benchmarks import common
+
+NUM_REDIRECTS = 1000
+
+# Fraction of synthetic requests that hit a redirect.
+REDIRECT_RATIO = 0.05
+
+
+class Entry(object):
+
+    def __init__(self, path, host=None, accept_language=None, country=None,
+                 status=None):
+        self.path = path
+        self.host = host or common.HOST
+        self.headers = {}
+        if accept_language:
+            self.headers['Accept-Language'] = accept_language
+        if country:
+            self.headers['X-AppEngine-Country'] = country
+        self.status = status
+
+
+def read_log(path):
+    entries = []
+    with open(path) as fp:
+        for line in fp:
+            line = line.strip()
+            if not line:
+                continue
+            data = json.loads(line)
+            entries.append(Entry(
+                data['path'], host=data.get('host'),
+                accept_language=data.get('accept_language'),
+                country=data.get('country'), status=data.get('status')))
+    return entries
+
+
+def make_manifest_paths(entries):
+    """Returns manifest paths that serve every logged path that didn't 404."""
+    paths = {}
+    for entry in entries:
+        if entry.status == 404:
+            continue
+        path = entry.path.split('?', 1)[0]
+        if '.' not in path.rsplit('/', 1)[-1]:
+            path = path.rstrip('/') + '/index.html'
+        paths[path.lower()] = common.fake_sha(path)
+    return paths
+
+
+def make_synthetic_log(paths, redirects, num_requests, seed=0):
+    rand = random.Random(seed)
+    entries = []
+    for path, headers in common.make_requests(paths, num_requests, seed=seed):
+        if redirects and rand.random() < REDIRECT_RATIO:
+            path = rand.choice(redirects)[1]
+            if ':' in path or '*' in path:
+                path = path.split(':', 1)[0].split('*', 1)[0] + 'x/'
+        entries.append(Entry(
+            path, accept_language=headers.get('Accept-Language'),
+            country=headers.get('X-AppEngine-Country')))
+    return entries
+
+
+def parse_server_timing(value):
+    """Returns a map of stage => milliseconds from a Server-Timing header."""
+    stages = {}
+    for part in (value or '').split(','):
+        name, _, params = part.strip().partition(';')
+        if params.startswith('dur='):
+            stages[name] = float(params[4:])
+    return stages
+
+
+class Recorder(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.service_times = []
+        self.statuses = collections.Counter()
+        self.stages = collections.defaultdict(float)
+
+    def add(self, latency, service_time, status, stages):
+        with self.lock:
+            self.latencies.append(latency)
+            self.service_times.append(service_time)
+            self.statuses[status] += 1
+            for name, ms in stages.items():
+                self.stages[name] += ms
+
+
+def replay(app, entries, rate, threads):
+    """Replays `entries` at `rate` requests per second (0 for unlimited)."""
+    import webob
+    recorder = Recorder()
+    next_index = [0]
+    index_lock = threading.Lock()
+    start = time.time()
+
+    def worker():
+        while True:
+            with index_lock:
+                i = next_index[0]
+                if i >= len(entries):
+                    return
+                next_index[0] += 1
+            entry = entries[i]
+            if rate:
+                due = start + float(i) / rate
+                now = time.time()
+                if due > now:
+                    time.sleep(due - now)
+            else:
+                due = time.time()
+            request = webob.Request.blank(entry.path, headers=entry.headers)
+            request.host = entry.host
+            sent = time.time()
+            try:
+                response = request.get_response(app)
+                status = response.status_int
+                stages = parse_server_timing(
+                    response.headers.get('Server-Timing'))
+            except Exception:
+                status = 'error'
+                stages = {}
+            done = time.time()
+            recorder.add(done - due, done - sent, status, stages)
+
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return recorder, time.time() - start
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(fraction * (len(values) - 1))))
+    return values[index]
+
+
+def print_report(recorder, seconds, rate):
+    count = len(recorder.latencies)
+    print('requests: {}  seconds: {:.2f}  throughput: {:.1f} req/s{}'.format(
+        count, seconds, count / seconds if seconds else 0,
+        '  (target {} req/s)'.format(rate) if rate else ''))
+    print()
+    print('{:<12} {:>10} {:>10} {:>10} {:>10}'.format(
+        'ms', 'p50', 'p95', 'p99', 'max'))
+    for name, values in (('latency', recorder.latencies),
+                         ('service', recorder.service_times)):
+        print('{:<12} {:>10.2f} {:>10.2f} {:>10.2f} {:>10.2f}'.format(
+            name, *[1000 * percentile(values, fraction)
+                    for fraction in (0.5, 0.95, 0.99, 1.0)]))
+    print()
+    print('statuses: {}'.format(', '.join(
+        '{}={}'.format(status, num)
+        for status, num in sorted(recorder.statuses.items(), key=str))))
+    print()
+    total_ms = recorder.stages.get('total', 0)
+    print('{:<12} {:>10} {:>10}'.format('stage', 'ms/req', 'share'))
+    for name, ms in sorted(recorder.stages.items(), key=lambda item: -item[1]):
+        if name == 'total':
+            continue
+        print('{:<12} {:>10.3f} {:>9.1f}%'.format(
+            name, ms / count if count else 0,
+            100 * ms / total_ms if total_ms else 0))
+    print('{:<12} {:>10.3f}'.format('total', total_ms / count if count else 0))
+    sys.stdout.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sdk', help='path to the App Engine SDK')
+    parser.add_argument('--log', help='JSON lines access log to replay')
+    parser.add_argument('--manifest', help='JSON map of path => SHA')
+    parser.add_argument('--paths', type=int, default=10000,
+                        help='synthetic manifest size (without --log)')
+    parser.add_argument('--requests', type=int, default=10000,
+                        help='number of requests (synthetic logs are '
+                             'generated, recorded logs are repeated)')
+    parser.add_argument('--rate', type=float, default=0,
+                        help='target requests per second (0 for unlimited)')
+    parser.add_argument('--threads', type=int, default=1,
+                        help='number of concurrent requests')
+    args = parser.parse_args()
+
+    common.setup_sdk(args.sdk)
+    redirects = common.make_redirects(NUM_REDIRECTS)
+    common.install_appengine_config(
+        REDIRECTS=redirects, SERVER_TIMING='always',
+        SERVER_TIMING_LOG_SAMPLE_RATE=0)
+
+    with common.Testbed():
+        from benchmarks import serving
+        from fileset.server import main as server_main
+        if args.log:
+            entries = read_log(args.log)
+            entries = [entries[i % len(entries)]
+                       for i in range(max(args.requests, len(entries)))]
+        if args.manifest:
+            with open(args.manifest) as fp:
+                paths = json.load(fp)
+        elif args.log:
+            paths = make_manifest_paths(entries)
+        else:
+            paths = common.make_paths(args.paths)
+        if not args.log:
+            entries = make_synthetic_log(paths, redirects, args.requests)
+        serving.write_error_page(paths)
+        serving.publish_manifest(paths, manifest_id=1)
+
+        recorder, seconds = replay(
+            server_main.app, entries, args.rate, args.threads)
+        print_report(recorder, seconds, args.rate)
+
+
+if __name__ == '__main__':
+    main()
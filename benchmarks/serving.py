@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+
+"""Serving-path microbenchmarks.
+
+Measures `RouteTrie` lookups, intl path generation, `RedirectMiddleware` and
+full requests through the WSGI `app` in `fileset/server/main.py` (which
+includes `MainHandler.serve_path`), against synthetic manifests and request
+mixes. Reports ops/sec, microseconds per op and allocations per op.
+
+Usage:
+
+    python -m benchmarks.serving [--sdk=PATH] [--sizes=1000,10000] [--quick]
+"""
+
+from __future__ import print_function
+
+import argparse
+import hashlib
+from benchmarks import common
+
+DEFAULT_SIZES = (1000, 10000, 100000, 500000)
+REDIRECT_COUNTS = (0, 100, 1000)
+
+# (name, hit_ratio, not_found_ratio), the rest are localized fallbacks.
+REQUEST_MIXES = (
+    ('hits', 1.0, 0.0),
+    ('mixed', 0.8, 0.1),
+    ('intl-heavy', 0.4, 0.1),
+    ('404-heavy', 0.5, 0.5),
+)
+
+
+def publish_manifest(paths, manifest_id):
+    """Makes `paths` the manifest of the default branch.
+
+    Manifests are published straight to memcache, like `set_branch_manifest`
+    does, since large synthetic manifests exceed the datastore entity limit.
+    """
+    from fileset.server import manifests
+    from fileset.server import utils
+    manifest = manifests.FilesetManifest(id=manifest_id)
+    manifest.commit = {'sha': 'bench', 'message': 'bench'}
+    manifest.paths = paths
+    manifests.publish_branch_manifest(utils.DEFAULT_BRANCH, manifest)
+    return manifest
+
+
+def write_error_page(paths):
+    from fileset.server import blobs
+    content = b'<!doctype html><title>Not found</title>'
+    sha = hashlib.sha1(content).hexdigest()
+    blobs.write(sha, content, 'text/html')
+    paths['/404.html'] = sha
+
+
+def make_wsgi_caller(app):
+    import webob
+
+    def call(item):
+        path, headers = item
+        request = webob.Request.blank(path, headers=headers)
+        request.host = common.HOST
+        return request.get_response(app)
+    return call
+
+
+def bench_route_trie(num_redirects, min_seconds):
+    from fileset.server import routetrie
+    trie = routetrie.RouteTrie()
+    for code, path, url in common.make_redirects(num_redirects):
+        trie.add(path, (code, url))
+    lookups = ['/old/page{}/'.format(i) for i in range(0, num_redirects, 7)]
+    lookups += ['/section{}/page{}/'.format(i % 100, i) for i in range(100)]
+    common.measure('routetrie.get redirects={}'.format(num_redirects),
+                   trie.get, lookups, min_seconds=min_seconds)
+
+
+def bench_intl(min_seconds):
+    from fileset.server import intl
+    requests = common.make_requests({'/index.html': 'x'}, 500)
+
+    def generate(item):
+        path, headers = item
+        return list(intl.generate_intl_paths(
+            '/foo/index.html',
+            accept_language=headers.get('Accept-Language'),
+            country=headers.get('X-AppEngine-Country')))
+    common.measure('intl.generate_intl_paths', generate, requests,
+                   min_seconds=min_seconds)
+
+
+def bench_redirect_middleware(num_redirects, min_seconds):
+    from fileset.server import main
+    from fileset.server import redirects
+    redirects.REDIRECTS = common.make_redirects(num_redirects)
+    middleware = redirects.RedirectMiddleware(main.app.app)
+    items = [('/old/page{}/'.format(i), {})
+             for i in range(0, max(num_redirects, 1), 3)]
+    common.measure(
+        'RedirectMiddleware redirect hits={}'.format(num_redirects),
+        make_wsgi_caller(middleware), items, min_seconds=min_seconds)
+
+
+def bench_serve(num_paths, min_seconds, quick=False):
+    from fileset.server import main
+    from fileset.server import redirects
+    paths = common.make_paths(num_paths)
+    write_error_page(paths)
+    publish_manifest(paths, manifest_id=num_paths)
+
+    # Serve benchmarks run without redirects.
+    redirects.REDIRECTS = ()
+    call = make_wsgi_caller(redirects.RedirectMiddleware(main.app.app))
+    mixes = REQUEST_MIXES[1:2] if quick else REQUEST_MIXES
+    for name, hit_ratio, not_found_ratio in mixes:
+        requests = common.make_requests(
+            paths, 500, hit_ratio=hit_ratio, not_found_ratio=not_found_ratio)
+        common.measure(
+            'serve paths={} mix={}'.format(num_paths, name), call, requests,
+            min_seconds=min_seconds)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sdk', help='path to the App Engine SDK')
+    parser.add_argument('--sizes', help='comma-separated manifest sizes')
+    parser.add_argument('--seconds', type=float, default=1.0,
+                        help='minimum seconds per scenario')
+    parser.add_argument('--quick', action='store_true',
+                        help='run a reduced set of scenarios')
+    args = parser.parse_args()
+
+    common.setup_sdk(args.sdk)
+    common.install_appengine_config()
+    sizes = DEFAULT_SIZES
+    if args.sizes:
+        sizes = [int(size) for size in args.sizes.split(',')]
+    elif args.quick:
+        sizes = DEFAULT_SIZES[:2]
+
+    with common.Testbed():
+        common.print_header()
+        for num_redirects in REDIRECT_COUNTS:
+            bench_route_trie(num_redirects, args.seconds)
+        bench_intl(args.seconds)
+        for num_redirects in REDIRECT_COUNTS[1:]:
+            bench_redirect_middleware(num_redirects, args.seconds)
+        for num_paths in sizes:
+            bench_serve(num_paths, args.seconds, quick=args.quick)
+
+
+if __name__ == '__main__':
+    main()
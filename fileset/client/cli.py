@@ -0,0 +1,333 @@
+#!/usr/bin/env python
+
+"""Command line tool that deploys a static build directory.
+
+Deploys any directory of built files (not just grow builds) to a fileset
+server, with the same branch, commit and timed deploy conventions as the
+grow deploy destination in `fileset/grow/ext.py`:
+
+    fileset deploy build/ --server=APPID.appspot.com [--branch=auto]
+        [--timed-deploy="2020-01-01 09:00" --timezone=America/Los_Angeles]
+
+Files are hashed in a process pool, and each file is checked and uploaded as
+soon as its hash is known, so hashing, existence checks and uploads overlap.
+Large files are hashed and uploaded through mmap. The auth token is read from
+`--token`, `.fileset.json` or the FILESET_TOKEN environment variable (in the
+same order as the grow deploy destination). `.fileset.json` and the journal
+are kept in the project root, found by searching upward from the build
+directory (see `get_project_root`).
+"""
+
+from __future__ import print_function
+
+import argparse
+import datetime
+import hashlib
+import json
+import logging
+import mmap
+import multiprocessing
+import os
+import subprocess
+import sys
+import time
+from fileset.client import deploy
+from fileset.client import fileset
+from fileset.client import journal
+
+CONFIG_PATH = '.fileset.json'
+
+# Files and directories that mark the project root.
+ROOT_MARKERS = (CONFIG_PATH, '.fileset', '.git')
+
+# Files of at least this many bytes are hashed and uploaded through mmap,
+# without reading them into memory first.
+MMAP_THRESHOLD = 1024 * 1024
+
+HASH_CHUNK_SIZE = 32
+
+
+class File(object):
+    """A file of the build directory, for `deploy.Deployer`."""
+
+    def __init__(self, filepath, path, sha, size):
+        self.filepath = filepath
+        self.path = path
+        self.hash = sha
+        self.size = size
+
+    def read(self):
+        """Returns the file's content, or an mmap of it for large files."""
+        with open(self.filepath, 'rb') as fp:
+            if self.size >= MMAP_THRESHOLD:
+                return mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+            return fp.read()
+
+
+def hash_file(filepath):
+    """Returns `(filepath, sha, size)` for a file."""
+    sha = hashlib.sha1()
+    with open(filepath, 'rb') as fp:
+        size = os.fstat(fp.fileno()).st_size
+        if size >= MMAP_THRESHOLD:
+            content = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                sha.update(content)
+            finally:
+                content.close()
+        else:
+            sha.update(fp.read())
+    return filepath, sha.hexdigest(), size
+
+
+def list_files(build_dir):
+    """Yields the paths of all files under a directory."""
+    for dirpath, _, filenames in os.walk(build_dir):
+        for filename in filenames:
+            yield os.path.join(dirpath, filename)
+
+
+def iter_files(build_dir, processes=None):
+    """Hashes the files of a build directory, yielding them as they're done."""
+    build_dir = os.path.abspath(build_dir)
+    pool = multiprocessing.Pool(processes)
+    try:
+        for filepath, sha, size in pool.imap_unordered(
+                hash_file, list_files(build_dir), HASH_CHUNK_SIZE):
+            relpath = os.path.relpath(filepath, build_dir)
+            path = '/' + relpath.replace(os.sep, '/')
+            yield File(filepath, path, sha, size)
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def get_host(server):
+    """Returns `--server` without its scheme, if any."""
+    return server.split('://', 1)[-1]
+
+
+def get_url(server, subdomain=None):
+    """Returns the URL of a server, or of its `<subdomain>-dot-` host."""
+    host = get_host(server)
+    if subdomain:
+        host = '{}-dot-{}'.format(subdomain, host)
+    if '://' in server:
+        return '{}://{}'.format(server.split('://', 1)[0], host)
+    if host.startswith('localhost'):
+        return 'http://{}'.format(host)
+    return fileset.FilesetClient._clean_host(host)
+
+
+def get_branch(args):
+    """Returns the branch to deploy to, like `FilesetDestination.get_branch`."""
+    if args.branch and args.branch != 'auto':
+        return args.branch
+
+    # Always use "master" on localhost.
+    if get_host(args.server).startswith('localhost'):
+        return 'master'
+
+    if os.environ.get('FILESET_BRANCH_NAME'):
+        branch = os.environ['FILESET_BRANCH_NAME']
+    elif os.environ.get('BRANCH_NAME'):
+        # Google Cloud Build uses "BRANCH_NAME" environ variable.
+        branch = os.environ['BRANCH_NAME']
+    elif os.environ.get('CI_COMMIT_REF_NAME'):
+        # Gitlab uses a detached git reference.
+        branch = os.environ['CI_COMMIT_REF_NAME']
+    else:
+        branch = _git('rev-parse', '--abbrev-ref', 'HEAD')
+        if not branch or branch == 'HEAD':
+            raise SystemExit('unable to determine the branch, use --branch')
+
+    if branch.startswith('feature/'):
+        branch = branch[8:]
+    branch = branch.replace('/', '-').lower()
+    return (args.branch_prefix or '') + branch
+
+
+def get_commit():
+    """Returns the commit being deployed, like `FilesetDestination.get_commit`."""
+    if os.environ.get('FILESET_COMMIT_SHA'):
+        sha = os.environ['FILESET_COMMIT_SHA']
+        message = os.environ.get('FILESET_COMMIT_TITLE', '')
+    elif os.environ.get('COMMIT_SHA'):
+        sha = os.environ['COMMIT_SHA']
+        message = ''
+    elif os.environ.get('CI_COMMIT_SHA'):
+        sha = os.environ['CI_COMMIT_SHA']
+        message = os.environ.get('CI_COMMIT_TITLE', '')
+    else:
+        sha = _git('rev-parse', 'HEAD') or ''
+        message = _git('log', '-1', '--format=%s') if sha else ''
+    return {
+        'sha': sha,
+        'message': message or '',
+    }
+
+
+def get_timed_deploy(args):
+    """Returns the timed deploy timestamp, or None to deploy right away."""
+    datetime_str = args.timed_deploy
+    if not datetime_str and args.timed_deploy_env:
+        datetime_str = os.environ.get(args.timed_deploy_env)
+    if not datetime_str:
+        return None
+    import pytz
+    dt = datetime.datetime.strptime(datetime_str, '%Y-%m-%d %H:%M')
+    localized_dt = pytz.timezone(args.timezone).localize(dt)
+    diff = localized_dt - datetime.datetime(1970, 1, 1, tzinfo=pytz.utc)
+    timestamp = int(diff.total_seconds())
+    if timestamp <= int(time.time()):
+        return None
+    return timestamp
+
+
+def get_project_root(build_dir):
+    """Returns the project root of a build directory.
+
+    That's the closest ancestor of the build directory with a `.fileset.json`
+    file, a `.fileset/` journal directory or a `.git` directory, or else the
+    build directory's parent. The build directory itself is deployed, so the
+    token and the journal are never kept in it.
+    """
+    parent = os.path.dirname(os.path.abspath(build_dir))
+    dirname = parent
+    while True:
+        for marker in ROOT_MARKERS:
+            if os.path.exists(os.path.join(dirname, marker)):
+                return dirname
+        next_dirname = os.path.dirname(dirname)
+        if next_dirname == dirname:
+            return parent
+        dirname = next_dirname
+
+
+def get_token(args, root):
+    if args.token:
+        return args.token
+    if get_host(args.server).startswith('localhost'):
+        # Localhost doesn't require an auth token.
+        return ''
+    config_path = os.path.join(root, CONFIG_PATH)
+    if os.path.exists(config_path):
+        with open(config_path) as fp:
+            return json.load(fp)['token']
+    if os.environ.get('FILESET_TOKEN'):
+        return os.environ['FILESET_TOKEN']
+    raise SystemExit(
+        '--token, "token" in {} or FILESET_TOKEN is required\n'
+        'visit {}/_fs/token to generate a new token'.format(
+            config_path, get_url(args.server)))
+
+
+def _git(*args):
+    try:
+        with open(os.devnull, 'w') as devnull:
+            output = subprocess.check_output(('git',) + args, stderr=devnull)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return output.decode('utf-8').strip()
+
+
+def run_deploy(args):
+    server = args.server
+    host = get_host(server)
+    branch = get_branch(args)
+    root = get_project_root(args.build_dir)
+    token = get_token(args, root)
+    deploy_timestamp = get_timed_deploy(args)
+
+    api_host = server
+    if branch != 'master':
+        api_host = get_url(server, branch)
+    fs = fileset.FilesetClient(api_host, token)
+    local_journal = journal.Journal(journal.get_path(root, host))
+    deployer = deploy.Deployer(fs, local_journal, max_workers=args.workers)
+
+    # Without a journal (e.g. on a new CI machine, or once its entries
+    # expired), start from the blobs of the branch's current manifest.
+    if local_journal.is_stale() and not host.startswith('localhost'):
+        deployer.warm_up(branch)
+
+    stats = {'files': 0, 'bytes': 0}
+
+    def count(files):
+        for f in files:
+            stats['files'] += 1
+            stats['bytes'] += f.size
+            yield f
+
+    start = time.time()
+    files = count(iter_files(args.build_dir, processes=args.processes))
+    manifest_id = deployer.deploy(
+        files, get_commit(), branch, deploy_timestamp=deploy_timestamp)
+    seconds = time.time() - start
+
+    lines = [
+        '',
+        'saved branch manifest:',
+        '  branch: {}'.format(branch),
+        '  manifest id: {}'.format(manifest_id),
+        '  files: {} ({:.1f} MB) in {:.1f}s'.format(
+            stats['files'], stats['bytes'] / 1e6, seconds),
+        '',
+        'url:',
+    ]
+    if host.startswith('localhost'):
+        lines.append('  {}'.format(get_url(server)))
+    elif deploy_timestamp:
+        lines.append('  {}'.format(
+            get_url(server, 'manifest-{}'.format(manifest_id))))
+    elif branch == 'master':
+        lines.append('  {}'.format(get_url(server)))
+    else:
+        lines.append('  {}'.format(get_url(server, branch)))
+    print('\n'.join(lines))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='fileset', description=__doc__.split('\n')[0])
+    subparsers = parser.add_subparsers(dest='command')
+    deploy_parser = subparsers.add_parser(
+        'deploy', help='deploy a build directory')
+    deploy_parser.add_argument('build_dir')
+    deploy_parser.add_argument(
+        '--server', required=True, help='e.g. APPID.appspot.com')
+    deploy_parser.add_argument(
+        '--branch', default='auto',
+        help='branch to deploy to, "auto" uses the git branch name')
+    deploy_parser.add_argument(
+        '--branch-prefix', help='prefix for branch names when --branch=auto')
+    deploy_parser.add_argument('--token', help='auth token')
+    deploy_parser.add_argument(
+        '--timed-deploy', help='deploy at a later time, "YYYY-MM-DD HH:MM"')
+    deploy_parser.add_argument(
+        '--timed-deploy-env',
+        help='environment variable with the --timed-deploy time')
+    deploy_parser.add_argument(
+        '--timezone', default='America/Los_Angeles',
+        help='timezone of the timed deploy')
+    deploy_parser.add_argument(
+        '--workers', type=int, default=deploy.MAX_WORKERS,
+        help='number of concurrent requests')
+    deploy_parser.add_argument(
+        '--processes', type=int, default=None,
+        help='number of hashing processes (defaults to the number of CPUs)')
+    deploy_parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args(argv)
+
+    if args.command != 'deploy':
+        parser.print_help()
+        return 1
+    logging.basicConfig(
+        level=logging.INFO if args.verbose else logging.WARNING,
+        format='%(message)s')
+    run_deploy(args)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
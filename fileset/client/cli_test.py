@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+
+import argparse
+import os
+import shutil
+import tempfile
+import unittest
+from fileset.client import cli
+
+
+class ProjectRootTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = os.path.realpath(tempfile.mkdtemp(prefix='fileset-test-'))
+        self.addCleanup(shutil.rmtree, self.root, True)
+        self.project = os.path.join(self.root, 'project')
+        self.build_dir = os.path.join(self.project, 'site', 'build')
+        os.makedirs(self.build_dir)
+
+    def _touch(self, *parts):
+        with open(os.path.join(*parts), 'w') as fp:
+            fp.write('{"token": "secret"}')
+
+    def test_config(self):
+        self._touch(self.project, cli.CONFIG_PATH)
+        self.assertEqual(self.project, cli.get_project_root(self.build_dir))
+        # Relative to the working directory.
+        cwd = os.getcwd()
+        self.addCleanup(os.chdir, cwd)
+        os.chdir(self.build_dir)
+        self.assertEqual(self.project, cli.get_project_root('.'))
+        os.chdir(self.root)
+        self.assertEqual(
+            self.project, cli.get_project_root('project/site/build/'))
+
+    def test_closest_marker(self):
+        os.mkdir(os.path.join(self.project, '.git'))
+        os.mkdir(os.path.join(self.project, 'site', '.fileset'))
+        self.assertEqual(os.path.join(self.project, 'site'),
+                         cli.get_project_root(self.build_dir))
+
+    def test_build_dir_is_never_the_root(self):
+        self._touch(self.build_dir, cli.CONFIG_PATH)
+        self.assertNotEqual(self.build_dir, cli.get_project_root(self.build_dir))
+
+    def test_get_token(self):
+        self._touch(self.project, cli.CONFIG_PATH)
+        args = argparse.Namespace(token=None, server='example.appspot.com')
+        self.assertEqual('secret', cli.get_token(args, self.project))
+        args.token = 'flag'
+        self.assertEqual('flag', cli.get_token(args, self.project))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+
+"""Deploys files to a fileset server.
+
+A `Deployer` uploads the blobs of a set of files (skipping blobs that the
+journal or the server already has), uploads the manifest and points a branch
+at it. It's used by the grow extension, the `fileset` command line tool and
+the deploy benchmark, and only needs objects with `path` and `hash`
+attributes and a `read()` method for the files, like grow's rendered
+documents (and optionally a `size` attribute, to avoid reading files).
+`read()` may return a file object or an mmap instead of the content, which is
+closed once the blob is uploaded.
+"""
+
+import logging
+import mimetypes
+from concurrent import futures
+from fileset import filemeta
+from fileset import merkle
+from fileset.client import fileset
+from fileset.client import preload
+from fileset.client import retry
+
+MAX_WORKERS = 20
+
+# Manifests with more files are uploaded in pages of this many files.
+MANIFEST_PAGE_SIZE = 5000
+
+# Manifests are derived from the branch's current manifest when less than this
+# fraction of the files changed, instead of uploading every file.
+MAX_DERIVE_RATIO = 0.5
+
+
+class Deployer(object):
+
+    def __init__(self, fs, journal, max_workers=MAX_WORKERS):
+        self.fs = fs
+        self.journal = journal
+        self.max_workers = max_workers
+        # Share a single limiter between all workers so that every worker
+        # backs off when the server starts throttling.
+        limiter = retry.ConcurrencyLimiter(max_workers)
+        self.retry_policy = retry.RetryPolicy(limiter=limiter)
+        # Requests that create manifests aren't idempotent, so they're only
+        # retried when the server didn't process them.
+        self.create_policy = retry.RetryPolicy(
+            limiter=limiter, idempotent=False)
+
+    def deploy(self, docs, commit, branch, deploy_timestamp=None):
+        """Uploads files and sets the branch's manifest. Returns its id."""
+        manifest = {
+            'commit': commit,
+            'files': self.upload_blobs(docs),
+        }
+        manifest_id = self.upload_manifest(manifest, branch=branch)
+        self.retry_policy.call(
+            self.fs.set_branch_manifest, branch, manifest_id,
+            deploy_timestamp=deploy_timestamp)
+        return manifest_id
+
+    def warm_up(self, branch):
+        """Adds the blobs of the branch's current manifest to the journal."""
+        try:
+            response = self.fs.get_branch_manifest(branch)
+            manifest = response.get('manifest')
+            if not manifest:
+                return
+            paths = manifest.get('paths') or {}
+            self.journal.update(paths.values())
+            logging.info('warmed up fileset cache')
+        except Exception as e:
+            logging.error('failed to warm fileset cache')
+            logging.error(e)
+
+    def upload_blobs(self, docs):
+        """Uploads the blobs of `docs` and returns their manifest entries."""
+        files = []
+        with futures.ThreadPoolExecutor(
+                max_workers=self.max_workers) as executor:
+            # Map of future => doc path.
+            results = {}
+            for doc in docs:
+                future = executor.submit(self.upload_blob, doc)
+                results[future] = doc.path
+
+            for future in futures.as_completed(results):
+                try:
+                    data = future.result()
+                except Exception:
+                    doc_path = results.get(future)
+                    logging.error('failed to upload: {}'.format(doc_path))
+                    raise
+                files.append(data)
+        self.journal.close()
+        return files
+
+    def upload_blob(self, doc):
+        sha = doc.hash
+        path = doc.path
+        if sha in self.journal:
+            return get_file_data(doc)
+        if not self.retry_policy.call(self.fs.blob_exists, sha):
+            logging.info('uploading blob {} {}'.format(sha, path))
+            content = doc.read()
+            try:
+                self.retry_policy.call(
+                    self.fs.upload_blob, sha, path, content)
+            except Exception:
+                logging.error('failed to upload {}'.format(path))
+                raise
+            finally:
+                if hasattr(content, 'close'):
+                    content.close()
+        self.journal.add(sha)
+        return get_file_data(doc)
+
+    def upload_manifest(self, manifest, branch=None):
+        """Uploads the manifest and returns its id.
+
+        The manifest is first compared to the branch's current manifest by
+        Merkle digests (see fileset/merkle.py). An unchanged manifest isn't
+        uploaded at all, and a manifest with few changes is derived from the
+        current one by sending only the changes. Otherwise, large manifests are
+        uploaded in pages (in parallel), to stay within the server's request
+        size limit and deadline.
+        """
+        files = manifest['files']
+        if branch:
+            manifest_id = self.derive_manifest(manifest, branch)
+            if manifest_id is not None:
+                return manifest_id
+
+        if len(files) <= MANIFEST_PAGE_SIZE:
+            response = self.create_policy.call(
+                self.fs.upload_manifest, manifest)
+            return response.json()['manifest_id']
+
+        session_id = self.create_policy.call(
+            self.fs.begin_manifest, manifest['commit'])
+        pages = [files[i:i + MANIFEST_PAGE_SIZE]
+                 for i in range(0, len(files), MANIFEST_PAGE_SIZE)]
+        with futures.ThreadPoolExecutor(
+                max_workers=self.max_workers) as executor:
+            results = [
+                executor.submit(
+                    self.retry_policy.call, self.fs.append_manifest_page,
+                    session_id, page, page_files)
+                for page, page_files in enumerate(pages)]
+            for future in results:
+                future.result()
+        logging.info('uploaded manifest in {} pages'.format(len(pages)))
+        response = self.create_policy.call(
+            self.fs.commit_manifest, session_id, len(pages))
+        return response.json()['manifest_id']
+
+    def derive_manifest(self, manifest, branch):
+        """Returns a manifest id derived from the branch's manifest, or None."""
+        files = manifest['files']
+        tree = merkle.Tree(
+            dict((data['path'], data['sha']) for data in files),
+            meta=dict((data['path'], get_file_meta(data)) for data in files))
+        try:
+            response = self.retry_policy.call(
+                self.fs.get_manifest_tree, branch=branch, dirs=[merkle.ROOT])
+        except fileset.Error as e:
+            # Servers without manifest.tree.
+            logging.info('not comparing manifests: {}'.format(e))
+            return None
+        base_manifest_id = response.get('manifest_id')
+        if not base_manifest_id:
+            return None
+        if response['root'] == tree.root:
+            logging.info('manifest unchanged: {}'.format(base_manifest_id))
+            return base_manifest_id
+
+        def get_nodes(dirs):
+            nodes = {}
+            for i in range(0, len(dirs), merkle.MAX_TREE_DIRS):
+                response = self.retry_policy.call(
+                    self.fs.get_manifest_tree, manifest_id=base_manifest_id,
+                    dirs=dirs[i:i + merkle.MAX_TREE_DIRS])
+                nodes.update(response['nodes'])
+            return nodes
+
+        changed, deleted = merkle.diff(
+            tree, get_nodes, nodes=response['nodes'])
+        if len(changed) + len(deleted) >= len(files) * MAX_DERIVE_RATIO:
+            return None
+        changed = set(changed)
+        changed_files = [data for data in files if data['path'] in changed]
+        manifest_id = self.create_policy.call(
+            self.fs.derive_manifest, base_manifest_id, manifest['commit'],
+            changed_files, deleted)
+        logging.info('derived manifest from {} ({} changed, {} deleted)'.format(
+            base_manifest_id, len(changed_files), len(deleted)))
+        return manifest_id
+
+
+def get_file_meta(data):
+    """Returns the metadata of a manifest entry, as stored by the server."""
+    return filemeta.clean(data)
+
+
+def get_file_data(doc):
+    """Returns the manifest entry for a file.
+
+    The size and content type are stored in the manifest, so the server can
+    answer HEAD requests and set headers without reading the blob. Files are
+    only read if they are HTML pages or if they have no `size` attribute.
+    """
+    content_type, _ = mimetypes.guess_type(doc.path)
+    size = getattr(doc, 'size', None)
+    content = None
+    if size is None or content_type == 'text/html':
+        content = doc.read()
+        if hasattr(content, 'read'):
+            fp = content
+            try:
+                content = fp.read()
+            finally:
+                fp.close()
+        if not isinstance(content, bytes):
+            content = content.encode('utf-8')
+        size = len(content)
+    data = {'size': size}
+    if content_type:
+        data['content_type'] = content_type
+    if content_type == 'text/html':
+        data['preload'] = preload.get_critical_assets(content, doc.path)
+    # Upload the metadata as the server stores it, so that the hashes of the
+    # local and the server's manifest match.
+    data = get_file_meta(data)
+    data['sha'] = doc.hash
+    data['path'] = doc.path
+    return data
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+
+import unittest
+from fileset import filemeta
+from fileset import merkle
+from fileset.client import deploy
+
+HTML = b'''<!doctype html>
+<html><head>
+<link rel="stylesheet" href="/main.css">
+<link rel="stylesheet" href="/print,screen.css">
+<script src="/a b.js"></script>
+<script src="https://example.com/external.js"></script>
+<script src="app.js"></script>
+</head><body></body></html>
+'''
+
+
+class Doc(object):
+
+    def __init__(self, path, content, size=None):
+        self.path = path
+        self.hash = 'a' * 40
+        self.content = content
+        if size is not None:
+            self.size = size
+
+    def read(self):
+        return self.content
+
+
+class GetFileDataTest(unittest.TestCase):
+
+    def test_html(self):
+        data = deploy.get_file_data(Doc('/x/index.html', HTML))
+        self.assertEqual({
+            'sha': 'a' * 40,
+            'path': '/x/index.html',
+            'size': len(HTML),
+            'content_type': 'text/html',
+            'preload': [
+                {'href': '/main.css', 'as': 'style'},
+                {'href': '/x/app.js', 'as': 'script'},
+            ],
+        }, data)
+
+    def test_matches_server_meta(self):
+        # The server stores `filemeta.clean()` of the uploaded entry, so the
+        # local tree has to hash the same metadata for manifests to match.
+        data = deploy.get_file_data(Doc('/index.html', HTML))
+        self.assertEqual(filemeta.clean(data), deploy.get_file_meta(data))
+        files = [data, deploy.get_file_data(Doc('/a.css', None, size=3))]
+        local = merkle.Tree(
+            dict((data['path'], data['sha']) for data in files),
+            meta=dict((data['path'], deploy.get_file_meta(data))
+                      for data in files))
+        server = merkle.Tree(
+            dict((data['path'], data['sha']) for data in files),
+            meta=dict((data['path'], filemeta.clean(data)) for data in files))
+        self.assertEqual(server.root, local.root)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,13 +1,21 @@
 #!/usr/bin/env python
 
+import email.utils
 import json
 import mimetypes
 import os
+import time
 import requests
 
 
 class Error(Exception):
-    pass
+
+    def __init__(self, message, status_code=None, retry_after=None):
+        super(Error, self).__init__(message)
+        # HTTP status code of the failed response, if any.
+        self.status_code = status_code
+        # Seconds the server asked us to wait before retrying, if any.
+        self.retry_after = retry_after
 
 
 class FilesetClient(object):
@@ -16,7 +24,8 @@ class FilesetClient(object):
         self.host = self._clean_host(host)
         self.token = token
 
-    def _clean_host(self, host):
+    @staticmethod
+    def _clean_host(host):
         if not host.startswith('http'):
             if host.startswith('localhost:8088'):
                 host = 'http://' + host
@@ -24,6 +33,32 @@ class FilesetClient(object):
                 host = 'https://' + host
         return host
 
+    def _check_response(self, response, method):
+        if response.status_code == 200:
+            return
+        text = response.text
+        if not isinstance(text, str):
+            text = text.encode('utf-8')
+        raise Error(
+            '{} failed: {}\n{}'.format(method, response.status_code, text),
+            status_code=response.status_code,
+            retry_after=self._get_retry_after(response))
+
+    def _get_retry_after(self, response, now=None):
+        """Parses the Retry-After header, which is either seconds or a date."""
+        value = response.headers.get('Retry-After')
+        if not value:
+            return None
+        value = value.strip()
+        if value.isdigit():
+            return int(value)
+        parsed = email.utils.parsedate_tz(value)
+        if not parsed:
+            return None
+        if now is None:
+            now = time.time()
+        return max(0, email.utils.mktime_tz(parsed) - now)
+
     def upload_manifest(self, manifest):
         payload = json.dumps(manifest)
         url = '{host}/_fs/api/manifest.upload'.format(host=self.host)
@@ -31,11 +66,91 @@ class FilesetClient(object):
             'Content-Type': 'application/json',
             'X-Fileset-Token': self.token,
         })
-        if response.status_code != 200:
-            raise Error('manifest.upload failed: {}\n{}'.format(
-                response.status_code, response.text))
+        self._check_response(response, 'manifest.upload')
+        return response
+
+    def begin_manifest(self, commit):
+        """Starts a paged manifest upload and returns the session id."""
+        data = {
+            'commit': commit,
+        }
+        payload = json.dumps(data)
+        url = '{host}/_fs/api/manifest.begin'.format(host=self.host)
+        response = requests.post(url, data=payload, headers={
+            'Content-Type': 'application/json',
+            'X-Fileset-Token': self.token,
+        })
+        self._check_response(response, 'manifest.begin')
+        return response.json()['session_id']
+
+    def append_manifest_page(self, session_id, page, files):
+        data = {
+            'session_id': session_id,
+            'page': page,
+            'files': files,
+        }
+        payload = json.dumps(data)
+        url = '{host}/_fs/api/manifest.append'.format(host=self.host)
+        response = requests.post(url, data=payload, headers={
+            'Content-Type': 'application/json',
+            'X-Fileset-Token': self.token,
+        })
+        self._check_response(response, 'manifest.append')
         return response
 
+    def commit_manifest(self, session_id, num_pages):
+        data = {
+            'session_id': session_id,
+            'num_pages': num_pages,
+        }
+        payload = json.dumps(data)
+        url = '{host}/_fs/api/manifest.commit'.format(host=self.host)
+        response = requests.post(url, data=payload, headers={
+            'Content-Type': 'application/json',
+            'X-Fileset-Token': self.token,
+        })
+        self._check_response(response, 'manifest.commit')
+        return response
+
+    def get_manifest_tree(self, branch=None, manifest_id=None, dirs=None):
+        """Returns Merkle tree nodes of a branch's manifest or a manifest.
+
+        The response has the `manifest_id`, the `root` digest and the
+        children of the requested directories under `nodes`.
+        """
+        data = {
+            'dirs': dirs,
+        }
+        if manifest_id is not None:
+            data['manifest_id'] = manifest_id
+        else:
+            data['branch'] = branch
+        payload = json.dumps(data)
+        url = '{host}/_fs/api/manifest.tree'.format(host=self.host)
+        response = requests.post(url, data=payload, headers={
+            'Content-Type': 'application/json',
+            'X-Fileset-Token': self.token,
+        })
+        self._check_response(response, 'manifest.tree')
+        return response.json()
+
+    def derive_manifest(self, base_manifest_id, commit, files, deleted):
+        """Saves a manifest from an existing one and returns its id."""
+        data = {
+            'base_manifest_id': base_manifest_id,
+            'commit': commit,
+            'files': files,
+            'deleted': deleted,
+        }
+        payload = json.dumps(data)
+        url = '{host}/_fs/api/manifest.derive'.format(host=self.host)
+        response = requests.post(url, data=payload, headers={
+            'Content-Type': 'application/json',
+            'X-Fileset-Token': self.token,
+        })
+        self._check_response(response, 'manifest.derive')
+        return response.json()['manifest_id']
+
     def blob_exists(self, sha):
         data = {
             'sha': sha,
@@ -46,12 +161,7 @@ class FilesetClient(object):
             'Content-Type': 'application/json',
             'X-Fileset-Token': self.token,
         })
-        if response.status_code != 200:
-            text = response.text
-            if isinstance(text, unicode):
-                text = text.encode('utf-8')
-            raise Error('blob.exists failed: {}\n{}'.format(
-                response.status_code, text))
+        self._check_response(response, 'blob.exists')
         return response.json()['exists']
 
     def upload_blob(self, sha, filepath, content):
@@ -59,18 +169,16 @@ class FilesetClient(object):
             host=self.host, sha=sha)
         filename = os.path.basename(filepath)
         mimetype = mimetypes.guess_type(filename)
+        if hasattr(content, 'seek'):
+            # File objects (and mmaps) are read to the end by each attempt.
+            content.seek(0)
         files = [
             ('blob', (filename, content, mimetype)),
         ]
         response = requests.post(url, files=files, headers={
             'X-Fileset-Token': self.token,
         })
-        if response.status_code != 200:
-            text = response.text
-            if isinstance(text, unicode):
-                text = text.encode('utf-8')
-            raise Error('blob.upload failed: {}\n{}'.format(
-                response.status_code, text))
+        self._check_response(response, 'blob.upload')
         return response
 
     def get_branch_manifest(self, branch):
@@ -83,9 +191,7 @@ class FilesetClient(object):
             'Content-Type': 'application/json',
             'X-Fileset-Token': self.token,
         })
-        if response.status_code != 200:
-            raise Error('branch.get_manifest failed: {}\n{}'.format(
-                response.status_code, response.text))
+        self._check_response(response, 'branch.get_manifest')
         return response.json()
 
     def set_branch_manifest(self, branch, manifest_id, deploy_timestamp=None):
@@ -101,7 +207,54 @@ class FilesetClient(object):
             'Content-Type': 'application/json',
             'X-Fileset-Token': self.token,
         })
-        if response.status_code != 200:
-            raise Error('branch.set_manifest failed: {}\n{}'.format(
-                response.status_code, response.text))
+        self._check_response(response, 'branch.set_manifest')
+        return response
+
+    def list_domains(self):
+        url = '{host}/_fs/api/domain.list'.format(host=self.host)
+        response = requests.post(url, data='{}', headers={
+            'Content-Type': 'application/json',
+            'X-Fileset-Token': self.token,
+        })
+        self._check_response(response, 'domain.list')
+        return response.json()['domains']
+
+    def set_domain(self, domain, branch):
+        data = {
+            'domain': domain,
+            'branch': branch,
+        }
+        payload = json.dumps(data)
+        url = '{host}/_fs/api/domain.set'.format(host=self.host)
+        response = requests.post(url, data=payload, headers={
+            'Content-Type': 'application/json',
+            'X-Fileset-Token': self.token,
+        })
+        self._check_response(response, 'domain.set')
+        return response.json()['domains']
+
+    def delete_domain(self, domain):
+        data = {
+            'domain': domain,
+        }
+        payload = json.dumps(data)
+        url = '{host}/_fs/api/domain.delete'.format(host=self.host)
+        response = requests.post(url, data=payload, headers={
+            'Content-Type': 'application/json',
+            'X-Fileset-Token': self.token,
+        })
+        self._check_response(response, 'domain.delete')
+        return response.json()['domains']
+
+    def revoke_token(self, token):
+        data = {
+            'token': token,
+        }
+        payload = json.dumps(data)
+        url = '{host}/_fs/api/token.revoke'.format(host=self.host)
+        response = requests.post(url, data=payload, headers={
+            'Content-Type': 'application/json',
+            'X-Fileset-Token': self.token,
+        })
+        self._check_response(response, 'token.revoke')
         return response
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+
+"""Append-only journal of blobs known to exist on a server.
+
+The journal is a text file with one `<sha> <timestamp>` line per blob. A line
+is appended (and flushed) as soon as an upload is confirmed, so a deploy that
+is killed midway keeps track of everything it uploaded, and the next deploy
+skips those blobs without asking the server. Appending a line only holds a
+lock for the duration of a small write, instead of rewriting a whole cache
+file.
+
+The server garbage collects blobs that weren't uploaded or confirmed within
+its retention window, so entries older than `MAX_AGE` seconds are ignored:
+those blobs are checked with the server again, and re-added with a new
+timestamp. Lines without a timestamp (from older clients) are ignored too.
+
+Duplicate and expired lines accumulate, so the file is rewritten without them
+when it's opened and has grown to `COMPACT_RATIO` times its number of SHAs. A
+partial last line left by a crash is ignored. A journal without a path is
+only kept in memory.
+"""
+
+import os
+import re
+import threading
+import time
+
+SHA_RE = re.compile(r'^[0-9a-f]{40}$')
+
+# Journals are kept per server, relative to the project root.
+PATH_FORMAT = '.fileset/journal.{}.txt'
+
+# Seconds an entry is trusted for. Must be shorter than the server's garbage
+# collection retention window (`fileset_GC_RETENTION_DAYS`, 30 days by
+# default).
+MAX_AGE = 7 * 24 * 3600
+
+COMPACT_RATIO = 2
+COMPACT_MIN_LINES = 1000
+
+
+class Journal(object):
+
+    def __init__(self, path=None, max_age=MAX_AGE):
+        self.path = path
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._file = None
+        # Map of SHA => timestamp of the last confirmation.
+        self._shas = {}
+        self._load()
+
+    def __contains__(self, sha):
+        timestamp = self._shas.get(sha)
+        return timestamp is not None and not self._is_expired(timestamp)
+
+    def __len__(self):
+        return len(self._shas)
+
+    def is_stale(self):
+        """Returns whether the journal has no unexpired entries.
+
+        That's the case on a new machine, or when the last deploy from this
+        machine was longer than `max_age` ago.
+        """
+        return not any(not self._is_expired(timestamp)
+                       for timestamp in list(self._shas.values()))
+
+    def _is_expired(self, timestamp):
+        return timestamp < time.time() - self.max_age
+
+    def _load(self):
+        num_lines = 0
+        if self.path and os.path.exists(self.path):
+            with open(self.path) as fp:
+                for line in fp:
+                    num_lines += 1
+                    parts = line.split()
+                    if (not line.endswith('\n') or len(parts) != 2
+                            or not SHA_RE.match(parts[0])
+                            or not parts[1].isdigit()):
+                        continue
+                    sha, timestamp = parts[0], int(parts[1])
+                    if (not self._is_expired(timestamp)
+                            and timestamp > self._shas.get(sha, 0)):
+                        self._shas[sha] = timestamp
+        if (num_lines > COMPACT_MIN_LINES
+                and num_lines > len(self._shas) * COMPACT_RATIO):
+            self.compact()
+
+    def _open(self):
+        if self._file is None:
+            dirname = os.path.dirname(self.path)
+            if dirname and not os.path.exists(dirname):
+                os.makedirs(dirname)
+            self._file = open(self.path, 'a')
+        return self._file
+
+    def add(self, sha):
+        """Records a SHA, returning False if it was already recorded."""
+        return self.update([sha]) > 0
+
+    def update(self, shas):
+        """Records several SHAs with a single write; returns how many were new.
+
+        SHAs whose entries expired are recorded again with the current time.
+        """
+        now = int(time.time())
+        lines = []
+        with self._lock:
+            for sha in shas:
+                if sha not in self and SHA_RE.match(sha):
+                    self._shas[sha] = now
+                    lines.append('{} {}\n'.format(sha, now))
+            if lines and self.path:
+                fp = self._open()
+                fp.write(''.join(lines))
+                fp.flush()
+        return len(lines)
+
+    def compact(self):
+        """Rewrites the journal with one line per unexpired SHA."""
+        if not self.path:
+            return
+        with self._lock:
+            self.close()
+            tmp_path = '{}.tmp'.format(self.path)
+            with open(tmp_path, 'w') as fp:
+                for sha, timestamp in sorted(self._shas.items()):
+                    if not self._is_expired(timestamp):
+                        fp.write('{} {}\n'.format(sha, timestamp))
+            _replace(tmp_path, self.path)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def get_path(root, server):
+    """Returns the path of the journal for a server."""
+    name = re.sub(r'[^\w.-]', '_', server)
+    return os.path.join(root, PATH_FORMAT.format(name))
+
+
+def _replace(src, dst):
+    try:
+        os.replace(src, dst)
+    except AttributeError:
+        # Python 2 has no atomic replace on Windows.
+        if os.name == 'nt' and os.path.exists(dst):
+            os.remove(dst)
+        os.rename(src, dst)
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from fileset.client import journal
+
+
+def _sha(value):
+    return '{:040x}'.format(value)
+
+
+class JournalTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='fileset-test-')
+        self.addCleanup(shutil.rmtree, self.root, True)
+        self.path = journal.get_path(self.root, 'example.appspot.com')
+
+    def _open(self, **kwargs):
+        local_journal = journal.Journal(self.path, **kwargs)
+        self.addCleanup(local_journal.close)
+        return local_journal
+
+    def _read_lines(self):
+        with open(self.path) as fp:
+            return fp.readlines()
+
+    def _write_lines(self, lines):
+        dirname = os.path.dirname(self.path)
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        with open(self.path, 'w') as fp:
+            fp.write(''.join(lines))
+
+    def test_get_path(self):
+        self.assertEqual(
+            os.path.join(self.root, '.fileset', 'journal.localhost_8088.txt'),
+            journal.get_path(self.root, 'localhost:8088'))
+
+    def test_append(self):
+        local_journal = self._open()
+        self.assertTrue(local_journal.is_stale())
+        self.assertTrue(local_journal.add(_sha(1)))
+        self.assertFalse(local_journal.add(_sha(1)))
+        self.assertEqual(2, local_journal.update([_sha(1), _sha(2), _sha(3)]))
+        self.assertFalse(local_journal.add('not a sha'))
+        self.assertIn(_sha(2), local_journal)
+        self.assertFalse(local_journal.is_stale())
+        # Entries are flushed as they're added.
+        self.assertEqual(3, len(self._read_lines()))
+
+        reopened = self._open()
+        self.assertEqual(3, len(reopened))
+        for i in (1, 2, 3):
+            self.assertIn(_sha(i), reopened)
+        self.assertNotIn(_sha(4), reopened)
+
+    def test_expiry(self):
+        now = int(time.time())
+        self._write_lines([
+            '{} {}\n'.format(_sha(1), now - 100),
+            '{} {}\n'.format(_sha(2), now - 10),
+            # Lines without a timestamp, from older clients.
+            '{}\n'.format(_sha(3)),
+        ])
+        local_journal = self._open(max_age=50)
+        self.assertNotIn(_sha(1), local_journal)
+        self.assertIn(_sha(2), local_journal)
+        self.assertNotIn(_sha(3), local_journal)
+        self.assertFalse(local_journal.is_stale())
+        # Expired entries are recorded again with a new timestamp.
+        self.assertTrue(local_journal.add(_sha(1)))
+        self.assertIn(_sha(1), self._open(max_age=50))
+
+        # Once every entry expired, the journal is stale.
+        local_journal.max_age = -1
+        self.assertTrue(local_journal.is_stale())
+
+    def test_compact(self):
+        now = int(time.time())
+        lines = ['{} {}\n'.format(_sha(i % 10), now)
+                 for i in range(journal.COMPACT_MIN_LINES)]
+        lines.append('{} {}\n'.format(_sha(99), now - 1000))
+        self._write_lines(lines)
+        local_journal = self._open(max_age=100)
+        self.assertEqual(10, len(local_journal))
+        self.assertEqual(
+            ['{} {}\n'.format(_sha(i), now) for i in range(10)],
+            self._read_lines())
+        # The compacted journal is appended to.
+        local_journal.add(_sha(10))
+        self.assertEqual(11, len(self._read_lines()))
+        self.assertFalse(os.path.exists(self.path + '.tmp'))
+
+    def test_no_compact(self):
+        now = int(time.time())
+        lines = ['{} {}\n'.format(_sha(i % 10), now) for i in range(100)]
+        self._write_lines(lines)
+        self.assertEqual(10, len(self._open()))
+        # Small journals aren't rewritten.
+        self.assertEqual(100, len(self._read_lines()))
+
+    def test_truncated_line(self):
+        now = int(time.time())
+        # A crash while appending leaves a partial last line.
+        self._write_lines([
+            '{} {}\n'.format(_sha(1), now),
+            '{} {}'.format(_sha(2), now)[:30],
+        ])
+        local_journal = self._open()
+        self.assertIn(_sha(1), local_journal)
+        self.assertEqual(1, len(local_journal))
+        # A partial line that is a complete SHA and timestamp isn't trusted
+        # either, the timestamp may have been cut short.
+        self._write_lines([
+            '{} {}\n'.format(_sha(1), now),
+            '{} {}'.format(_sha(2), now),
+        ])
+        self.assertNotIn(_sha(2), self._open())
+
+    def test_memory_only(self):
+        local_journal = journal.Journal()
+        self.assertTrue(local_journal.add(_sha(1)))
+        self.assertIn(_sha(1), local_journal)
+        local_journal.compact()
+        self.assertFalse(os.path.exists(os.path.join(self.root, '.fileset')))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+
+"""Extracts the critical subresources of rendered HTML pages.
+
+Stylesheets, blocking scripts and explicitly preloaded resources referenced
+in a page's `<head>` are sent to the server with the manifest, so the server
+can announce them with `Link: rel=preload` headers (and 103 Early Hints)
+before the browser has parsed the HTML.
+"""
+
+import posixpath
+try:
+    from html.parser import HTMLParser
+    from urllib.parse import urlparse
+except ImportError:
+    from HTMLParser import HTMLParser
+    from urlparse import urlparse
+from fileset import filemeta
+
+MAX_ASSETS = filemeta.MAX_PRELOAD
+
+
+class _HeadParser(HTMLParser):
+
+    def __init__(self):
+        HTMLParser.__init__(self)
+        self.assets = []
+        self.done = False
+
+    def handle_starttag(self, tag, attrs):
+        if self.done:
+            return
+        if tag == 'body':
+            self.done = True
+            return
+        attrs = dict((key, value or '') for key, value in attrs)
+        if tag == 'link':
+            rel = attrs.get('rel', '').lower().split()
+            if 'stylesheet' in rel and attrs.get('media', 'all') in (
+                    'all', 'screen'):
+                self.assets.append((attrs.get('href'), 'style'))
+            elif 'preload' in rel:
+                self.assets.append((attrs.get('href'), attrs.get('as')))
+        elif tag == 'script':
+            # Async, deferred and module scripts don't block rendering.
+            if ('async' not in attrs and 'defer' not in attrs
+                    and attrs.get('type') != 'module'):
+                self.assets.append((attrs.get('src'), 'script'))
+
+    def handle_endtag(self, tag):
+        if tag == 'head':
+            self.done = True
+
+
+def get_critical_assets(html, page_path, max_assets=MAX_ASSETS):
+    """Returns the critical subresources of an HTML page.
+
+    Returns a list of `{"href": ..., "as": ...}` dicts for same-origin
+    resources, with hrefs resolved to absolute paths.
+    """
+    if isinstance(html, bytes):
+        html = html.decode('utf-8', 'replace')
+    parser = _HeadParser()
+    try:
+        parser.feed(html)
+        parser.close()
+    except Exception:
+        # Malformed HTML; use whatever was found before the error.
+        pass
+
+    assets = []
+    seen = set()
+    for href, kind in parser.assets:
+        if kind not in filemeta.PRELOAD_TYPES:
+            continue
+        href = _resolve(href, page_path)
+        if not href or href in seen:
+            continue
+        seen.add(href)
+        assets.append({'href': href, 'as': kind})
+        if len(assets) >= max_assets:
+            break
+    return assets
+
+
+def _resolve(href, page_path):
+    """Resolves a same-origin href against a page path, or returns None."""
+    if not href:
+        return None
+    href = href.strip()
+    parts = urlparse(href)
+    if parts.scheme or parts.netloc or href.startswith('#'):
+        return None
+    path = parts.path
+    if not path.startswith('/'):
+        path = posixpath.join(posixpath.dirname(page_path), path)
+    path = posixpath.normpath(path)
+    if parts.query:
+        path += '?' + parts.query
+    return path
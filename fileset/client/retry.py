@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+
+"""Retry and throttling helpers for the fileset client.
+
+A `RetryPolicy` retries calls that fail with a retryable error (connection
+errors, 429 or 5xx responses) using exponential backoff with full jitter, and
+honors the server's `Retry-After` header when one is sent. Policies for
+requests that aren't idempotent (e.g. saving a manifest) only retry errors
+that guarantee the request wasn't processed: 429 responses and failures to
+connect.
+
+A `ConcurrencyLimiter` is shared by all upload workers. Whenever any worker
+sees the server throttling, the limiter halves the number of requests allowed
+in flight (and pauses everyone for `Retry-After` seconds, if given). The limit
+grows back by one after a run of successful requests, so throughput degrades
+gracefully under load instead of collapsing.
+"""
+
+import logging
+import random
+import threading
+import time
+import requests
+from fileset.client import fileset
+
+RETRYABLE_STATUS_CODES = frozenset([408, 429, 500, 502, 503, 504])
+THROTTLE_STATUS_CODES = frozenset([429, 503])
+
+
+def is_retryable(error, idempotent=True):
+    """Returns whether a failed call should be retried."""
+    if not idempotent:
+        if isinstance(error, fileset.Error):
+            return error.status_code == 429
+        return isinstance(error, requests.ConnectTimeout)
+    if isinstance(error, fileset.Error):
+        return error.status_code in RETRYABLE_STATUS_CODES
+    return isinstance(error, (requests.ConnectionError, requests.Timeout))
+
+
+def is_throttled(error):
+    """Returns whether an error indicates that the server is overloaded."""
+    if isinstance(error, fileset.Error):
+        return (error.status_code in THROTTLE_STATUS_CODES
+                or error.retry_after is not None)
+    return False
+
+
+class ConcurrencyLimiter(object):
+    """Limits concurrent requests using additive-increase/multiplicative-decrease.
+
+    The limiter is meant to be shared by every worker thread of a deploy.
+    """
+
+    # Minimum number of seconds between two consecutive decreases, so that a
+    # burst of simultaneous failures only halves the limit once.
+    DECREASE_COOLDOWN = 1.0
+
+    def __init__(self, max_limit, min_limit=1, clock=time.time):
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.limit = max_limit
+        self.clock = clock
+        self._active = 0
+        self._successes = 0
+        self._last_decrease = 0
+        self._resume_at = 0
+        self._cond = threading.Condition()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+    def acquire(self):
+        with self._cond:
+            while True:
+                wait = self._resume_at - self.clock()
+                if wait > 0:
+                    self._cond.wait(wait)
+                    continue
+                if self._active < self.limit:
+                    break
+                self._cond.wait()
+            self._active += 1
+
+    def release(self):
+        with self._cond:
+            self._active -= 1
+            self._cond.notify()
+
+    def on_success(self):
+        with self._cond:
+            if self.limit >= self.max_limit:
+                return
+            self._successes += 1
+            if self._successes >= self.limit:
+                self._successes = 0
+                self.limit += 1
+                self._cond.notify()
+
+    def on_throttle(self, retry_after=None):
+        with self._cond:
+            now = self.clock()
+            if retry_after:
+                self._resume_at = max(self._resume_at, now + retry_after)
+            if now - self._last_decrease < self.DECREASE_COOLDOWN:
+                return
+            self._last_decrease = now
+            self._successes = 0
+            new_limit = max(self.min_limit, self.limit // 2)
+            if new_limit != self.limit:
+                logging.info('server is throttling, reducing concurrency: '
+                             '{} -> {}'.format(self.limit, new_limit))
+                self.limit = new_limit
+
+
+class RetryPolicy(object):
+    """Retries calls with exponential backoff, jitter and Retry-After support.
+
+    `sleep` and `rand` (a `random.Random`) can be replaced, e.g. by tests.
+    """
+
+    def __init__(self, max_tries=6, base_delay=0.5, max_delay=30.0,
+                 max_retry_after=120.0, limiter=None, idempotent=True,
+                 sleep=time.sleep, rand=None):
+        self.max_tries = max_tries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_retry_after = max_retry_after
+        self.limiter = limiter
+        self.idempotent = idempotent
+        self.sleep = sleep
+        self.random = rand or random
+
+    def get_delay(self, attempt, error=None):
+        """Returns the number of seconds to sleep before the next attempt."""
+        retry_after = getattr(error, 'retry_after', None)
+        if retry_after is not None:
+            return min(retry_after, self.max_retry_after)
+        # "Full jitter" backoff spreads retries from many workers so they don't
+        # hit the server in lockstep.
+        ceiling = min(self.max_delay, self.base_delay * (2 ** attempt))
+        return self.random.uniform(0, ceiling)
+
+    def call(self, func, *args, **kwargs):
+        """Calls `func`, retrying retryable errors until `max_tries` is hit."""
+        attempt = 0
+        while True:
+            try:
+                if self.limiter:
+                    with self.limiter:
+                        result = func(*args, **kwargs)
+                else:
+                    result = func(*args, **kwargs)
+            except Exception as e:
+                attempt += 1
+                if (not is_retryable(e, idempotent=self.idempotent)
+                        or attempt >= self.max_tries):
+                    raise
+                retry_after = getattr(e, 'retry_after', None)
+                if self.limiter and is_throttled(e):
+                    self.limiter.on_throttle(retry_after=retry_after)
+                delay = self.get_delay(attempt, e)
+                logging.warning('retrying {} in {:.1f}s ({}/{}): {}'.format(
+                    getattr(func, '__name__', 'request'), delay, attempt,
+                    self.max_tries - 1, str(e).split('\n', 1)[0]))
+                self.sleep(delay)
+                continue
+            if self.limiter:
+                self.limiter.on_success()
+            return result
@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+
+import email.utils
+import random
+import unittest
+import requests
+from fileset.client import fileset
+from fileset.client import retry
+
+
+class MaxRandom(object):
+    """Always returns the upper bound, to check backoff ceilings."""
+
+    def uniform(self, a, b):
+        return b
+
+
+class Clock(object):
+
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class Response(object):
+
+    def __init__(self, headers):
+        self.headers = headers
+
+
+def _error(status_code, retry_after=None):
+    return fileset.Error('failed: {}'.format(status_code),
+                         status_code=status_code, retry_after=retry_after)
+
+
+def _failing(errors, result='ok'):
+    """Returns a function that raises `errors` in turn, then returns."""
+    errors = list(errors)
+    calls = []
+
+    def func():
+        calls.append(1)
+        if errors:
+            raise errors.pop(0)
+        return result
+
+    func.calls = calls
+    return func
+
+
+class RetryPolicyTest(unittest.TestCase):
+
+    def test_backoff_bounds(self):
+        policy = retry.RetryPolicy(base_delay=0.5, max_delay=30.0,
+                                   rand=MaxRandom())
+        self.assertEqual(1.0, policy.get_delay(1))
+        self.assertEqual(2.0, policy.get_delay(2))
+        self.assertEqual(16.0, policy.get_delay(5))
+        self.assertEqual(30.0, policy.get_delay(6))
+        self.assertEqual(30.0, policy.get_delay(20))
+
+    def test_backoff_jitter(self):
+        policy = retry.RetryPolicy(base_delay=0.5, max_delay=30.0,
+                                   rand=random.Random(0))
+        for attempt in range(1, 10):
+            ceiling = min(30.0, 0.5 * 2 ** attempt)
+            for _ in range(20):
+                delay = policy.get_delay(attempt)
+                self.assertTrue(0 <= delay <= ceiling, delay)
+
+    def test_retry_after(self):
+        policy = retry.RetryPolicy(max_retry_after=120.0, rand=MaxRandom())
+        self.assertEqual(7, policy.get_delay(1, _error(429, retry_after=7)))
+        self.assertEqual(
+            120.0, policy.get_delay(1, _error(429, retry_after=600)))
+        # Without Retry-After, the backoff applies.
+        self.assertEqual(1.0, policy.get_delay(1, _error(503)))
+
+    def test_call_retries(self):
+        sleeps = []
+        policy = retry.RetryPolicy(max_tries=3, sleep=sleeps.append,
+                                   rand=MaxRandom())
+        func = _failing([_error(500), _error(429, retry_after=3)])
+        self.assertEqual('ok', policy.call(func))
+        self.assertEqual(3, len(func.calls))
+        self.assertEqual([1.0, 3], sleeps)
+
+    def test_call_max_tries(self):
+        sleeps = []
+        policy = retry.RetryPolicy(max_tries=3, sleep=sleeps.append,
+                                   rand=MaxRandom())
+        func = _failing([_error(500)] * 5)
+        with self.assertRaises(fileset.Error):
+            policy.call(func)
+        self.assertEqual(3, len(func.calls))
+        self.assertEqual(2, len(sleeps))
+
+    def test_call_not_retryable(self):
+        sleeps = []
+        policy = retry.RetryPolicy(sleep=sleeps.append)
+        for error in (_error(400), _error(403), ValueError('bug')):
+            func = _failing([error])
+            with self.assertRaises(type(error)):
+                policy.call(func)
+            self.assertEqual(1, len(func.calls))
+        self.assertEqual([], sleeps)
+
+    def test_is_retryable(self):
+        for status_code in (408, 429, 500, 502, 503, 504):
+            self.assertTrue(retry.is_retryable(_error(status_code)))
+        self.assertFalse(retry.is_retryable(_error(404)))
+        self.assertTrue(retry.is_retryable(requests.ConnectionError()))
+        self.assertTrue(retry.is_retryable(requests.ReadTimeout()))
+
+    def test_not_idempotent(self):
+        # Only errors that guarantee the request wasn't processed are retried.
+        self.assertTrue(
+            retry.is_retryable(_error(429), idempotent=False))
+        self.assertTrue(
+            retry.is_retryable(requests.ConnectTimeout(), idempotent=False))
+        for error in (_error(500), _error(503), _error(408),
+                      requests.ReadTimeout(), requests.ConnectionError()):
+            self.assertFalse(retry.is_retryable(error, idempotent=False))
+
+        sleeps = []
+        policy = retry.RetryPolicy(idempotent=False, sleep=sleeps.append)
+        func = _failing([_error(500)])
+        with self.assertRaises(fileset.Error):
+            policy.call(func)
+        self.assertEqual(1, len(func.calls))
+        func = _failing([_error(429), requests.ConnectTimeout()])
+        self.assertEqual('ok', policy.call(func))
+        self.assertEqual(3, len(func.calls))
+
+    def test_throttle_reduces_concurrency(self):
+        clock = Clock()
+        limiter = retry.ConcurrencyLimiter(8, clock=clock)
+        policy = retry.RetryPolicy(limiter=limiter, sleep=lambda _: None)
+        func = _failing([_error(429)])
+        self.assertEqual('ok', policy.call(func))
+        self.assertEqual(4, limiter.limit)
+        # Server errors that aren't throttling don't reduce concurrency.
+        clock.now += 10
+        self.assertEqual('ok', policy.call(_failing([_error(500)])))
+        self.assertEqual(4, limiter.limit)
+
+
+class RetryAfterTest(unittest.TestCase):
+
+    def _parse(self, value, now=1000000000.0):
+        client = fileset.FilesetClient('example.com', 'token')
+        headers = {'Retry-After': value} if value is not None else {}
+        return client._get_retry_after(Response(headers), now=now)
+
+    def test_seconds(self):
+        self.assertEqual(120, self._parse('120'))
+        self.assertEqual(0, self._parse(' 0 '))
+
+    def test_http_date(self):
+        now = 1000000000.0
+        value = email.utils.formatdate(now + 30, usegmt=True)
+        self.assertEqual(30, self._parse(value, now=now))
+        # Dates in the past mean "retry now".
+        value = email.utils.formatdate(now - 30, usegmt=True)
+        self.assertEqual(0, self._parse(value, now=now))
+
+    def test_invalid(self):
+        self.assertIsNone(self._parse(None))
+        self.assertIsNone(self._parse(''))
+        self.assertIsNone(self._parse('soon'))
+        self.assertIsNone(self._parse('-5'))
+
+
+class ConcurrencyLimiterTest(unittest.TestCase):
+
+    def test_halving(self):
+        clock = Clock()
+        limiter = retry.ConcurrencyLimiter(16, min_limit=2, clock=clock)
+        limiter.on_throttle()
+        self.assertEqual(8, limiter.limit)
+        # A burst of failures within the cooldown only halves the limit once.
+        clock.now += limiter.DECREASE_COOLDOWN / 2
+        limiter.on_throttle()
+        self.assertEqual(8, limiter.limit)
+        for expected in (4, 2, 2):
+            clock.now += limiter.DECREASE_COOLDOWN
+            limiter.on_throttle()
+            self.assertEqual(expected, limiter.limit)
+
+    def test_recovery(self):
+        clock = Clock()
+        limiter = retry.ConcurrencyLimiter(4, clock=clock)
+        limiter.on_throttle()
+        self.assertEqual(2, limiter.limit)
+        # The limit grows by one after `limit` successes.
+        limiter.on_success()
+        self.assertEqual(2, limiter.limit)
+        limiter.on_success()
+        self.assertEqual(3, limiter.limit)
+        for _ in range(3):
+            limiter.on_success()
+        self.assertEqual(4, limiter.limit)
+        # It never exceeds the maximum.
+        for _ in range(10):
+            limiter.on_success()
+        self.assertEqual(4, limiter.limit)
+
+    def test_retry_after_pauses(self):
+        clock = Clock()
+        limiter = retry.ConcurrencyLimiter(4, clock=clock)
+        limiter.on_throttle(retry_after=5)
+        self.assertEqual(clock.now + 5, limiter._resume_at)
+        # A shorter Retry-After doesn't shorten the pause.
+        limiter.on_throttle(retry_after=1)
+        self.assertEqual(clock.now + 5, limiter._resume_at)
+        # Once the pause is over, requests go through right away.
+        clock.now += 5
+        with limiter:
+            self.assertEqual(1, limiter._active)
+        self.assertEqual(0, limiter._active)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -21,21 +21,61 @@ class ConfigDefaults(object):
     # List of emails that are authorized to access Env.STAGING.
     AUTHORIZED_USERS = frozenset()
 
+    # Number of days that signed API tokens created by /_fs/token are valid.
+    AUTH_TOKEN_TTL_DAYS = 365
+
+    # Small blobs read by an instance (error pages, and blobs prefetched by
+    # the warmup request) are kept in memory, up to BLOB_CACHE_MAX_BYTES in
+    # total. Blobs larger than BLOB_CACHE_MAX_BLOB_SIZE are never cached.
+    BLOB_CACHE_MAX_BYTES = 16 * 1024 * 1024
+    BLOB_CACHE_MAX_BLOB_SIZE = 256 * 1024
+
     # If provided, any Env.PROD requests that do not match the CANONICAL_DOMAIN
     # will be redirected there with the path and query strings preserved. Useful
     # for redirecting "www" to the naked domain (or vice versa), for example.
+    # Domains routed to a branch with the /_fs/api/domain.set API are exempt.
     CANONICAL_DOMAIN = None
 
     # The name of the default branch to use if a branch isn't inferred from the
     # URL. Requests to Env.PROD will always read from the DEFAULT_BRANCH.
     DEFAULT_BRANCH = 'master'
 
+    # Whether the garbage collector (the /_fs/api/cron.gc cron job) is allowed
+    # to run. Garbage collection deletes blobs and manifests that are not
+    # referenced by a branch, a pending timed deploy or a recent manifest.
+    GC_ENABLED = False
+
+    # When True, the garbage collector only logs what it would delete.
+    GC_DRY_RUN = True
+
+    # Manifests created within the retention window (and the blobs they
+    # reference) are never deleted. Blobs uploaded or reported to exist (by
+    # blob.exists) within the window are also kept, so that in-progress
+    # deploys aren't affected. The deploy client trusts its local journal of
+    # uploaded blobs for 7 days (fileset/client/journal.py), so the window
+    # must be longer than that.
+    GC_RETENTION_DAYS = 30
+
+    # Number of blobs or manifests to inspect per batch, and the maximum
+    # number of deletes per garbage collection run.
+    GC_BATCH_SIZE = 500
+    GC_MAX_DELETES = 5000
+
     # The path format for internationalized/localized paths, where:
     #
     #     * `{locale}` can either be `<lang>_<country>` or just `<lang>`
     #     * `{path}` is the request path, including the leading slash
     INTL_PATH_FORMAT = '/intl/{locale}{path}'
 
+    # When True, HTML pages are negotiated in a way that lets a CDN cache them.
+    # Requests for a page with localized variants are redirected to the
+    # best-matching localized URL (with `Cache-Control: private`, since the
+    # choice depends on the user), and localized URLs are served as-is, with a
+    # `Content-Language` header and INTL_CACHE_CONTROL. Pages without
+    # localized variants also get INTL_CACHE_CONTROL.
+    INTL_REDIRECTS = False
+    INTL_CACHE_CONTROL = 'public, max-age=300'
+
     # A list of redirects, formatted as:
     #
     #     (code, source, dest)
@@ -48,12 +88,58 @@ class ConfigDefaults(object):
     #     * `dest` is the destination url, which can accept $param values
     REDIRECTS = tuple()
 
+    # Manifests are immutable, so branch manifests and manifests addressed by
+    # id (the `manifest-<id>-dot-<app>` preview URLs of timed deploys) are
+    # cached in memory until evicted to stay within this budget, measured in
+    # total number of paths across cached manifests.
+    MANIFEST_CACHE_MAX_PATHS = 250000
+
+    # Cache-Control header for responses served from `manifest-<id>` preview
+    # URLs. Preview URLs require login, so the default only allows browsers
+    # to cache the (immutable) responses. Use "public, ..." only if the preview
+    # hosts are not protected by authentication.
+    MANIFEST_CACHE_CONTROL = 'private, max-age=31536000, immutable'
+
+    # Whether to add `Link: rel=preload` headers for the critical subresources
+    # (stylesheets, blocking scripts, preloaded fonts) that the client recorded
+    # for each HTML page. CDNs and frontends that support 103 Early Hints can
+    # send these before the response itself.
+    PRELOAD_LINKS = True
+
     # Whether to require authentication, even on Env.PROD.
     REQUIRE_AUTH = False
 
     # Whether to enforce https for all Env.PROD requests.
     REQUIRE_HTTPS = False
 
+    # When to add a Server-Timing header with the time spent in each stage of a
+    # request (middleware, manifest, intl, and blob for bodies written from
+    # memory or blob_dispatch for bodies that storage sends after the handler
+    # returns, which only covers the handoff). One of:
+    #
+    #     * 'always'
+    #     * 'authorized': on Env.DEV and Env.STAGING, and on Env.PROD for signed
+    #       in AUTHORIZED_USERS/AUTHORIZED_ORGS
+    #     * None: never
+    SERVER_TIMING = 'authorized'
+
+    # Fraction of requests whose stage timings are logged. Requests slower
+    # than SERVER_TIMING_SLOW_MS are always logged.
+    SERVER_TIMING_LOG_SAMPLE_RATE = 0.01
+    SERVER_TIMING_SLOW_MS = 1000
+
+    # Where blobs are stored, either "gcs" (the app's default GCS bucket) or
+    # "local" (the STORAGE_ROOT directory on the local filesystem, useful for
+    # running or benchmarking the server outside of App Engine).
+    STORAGE_BACKEND = 'gcs'
+    STORAGE_ROOT = None
+
+    # Number of the most requested blobs (across recently active instances)
+    # that the /_ah/warmup request loads into the blob cache. 0 disables
+    # prefetching; the default branch manifest and redirects are always
+    # loaded. Requires `inbound_services: [warmup]` in app.yaml.
+    WARMUP_PREFETCH_BLOBS = 0
+
     # HTTP response headers to append to certain requests. Right now, only
     # supports headers for HTML files.
     RESPONSE_HEADERS = {
@@ -67,10 +153,29 @@ config = lib_config.register('fileset', ConfigDefaults.__dict__)
 
 AUTHORIZED_ORGS = config.AUTHORIZED_ORGS
 AUTHORIZED_USERS = config.AUTHORIZED_USERS
+AUTH_TOKEN_TTL_DAYS = config.AUTH_TOKEN_TTL_DAYS
+BLOB_CACHE_MAX_BLOB_SIZE = config.BLOB_CACHE_MAX_BLOB_SIZE
+BLOB_CACHE_MAX_BYTES = config.BLOB_CACHE_MAX_BYTES
 CANONICAL_DOMAIN = config.CANONICAL_DOMAIN
 DEFAULT_BRANCH = config.DEFAULT_BRANCH
+GC_BATCH_SIZE = config.GC_BATCH_SIZE
+GC_DRY_RUN = config.GC_DRY_RUN
+GC_ENABLED = config.GC_ENABLED
+GC_MAX_DELETES = config.GC_MAX_DELETES
+GC_RETENTION_DAYS = config.GC_RETENTION_DAYS
+INTL_CACHE_CONTROL = config.INTL_CACHE_CONTROL
 INTL_PATH_FORMAT = config.INTL_PATH_FORMAT
+INTL_REDIRECTS = config.INTL_REDIRECTS
+MANIFEST_CACHE_CONTROL = config.MANIFEST_CACHE_CONTROL
+MANIFEST_CACHE_MAX_PATHS = config.MANIFEST_CACHE_MAX_PATHS
+PRELOAD_LINKS = config.PRELOAD_LINKS
 REDIRECTS = config.REDIRECTS
 REQUIRE_AUTH = config.REQUIRE_AUTH
 REQUIRE_HTTPS = config.REQUIRE_HTTPS
 RESPONSE_HEADERS = config.RESPONSE_HEADERS
+SERVER_TIMING = config.SERVER_TIMING
+SERVER_TIMING_LOG_SAMPLE_RATE = config.SERVER_TIMING_LOG_SAMPLE_RATE
+SERVER_TIMING_SLOW_MS = config.SERVER_TIMING_SLOW_MS
+STORAGE_BACKEND = config.STORAGE_BACKEND
+STORAGE_ROOT = config.STORAGE_ROOT
+WARMUP_PREFETCH_BLOBS = config.WARMUP_PREFETCH_BLOBS
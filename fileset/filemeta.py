@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+
+"""Metadata of manifest files, shared by the client and the server.
+
+The server stores the cleaned metadata of every file in the manifest, and the
+Merkle tree hashes files with their metadata, so the client cleans metadata
+the same way before hashing and uploading it.
+"""
+
+# Content codings of pre-compressed variants that files may have, in order of
+# preference.
+ENCODINGS = ('br', 'gzip')
+
+# Destination types of critical subresources that HTML pages may declare, and
+# the maximum number of subresources per page.
+PRELOAD_TYPES = ('font', 'image', 'script', 'style')
+MAX_PRELOAD = 8
+
+
+def clean(file_data):
+    """Returns the metadata of a file in a manifest.
+
+    Recognized fields are:
+
+        * `size`: size of the blob in bytes
+        * `content_type`: the Content-Type to serve the file with
+        * `encodings`: map of content coding (e.g. "gzip" or "br") to a
+          `{"sha": ..., "size": ...}` pre-compressed variant of the file
+        * `preload`: for HTML pages, a list of `{"href": ..., "as": ...}`
+          critical subresources, where `href` is an absolute path
+
+    Unknown or malformed fields are dropped.
+    """
+    meta = {}
+    size = file_data.get('size')
+    if isinstance(size, int) and size >= 0:
+        meta['size'] = size
+    content_type = file_data.get('content_type')
+    if content_type and isinstance(content_type, (str, type(u''))):
+        meta['content_type'] = content_type
+    encodings = {}
+    for encoding, variant in (file_data.get('encodings') or {}).items():
+        if encoding not in ENCODINGS or not isinstance(variant, dict):
+            continue
+        if not variant.get('sha'):
+            continue
+        encodings[encoding] = {'sha': variant['sha']}
+        if isinstance(variant.get('size'), int):
+            encodings[encoding]['size'] = variant['size']
+    if encodings:
+        meta['encodings'] = encodings
+    preload = []
+    for asset in (file_data.get('preload') or [])[:MAX_PRELOAD]:
+        if not isinstance(asset, dict) or asset.get('as') not in PRELOAD_TYPES:
+            continue
+        href = asset.get('href')
+        # Only same-origin paths, which can't break out of the Link header.
+        if (not isinstance(href, (str, type(u''))) or not href.startswith('/')
+                or href.startswith('//') or any(c in href for c in '<>,; ')):
+            continue
+        preload.append({'href': href, 'as': asset['as']})
+    if preload:
+        meta['preload'] = preload
+    return meta
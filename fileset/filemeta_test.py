@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+
+import unittest
+from fileset import filemeta
+
+
+class CleanTest(unittest.TestCase):
+
+    def test_fields(self):
+        file_data = {
+            'path': '/index.html',
+            'sha': 'a' * 40,
+            'size': 10,
+            'content_type': 'text/html',
+            'encodings': {'gzip': {'sha': 'b' * 40, 'size': 5}},
+            'unknown': True,
+        }
+        self.assertEqual({
+            'size': 10,
+            'content_type': 'text/html',
+            'encodings': {'gzip': {'sha': 'b' * 40, 'size': 5}},
+        }, filemeta.clean(file_data))
+
+    def test_malformed(self):
+        self.assertEqual({}, filemeta.clean({
+            'size': -1,
+            'content_type': 5,
+            'encodings': {'deflate': {'sha': 'b' * 40}, 'br': {}},
+            'preload': [{'href': '/a.css', 'as': 'document'}],
+        }))
+
+    def test_preload(self):
+        preload = [
+            {'href': '/a.css', 'as': 'style'},
+            {'href': 'relative.js', 'as': 'script'},
+            {'href': '//example.com/b.js', 'as': 'script'},
+            {'href': '/c d.js', 'as': 'script'},
+            {'href': '/e.js>; rel=x', 'as': 'script'},
+            {'href': '/f.woff2', 'as': 'font'},
+        ]
+        preload.extend({'href': '/{}.png'.format(i), 'as': 'image'}
+                       for i in range(10))
+        self.assertEqual(
+            [{'href': '/a.css', 'as': 'style'},
+             {'href': '/f.woff2', 'as': 'font'},
+             {'href': '/0.png', 'as': 'image'},
+             {'href': '/1.png', 'as': 'image'}],
+            filemeta.clean({'preload': preload})['preload'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -41,14 +41,15 @@ import threading
 import time
 import grow
 import pytz
-from concurrent import futures
 from grow import extensions
 from grow.common import utils
 from grow.deployments import deployments
 from grow.deployments.destinations import base as destinations
 from grow.extensions import hooks
 from grow.pods import env
+from fileset.client import deploy
 from fileset.client import fileset
+from fileset.client import journal
 from protorpc import messages
 
 __all__ = ('FilesetDestination', 'FilesetExtension', 'FilesetPreprocessor')
@@ -84,6 +85,7 @@ class FilesetDestination(destinations.BaseDestination):
         super(FilesetDestination, self).__init__(*args, **kwargs)
         self._objectcache = None
         self.objectcache_lock = threading.RLock()
+        self._journal = None
 
     @property
     def objectcache(self):
@@ -95,6 +97,25 @@ class FilesetDestination(destinations.BaseDestination):
                 objectache_id, write_to_file=True, separate_file=True)
         return self._objectcache
 
+    def clear_objectcache(self):
+        """Removes the blob and manifest entries of older versions.
+
+        Blobs used to be recorded in the pod's objectcache, which the journal
+        replaced.
+        """
+        with self.objectcache_lock:
+            if not self.objectcache.export():
+                return
+            self.objectcache.reset()
+        self.pod.podcache.write()
+
+    @property
+    def journal(self):
+        if self._journal is None:
+            path = journal.get_path(self.pod.root, self.config.server)
+            self._journal = journal.Journal(path)
+        return self._journal
+
     def get_branch(self):
         if self.config.branch and not self.config.branch == 'auto':
             return self.config.branch
@@ -224,44 +245,21 @@ class FilesetDestination(destinations.BaseDestination):
         if branch != 'master':
             api_host = '{}-dot-{}'.format(branch, server)
         fs = fileset.FilesetClient(api_host, token)
-        manifest = {
-            'commit': self.get_commit(),
-            'files': [],
-        }
-
-        # Warm the cache by fetching the current manifest.
-        if not server.startswith('localhost'):
-            self._warm_up_cache(fs, branch)
-
-        with futures.ThreadPoolExecutor(max_workers=20) as executor:
-            # Map of future => doc path.
-            results = {}
-            for rendered_doc in content_generator:
-                future = executor.submit(self._upload_blob, fs, rendered_doc)
-                results[future] = rendered_doc.path
-
-            for future in futures.as_completed(results):
-                try:
-                    data = future.result()
-                except Exception as e:
-                    # If any upload fails, write the objectcache to file so we
-                    # don't lose information about what was already uploaded.
-                    self.pod.podcache.write()
-                    doc_path = results.get(future)
-                    logging.error('failed to upload: {}'.format(doc_path))
-                    raise
-                manifest['files'].append(data)
+        deployer = deploy.Deployer(fs, self.journal)
 
-        self.pod.podcache.write()
-        response = fs.upload_manifest(manifest)
-        manifest_id = response.json()['manifest_id']
+        # Without a journal (e.g. on a new machine, or once its entries
+        # expired), start from the blobs of the branch's current manifest.
+        if not server.startswith('localhost') and self.journal.is_stale():
+            deployer.warm_up(branch)
 
         deploy_timestamp = None
         if timed_deploy:
             deploy_timestamp = timed_deploy['timestamp']
 
-        fs.set_branch_manifest(
-            branch, manifest_id, deploy_timestamp=deploy_timestamp)
+        manifest_id = deployer.deploy(
+            content_generator, self.get_commit(), branch,
+            deploy_timestamp=deploy_timestamp)
+        self.clear_objectcache()
         lines = [
             '',
             'saved branch manifest:',
@@ -288,26 +286,6 @@ class FilesetDestination(destinations.BaseDestination):
 
         logging.info('\n'.join(lines))
 
-    def _upload_blob(self, fs, rendered_doc, num_tries=0):
-        sha = rendered_doc.hash
-        path = rendered_doc.path
-        blobkey = '{server}::blob::{sha}'.format(
-            server=self.config.server, sha=sha)
-        if not self.objectcache.get(blobkey) and not fs.blob_exists(sha):
-            logging.info('uploading blob {} {}'.format(sha, path))
-            try:
-                fs.upload_blob(sha, path, rendered_doc.read())
-            except Exception as e:
-                logging.error('failed to upload {}'.format(path))
-                if num_tries <= 2:
-                    logging.error('retrying upload blob...')
-                    return self._upload_blob(
-                        fs, rendered_doc, num_tries=num_tries + 1)
-                raise
-            with self.objectcache_lock:
-                self.objectcache.add(blobkey, 1)
-        return {'sha': sha, 'path': path}
-
     def _get_timestamp(self, datetime_str, timezone):
         dt = datetime.datetime.strptime(datetime_str, '%Y-%m-%d %H:%M')
         localized_dt = pytz.timezone(timezone).localize(dt)
@@ -315,21 +293,6 @@ class FilesetDestination(destinations.BaseDestination):
         ts = int(diff.total_seconds())
         return ts
 
-    def _warm_up_cache(self, fs, branch):
-        try:
-            response = fs.get_branch_manifest(branch)
-            manifest = response.get('manifest')
-            if not manifest:
-                return
-            paths = manifest.get('paths') or {}
-            for path, blobkey in paths.items():
-                    self.objectcache.add(blobkey, 1)
-            logging.info('warmed up fileset cache')
-        except Exception as e:
-            logging.error('failed to warm fileset cache')
-            logging.error(e)
-            pass
-
 
 class FilesetPreprocessor(grow.Preprocessor):
     """Preprocessor for grow that sets up the fileset deploy destination.
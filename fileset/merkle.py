@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+
+"""Merkle trees over manifest paths, shared by the client and the server.
+
+Every directory of a manifest gets a digest computed from the sorted names
+and hashes of its children, where a file's hash is its blob SHA (combined
+with its metadata, if it has any) and a subdirectory's hash is its digest.
+Two manifests with the same root digest have exactly the same paths, SHAs and
+metadata, and comparing the children of differing directories level by level
+finds the changed files without exchanging the full manifest.
+
+Directories are identified by their path with a trailing slash (the root is
+"/"), and subdirectory names in a directory's children also end with "/".
+"""
+
+import collections
+import hashlib
+import json
+
+ROOT = '/'
+
+# Maximum number of directories per `manifest.tree` request.
+MAX_TREE_DIRS = 1000
+
+
+class Tree(object):
+
+    def __init__(self, paths, meta=None):
+        meta = meta or {}
+        # Map of directory => {child name => file hash or subdirectory digest}.
+        self.children = collections.defaultdict(dict)
+        self.children[ROOT] = {}
+        for path, sha in paths.items():
+            dirname, name = path.rsplit('/', 1)
+            dirname += '/'
+            self.children[dirname][name] = get_file_hash(sha, meta.get(path))
+            # Register the directory with its ancestors.
+            while dirname != ROOT:
+                parent, subdir = dirname[:-1].rsplit('/', 1)
+                parent += '/'
+                if subdir + '/' in self.children[parent]:
+                    break
+                self.children[parent][subdir + '/'] = None
+                dirname = parent
+
+        # Map of directory => digest, computed from the deepest directories up.
+        self.digests = {}
+        for dirname in sorted(self.children, key=lambda d: -d.count('/')):
+            entries = self.children[dirname]
+            for name in entries:
+                if name.endswith('/'):
+                    entries[name] = self.digests[dirname + name]
+            self.digests[dirname] = get_digest(entries)
+        self.children = dict(self.children)
+
+    @property
+    def root(self):
+        return self.digests[ROOT]
+
+    def get_children(self, dirname):
+        """Returns the children of a directory, or None if it doesn't exist."""
+        return self.children.get(dirname)
+
+    def iter_files(self, dirname):
+        """Yields the paths of all files under a directory."""
+        for name in self.children.get(dirname, ()):
+            if name.endswith('/'):
+                for path in self.iter_files(dirname + name):
+                    yield path
+            else:
+                yield dirname + name
+
+
+def get_file_hash(sha, meta=None):
+    """Returns the hash of a file from its SHA and metadata.
+
+    Files without metadata are hashed as their SHA, so that manifests uploaded
+    without metadata never match manifests with metadata.
+    """
+    if not meta:
+        return sha
+    data = json.dumps(meta, sort_keys=True, separators=(',', ':'))
+    line = u'{}\0{}'.format(sha, data)
+    return hashlib.sha1(line.encode('utf-8')).hexdigest()
+
+
+def get_digest(entries):
+    """Returns the digest of a directory from a map of its children."""
+    digest = hashlib.sha1()
+    for name in sorted(entries):
+        line = u'{}\0{}\n'.format(name, entries[name])
+        digest.update(line.encode('utf-8'))
+    return digest.hexdigest()
+
+
+def diff(tree, get_nodes, nodes=None):
+    """Compares a local tree to a remote tree, one level at a time.
+
+    `get_nodes(dirnames)` returns a map of directory => children for the
+    remote tree. `nodes` are remote nodes that were already fetched (e.g. the
+    root). Returns a tuple of `(changed_paths, deleted_paths)`, where a
+    deleted path ending with "/" stands for a whole directory.
+    """
+    changed = []
+    deleted = []
+    nodes = dict(nodes or {})
+    pending = [ROOT]
+    while pending:
+        missing = [dirname for dirname in pending if dirname not in nodes]
+        if missing:
+            nodes.update(get_nodes(missing))
+            # A node left out of the response would look like an empty
+            # directory, hiding deleted files.
+            missing = [dirname for dirname in missing if dirname not in nodes]
+            if missing:
+                raise ValueError('missing remote nodes: {}'.format(
+                    ', '.join(missing)))
+        next_pending = []
+        for dirname in pending:
+            local = tree.get_children(dirname) or {}
+            remote = nodes.pop(dirname, None) or {}
+            for name, value in local.items():
+                if remote.get(name) == value:
+                    continue
+                if not name.endswith('/'):
+                    changed.append(dirname + name)
+                elif name in remote:
+                    next_pending.append(dirname + name)
+                else:
+                    changed.extend(tree.iter_files(dirname + name))
+            for name in remote:
+                if name not in local:
+                    deleted.append(dirname + name)
+        pending = next_pending
+    return changed, deleted
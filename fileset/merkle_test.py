@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+
+import unittest
+from fileset import merkle
+
+PATHS = {
+    '/index.html': 'a' * 40,
+    '/x/a.css': 'b' * 40,
+    '/x/y/b.js': 'c' * 40,
+    '/x/z/c.png': 'd' * 40,
+    '/x/z/d.png': 'e' * 40,
+}
+
+
+def _diff(local_paths, remote_paths, local_meta=None, remote_meta=None):
+    local = merkle.Tree(local_paths, meta=local_meta)
+    remote = merkle.Tree(remote_paths, meta=remote_meta)
+    requests = []
+
+    def get_nodes(dirs):
+        requests.append(sorted(dirs))
+        return dict((dirname, remote.get_children(dirname))
+                    for dirname in dirs)
+
+    changed, deleted = merkle.diff(local, get_nodes)
+    return sorted(changed), sorted(deleted), requests
+
+
+class MerkleTest(unittest.TestCase):
+
+    def test_unchanged(self):
+        self.assertEqual(
+            merkle.Tree(PATHS).root, merkle.Tree(dict(PATHS)).root)
+        changed, deleted, _ = _diff(PATHS, PATHS)
+        self.assertEqual([], changed)
+        self.assertEqual([], deleted)
+
+    def test_changed_file(self):
+        paths = dict(PATHS)
+        paths['/x/y/b.js'] = 'f' * 40
+        self.assertNotEqual(merkle.Tree(PATHS).root, merkle.Tree(paths).root)
+        changed, deleted, requests = _diff(paths, PATHS)
+        self.assertEqual(['/x/y/b.js'], changed)
+        self.assertEqual([], deleted)
+        # Unchanged directories aren't fetched.
+        self.assertEqual([['/'], ['/x/'], ['/x/y/']], requests)
+
+    def test_added_files(self):
+        paths = dict(PATHS)
+        paths['/new.html'] = 'f' * 40
+        paths['/x/new/e.js'] = 'f' * 40
+        paths['/x/new/deep/f.js'] = 'f' * 40
+        changed, deleted, _ = _diff(paths, PATHS)
+        self.assertEqual(
+            ['/new.html', '/x/new/deep/f.js', '/x/new/e.js'], changed)
+        self.assertEqual([], deleted)
+
+    def test_deleted_file(self):
+        paths = dict(PATHS)
+        del paths['/x/z/c.png']
+        changed, deleted, _ = _diff(paths, PATHS)
+        self.assertEqual([], changed)
+        self.assertEqual(['/x/z/c.png'], deleted)
+
+    def test_deleted_directory(self):
+        paths = dict(PATHS)
+        del paths['/x/z/c.png']
+        del paths['/x/z/d.png']
+        paths['/x/a.css'] = 'f' * 40
+        changed, deleted, _ = _diff(paths, PATHS)
+        self.assertEqual(['/x/a.css'], changed)
+        self.assertEqual(['/x/z/'], deleted)
+
+    def test_meta(self):
+        meta = {'/x/a.css': {'size': 10, 'content_type': 'text/css'}}
+        # Key order doesn't matter.
+        same_meta = {'/x/a.css': {'content_type': 'text/css', 'size': 10}}
+        self.assertEqual(merkle.Tree(PATHS, meta=meta).root,
+                         merkle.Tree(PATHS, meta=same_meta).root)
+        self.assertNotEqual(merkle.Tree(PATHS, meta=meta).root,
+                            merkle.Tree(PATHS).root)
+        # Files without metadata hash as their SHA.
+        self.assertEqual(merkle.Tree(PATHS, meta={'/x/a.css': {}}).root,
+                         merkle.Tree(PATHS).root)
+
+        changed, deleted, _ = _diff(PATHS, PATHS, local_meta=meta)
+        self.assertEqual(['/x/a.css'], changed)
+        self.assertEqual([], deleted)
+
+    def test_missing_nodes(self):
+        paths = dict(PATHS)
+        del paths['/x/z/c.png']
+        local = merkle.Tree(paths)
+        remote = merkle.Tree(PATHS)
+
+        def get_nodes(dirs):
+            # Drops the last requested directory.
+            return dict((dirname, remote.get_children(dirname))
+                        for dirname in sorted(dirs)[:-1])
+
+        nodes = {merkle.ROOT: remote.get_children(merkle.ROOT)}
+        with self.assertRaises(ValueError):
+            merkle.diff(local, get_nodes, nodes=nodes)
+
+
+if __name__ == '__main__':
+    unittest.main()
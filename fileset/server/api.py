@@ -6,15 +6,24 @@ import logging
 import mimetypes
 import os
 import webapp2
+from fileset import config
+from fileset import filemeta
+from fileset import merkle
 from fileset.server import auth
 from fileset.server import blobs
+from fileset.server import domains
+from fileset.server import garbage
 from fileset.server import manifests
+from fileset.server import stats
 from google.appengine.api import users
 from google.appengine.ext import ndb
 
 
 class RpcHandler(webapp2.RequestHandler):
 
+    # Scope that signed tokens need to call this method (see auth.py).
+    SCOPE = auth.SCOPE_DEPLOY
+
     def post(self):
         if not self._is_authorized():
             return self.json({'success': False, 'error': 'unauthorized'}, status=403)
@@ -41,8 +50,11 @@ class RpcHandler(webapp2.RequestHandler):
             return True
         if self.request.headers.get('X-Appengine-Cron', '').lower() == 'true':
             return True
+        # App Engine strips this header from external requests.
+        if self.request.headers.get('X-AppEngine-QueueName'):
+            return True
         token = self.request.headers.get('X-Fileset-Token')
-        return token and auth.is_token_valid(token)
+        return token and auth.is_token_valid(token, scope=self.SCOPE)
 
     def _handle(self):
         raise NotImplementedError('subclasses should implement')
@@ -60,14 +72,9 @@ class ManifestUploadHandler(RpcHandler):
         content = self.request.body
         data = json.loads(content)
 
-        paths = {}
-        for file_data in data['files']:
-            sha = file_data['sha']
-            path = file_data['path']
-            paths[path] = sha
-
+        paths, meta = _parse_files(data['files'])
         commit = data['commit']
-        manifest_id = manifests.save(commit, paths)
+        manifest_id = manifests.save(commit, paths, meta=meta)
 
         return self.json({
             'success': True,
@@ -75,6 +82,132 @@ class ManifestUploadHandler(RpcHandler):
         })
 
 
+class ManifestBeginHandler(RpcHandler):
+    """Starts a paged manifest upload, for sites with many files.
+
+    Pages of files are then sent to `manifest.append` (in any order, and in
+    parallel), and `manifest.commit` saves the manifest.
+    """
+
+    def _handle(self):
+        data = json.loads(self.request.body)
+        manifest_id = manifests.begin_session(data['commit'])
+        return self.json({
+            'success': True,
+            'session_id': manifest_id,
+        })
+
+
+class ManifestAppendHandler(RpcHandler):
+
+    def _handle(self):
+        data = json.loads(self.request.body)
+        paths, meta = _parse_files(data['files'])
+        try:
+            manifests.append_page(
+                data['session_id'], data['page'], paths, meta=meta)
+        except manifests.Error as e:
+            return self.json({
+                'error': str(e),
+                'success': False,
+            }, status=400)
+        return self.json({
+            'success': True,
+            'page': data['page'],
+        })
+
+
+class ManifestCommitHandler(RpcHandler):
+
+    def _handle(self):
+        data = json.loads(self.request.body)
+        try:
+            manifest_id = manifests.commit_session(
+                data['session_id'], data['num_pages'])
+        except manifests.Error as e:
+            return self.json({
+                'error': str(e),
+                'success': False,
+            }, status=400)
+        return self.json({
+            'success': True,
+            'manifest_id': manifest_id,
+        })
+
+
+class ManifestTreeHandler(RpcHandler):
+    """Returns Merkle tree nodes of a manifest (see fileset/merkle.py).
+
+    The manifest is given by `manifest_id`, or by `branch` for the branch's
+    current manifest. Returns the root digest and the children of each of the
+    requested `dirs` (at most `merkle.MAX_TREE_DIRS`).
+    """
+
+    SCOPE = auth.SCOPE_READ
+
+    def _handle(self):
+        data = json.loads(self.request.body)
+        dirs = data.get('dirs') or [merkle.ROOT]
+        if len(dirs) > merkle.MAX_TREE_DIRS:
+            return self.json({
+                'error': 'too many dirs: {} > {}'.format(
+                    len(dirs), merkle.MAX_TREE_DIRS),
+                'success': False,
+            }, status=400)
+        manifest_id = data.get('manifest_id')
+        if manifest_id is None:
+            manifest = manifests.get_branch_manifest(data['branch'])
+            manifest_id = manifest.id if manifest else None
+        tree = manifests.get_tree(manifest_id) if manifest_id else None
+        if not tree:
+            return self.json({
+                'success': True,
+                'manifest_id': None,
+            })
+        return self.json({
+            'success': True,
+            'manifest_id': manifest_id,
+            'root': tree.root,
+            'nodes': dict((dirname, tree.get_children(dirname))
+                          for dirname in dirs),
+        })
+
+
+class ManifestDeriveHandler(RpcHandler):
+    """Saves a manifest from an existing one and a list of changes."""
+
+    def _handle(self):
+        data = json.loads(self.request.body)
+        paths, meta = _parse_files(data.get('files') or [])
+        try:
+            manifest_id = manifests.derive(
+                data['base_manifest_id'], data['commit'], paths, meta=meta,
+                deleted=data.get('deleted') or [])
+        except manifests.Error as e:
+            return self.json({
+                'error': str(e),
+                'success': False,
+            }, status=400)
+        return self.json({
+            'success': True,
+            'manifest_id': manifest_id,
+        })
+
+
+def _parse_files(files):
+    """Returns the `(paths, meta)` of a list of files in a request."""
+    paths = {}
+    meta = {}
+    for file_data in files:
+        sha = file_data['sha']
+        path = file_data['path']
+        paths[path] = sha
+        file_meta = filemeta.clean(file_data)
+        if file_meta:
+            meta[path] = file_meta
+    return paths, meta
+
+
 class BlobUploadHandler(RpcHandler):
 
     def _handle(self):
@@ -102,9 +235,19 @@ class BlobUploadHandler(RpcHandler):
 
 class BlobExistsHandler(RpcHandler):
 
+    SCOPE = auth.SCOPE_READ
+
     def _handle(self):
-        request_sha = self.request.get('sha')
+        # The client sends a JSON body, older clients a query param.
+        data = json.loads(self.request.body or '{}')
+        request_sha = data.get('sha') or self.request.get('sha')
+        if not request_sha:
+            return self.json({
+                'error': 'missing required param: "sha"',
+                'success': False,
+            }, status=400)
         exists = blobs.exists(request_sha)
+        blobs.flush_confirmations()
         return self.json({
             'success': True,
             'sha': request_sha,
@@ -112,8 +255,36 @@ class BlobExistsHandler(RpcHandler):
         })
 
 
+class BlobPrefillExistsHandler(RpcHandler):
+    """Seeds the blob existence caches from a listing of the blobs bucket.
+
+    Each call processes up to `num_pages` listing pages and returns a `marker`
+    to pass to the next call, or None once the whole bucket has been listed.
+    """
+
+    def _handle(self):
+        data = json.loads(self.request.body or '{}')
+        marker = data.get('marker')
+        num_pages = data.get('num_pages', 10)
+
+        num_blobs = 0
+        for _ in range(num_pages):
+            count, marker = blobs.prefill_exists_cache(marker=marker)
+            num_blobs += count
+            if not marker:
+                break
+
+        return self.json({
+            'success': True,
+            'num_blobs': num_blobs,
+            'marker': marker,
+        })
+
+
 class BranchGetManifestHandler(RpcHandler):
 
+    SCOPE = auth.SCOPE_READ
+
     def _handle(self):
         content = self.request.body
         data = json.loads(content)
@@ -148,8 +319,54 @@ class BranchSetManifestHandler(RpcHandler):
         })
 
 
+class DomainListHandler(RpcHandler):
+
+    SCOPE = auth.SCOPE_READ
+
+    def _handle(self):
+        return self.json({
+            'success': True,
+            'domains': domains.get_routes(),
+        })
+
+
+class DomainSetHandler(RpcHandler):
+    """Serves a domain from a branch on Env.PROD."""
+
+    SCOPE = auth.SCOPE_ADMIN
+
+    def _handle(self):
+        data = json.loads(self.request.body)
+        try:
+            routes = domains.set_route(data['domain'], data['branch'])
+        except domains.Error as e:
+            return self.json({
+                'error': str(e),
+                'success': False,
+            }, status=400)
+        return self.json({
+            'success': True,
+            'domains': routes,
+        })
+
+
+class DomainDeleteHandler(RpcHandler):
+
+    SCOPE = auth.SCOPE_ADMIN
+
+    def _handle(self):
+        data = json.loads(self.request.body)
+        routes = domains.delete_route(data['domain'])
+        return self.json({
+            'success': True,
+            'domains': routes,
+        })
+
+
 class CronTimedDeployHandler(RpcHandler):
 
+    SCOPE = auth.SCOPE_ADMIN
+
     def _handle(self):
         deployments = manifests.handle_timed_deploys()
         if deployments:
@@ -160,8 +377,140 @@ class CronTimedDeployHandler(RpcHandler):
         })
 
 
+class CronGcHandler(RpcHandler):
+
+    SCOPE = auth.SCOPE_ADMIN
+
+    def _handle(self):
+        if not config.GC_ENABLED:
+            logging.info('gc is disabled, set fileset_GC_ENABLED = True')
+            return self.json({
+                'success': True,
+                'stats': None,
+            })
+
+        data = json.loads(self.request.body or '{}')
+        stats = garbage.run(
+            dry_run=data.get('dry_run'),
+            batch_size=data.get('batch_size'),
+            max_deletes=data.get('max_deletes'))
+        return self.json({
+            'success': True,
+            'stats': stats,
+        })
+
+
+class TaskTimedDeployHandler(RpcHandler):
+    """Applies a branch's timed deploy at its exact deploy timestamp."""
+
+    SCOPE = auth.SCOPE_ADMIN
+
+    def _handle(self):
+        data = json.loads(self.request.body)
+        branch = data['branch']
+        deployments = manifests.handle_timed_deploys(branch=branch)
+        if deployments:
+            logging.info('deployed: %s', json.dumps(deployments, indent=2))
+        else:
+            delay = manifests.get_timed_deploy_delay(branch)
+            if delay is not None and delay > 0:
+                # The task ran early (e.g. clock skew), fail it so that the
+                # task queue retries it instead of leaving it to the cron.
+                return self.json({
+                    'error': 'timed deploy is due in {}s'.format(delay),
+                    'success': False,
+                }, status=503)
+        return self.json({
+            'success': True,
+            'deployments': deployments,
+        })
+
+
+class TaskConfirmBlobsHandler(RpcHandler):
+    """Writes a batch of blob confirmations buffered by `blob.exists`."""
+
+    SCOPE = auth.SCOPE_ADMIN
+
+    def _handle(self):
+        confirmations = json.loads(self.request.body)
+        blobs.save_confirmations(confirmations)
+        return self.json({
+            'success': True,
+            'count': len(confirmations),
+        })
+
+
+class TaskPrewarmManifestHandler(RpcHandler):
+    """Loads a manifest into caches shortly before a timed deploy."""
+
+    SCOPE = auth.SCOPE_ADMIN
+
+    def _handle(self):
+        data = json.loads(self.request.body)
+        manifest_id = data['manifest_id']
+        found = manifests.prewarm_manifest(manifest_id)
+        return self.json({
+            'success': True,
+            'manifest_id': manifest_id,
+            'found': found,
+        })
+
+
+class StatsHandler(RpcHandler):
+    """Returns runtime counters aggregated across instances.
+
+    `global` sums the counters of all instances since memcache last evicted
+    them, `instance` is the instance serving this request and `instances`
+    are the latest snapshots of recently active instances.
+    """
+
+    SCOPE = auth.SCOPE_READ
+
+    def _handle(self):
+        stats.flush(force=True)
+        counters = stats.get_global_counters()
+        return self.json({
+            'success': True,
+            'global': {
+                'counters': counters,
+                'ratios': stats.get_ratios(counters),
+            },
+            'instance': stats.snapshot(),
+            'instances': stats.get_instance_snapshots(),
+        })
+
+
+class TokenRevokeHandler(RpcHandler):
+    """Revokes a token. Signed tokens are rejected by all instances within
+    auth.REFRESH_SECONDS."""
+
+    SCOPE = auth.SCOPE_ADMIN
+
+    def _handle(self):
+        data = json.loads(self.request.body or '{}')
+        if not data.get('token'):
+            return self.json({
+                'error': 'missing required param: "token"',
+                'success': False,
+            }, status=400)
+        try:
+            auth.delete_token(data['token'])
+        except auth.Error as e:
+            return self.json({
+                'error': str(e),
+                'success': False,
+            }, status=400)
+        return self.json({
+            'success': True,
+        })
+
+
 class TokenHandler(webapp2.RequestHandler):
-    """Handler that generates an auth token for a user."""
+    """Handler that generates a signed auth token for a user.
+
+    The token's scope defaults to "deploy" and can be changed with the `scope`
+    query param ("read", "deploy" or "admin").
+    """
 
     def get(self):
         self.response.headers['Content-Type'] = 'text/plain'
@@ -171,9 +520,15 @@ class TokenHandler(webapp2.RequestHandler):
             self.response.out.write('unauthorized')
             return
 
+        scope = self.request.get('scope') or auth.SCOPE_DEPLOY
+        try:
+            token = auth.create_signed_token(scope=scope)
+        except auth.Error as e:
+            self.response.set_status(400)
+            self.response.out.write(str(e))
+            return
         user = users.get_current_user()
-        desc = user.email()
-        token = auth.create_auth_token(desc)
+        logging.info('created {} token for {}'.format(scope, user.email()))
 
         lines = [
             'save the following to .fileset.json:',
@@ -187,10 +542,25 @@ class TokenHandler(webapp2.RequestHandler):
 
 app = ndb.toplevel(webapp2.WSGIApplication([
     webapp2.Route('/_fs/api/blob.exists', handler=BlobExistsHandler),
+    webapp2.Route('/_fs/api/blob.prefill_exists', handler=BlobPrefillExistsHandler),
     webapp2.Route('/_fs/api/blob.upload', handler=BlobUploadHandler),
     webapp2.Route('/_fs/api/branch.get_manifest', handler=BranchGetManifestHandler),
     webapp2.Route('/_fs/api/branch.set_manifest', handler=BranchSetManifestHandler),
+    webapp2.Route('/_fs/api/cron.gc', handler=CronGcHandler),
     webapp2.Route('/_fs/api/cron.timed_deploy', handler=CronTimedDeployHandler),
+    webapp2.Route('/_fs/api/domain.delete', handler=DomainDeleteHandler),
+    webapp2.Route('/_fs/api/domain.list', handler=DomainListHandler),
+    webapp2.Route('/_fs/api/domain.set', handler=DomainSetHandler),
+    webapp2.Route('/_fs/api/manifest.append', handler=ManifestAppendHandler),
+    webapp2.Route('/_fs/api/manifest.begin', handler=ManifestBeginHandler),
+    webapp2.Route('/_fs/api/manifest.commit', handler=ManifestCommitHandler),
+    webapp2.Route('/_fs/api/manifest.derive', handler=ManifestDeriveHandler),
+    webapp2.Route('/_fs/api/manifest.tree', handler=ManifestTreeHandler),
     webapp2.Route('/_fs/api/manifest.upload', handler=ManifestUploadHandler),
+    webapp2.Route('/_fs/api/stats', handler=StatsHandler),
+    webapp2.Route('/_fs/api/task.confirm_blobs', handler=TaskConfirmBlobsHandler),
+    webapp2.Route('/_fs/api/task.prewarm_manifest', handler=TaskPrewarmManifestHandler),
+    webapp2.Route('/_fs/api/task.timed_deploy', handler=TaskTimedDeployHandler),
+    webapp2.Route('/_fs/api/token.revoke', handler=TokenRevokeHandler),
     webapp2.Route('/_fs/token', handler=TokenHandler),
 ]))
@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+
+import datetime
+import json
+import threading
+import time
+import unittest
+from fileset.server import testing
+
+testing.setup_sdk()
+
+from fileset.server import api
+from fileset.server import garbage
+from fileset.server import manifests
+import webapp2
+
+COMMIT = {'sha': 'commit', 'message': ''}
+
+
+class ApiTestCase(testing.TestCase):
+
+    def post(self, method, data=None, headers=None):
+        """Returns `(status, data)` for an API request."""
+        request = webapp2.Request.blank(
+            '/_fs/api/{}'.format(method), POST=json.dumps(data or {}),
+            headers=headers)
+        request.content_type = 'application/json'
+        response = request.get_response(api.app)
+        return response.status_int, json.loads(response.body)
+
+
+def _files(start, end):
+    return [{'path': '/{}.html'.format(i), 'sha': '{:040x}'.format(i),
+             'size': i}
+            for i in range(start, end)]
+
+
+class ManifestSessionTest(ApiTestCase):
+
+    def setUp(self):
+        super(ManifestSessionTest, self).setUp()
+        self.patch(manifests, '_manifest_cache', manifests.lru.LruCache(10))
+
+    def _begin(self):
+        status, data = self.post('manifest.begin', {'commit': COMMIT})
+        self.assertEqual(200, status)
+        return data['session_id']
+
+    def _append(self, session_id, page, files):
+        return self.post('manifest.append', {
+            'session_id': session_id,
+            'page': page,
+            'files': files,
+        })
+
+    def _commit(self, session_id, num_pages):
+        return self.post('manifest.commit', {
+            'session_id': session_id,
+            'num_pages': num_pages,
+        })
+
+    def test_pages_out_of_order(self):
+        session_id = self._begin()
+        # Pages uploaded in parallel arrive in any order.
+        for page in (2, 0, 1):
+            status, data = self._append(
+                session_id, page, _files(page * 10, page * 10 + 10))
+            self.assertEqual(200, status)
+            self.assertEqual(page, data['page'])
+        status, data = self._commit(session_id, 3)
+        self.assertEqual(200, status)
+        self.assertEqual(session_id, data['manifest_id'])
+
+        manifest = manifests.get(session_id)
+        self.assertEqual(COMMIT, manifest.commit)
+        self.assertEqual(30, len(manifest.paths))
+        self.assertEqual('{:040x}'.format(25), manifest.paths['/25.html'])
+        self.assertEqual({'size': 25}, manifest.get_meta('/25.html'))
+        # The session is gone once committed.
+        self.assertIsNone(manifests.FilesetManifestSession.get_by_id(session_id))
+        status, _ = self._commit(session_id, 3)
+        self.assertEqual(400, status)
+
+    def test_parallel_pages(self):
+        session_id = self._begin()
+        errors = []
+
+        def append(page):
+            try:
+                status, _ = self._append(
+                    session_id, page, _files(page * 10, page * 10 + 10))
+                self.assertEqual(200, status)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=append, args=(page,))
+                   for page in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([], errors)
+        status, _ = self._commit(session_id, 8)
+        self.assertEqual(200, status)
+        self.assertEqual(80, len(manifests.get(session_id).paths))
+
+    def test_duplicate_page(self):
+        session_id = self._begin()
+        self._append(session_id, 0, _files(0, 10))
+        self._append(session_id, 1, _files(10, 20))
+        # A retried page replaces the earlier upload.
+        self._append(session_id, 1, _files(10, 15))
+        status, _ = self._commit(session_id, 2)
+        self.assertEqual(200, status)
+        manifest = manifests.get(session_id)
+        self.assertEqual(15, len(manifest.paths))
+        self.assertNotIn('/19.html', manifest.paths)
+
+    def test_missing_page(self):
+        session_id = self._begin()
+        self._append(session_id, 0, _files(0, 10))
+        self._append(session_id, 2, _files(20, 30))
+        status, data = self._commit(session_id, 3)
+        self.assertEqual(400, status)
+        self.assertIn('missing page', data['error'])
+        self.assertIsNone(manifests.FilesetManifest.get_by_id(session_id))
+
+        # The session can still be completed.
+        self._append(session_id, 1, _files(10, 20))
+        status, _ = self._commit(session_id, 3)
+        self.assertEqual(200, status)
+        self.assertEqual(30, len(manifests.get(session_id).paths))
+
+    def test_invalid_append(self):
+        status, data = self._append(12345, 0, _files(0, 1))
+        self.assertEqual(400, status)
+        self.assertIn('unknown session', data['error'])
+        session_id = self._begin()
+        status, data = self._append(session_id, -1, _files(0, 1))
+        self.assertEqual(400, status)
+        status, data = self._commit(12345, 1)
+        self.assertEqual(400, status)
+
+    def test_expired_session(self):
+        session_id = self._begin()
+        self._append(session_id, 0, _files(0, 10))
+        committed_id = self._begin()
+        self._append(committed_id, 0, _files(0, 10))
+        self._commit(committed_id, 1)
+        for session in manifests.FilesetManifestSession.query():
+            session.created -= datetime.timedelta(
+                days=garbage.config.GC_RETENTION_DAYS + 1)
+            session.put()
+
+        state = garbage.get_state()
+        state.phase = garbage.PHASE_MANIFESTS
+        state.put()
+        stats = garbage.run(dry_run=False)
+        self.assertEqual(1, stats['deleted_sessions'])
+        # Abandoned sessions can't be completed, and their pages are deleted.
+        self.assertIsNone(manifests.FilesetManifestSession.get_by_id(session_id))
+        self.assertEqual([committed_id], [
+            page.manifest_id for page in manifests.FilesetManifestPage.query()])
+        status, _ = self._append(session_id, 1, _files(10, 20))
+        self.assertEqual(400, status)
+        status, _ = self._commit(session_id, 1)
+        self.assertEqual(400, status)
+
+
+class TaskTimedDeployTest(ApiTestCase):
+
+    def setUp(self):
+        super(TaskTimedDeployTest, self).setUp()
+        self.manifest_id = manifests.save(COMMIT, {'/index.html': 'a' * 40})
+
+    def test_early_task_fails(self):
+        manifests.set_branch_manifest(
+            'master', self.manifest_id,
+            deploy_timestamp=int(time.time()) + 60)
+        status, data = self.post('task.timed_deploy', {'branch': 'master'})
+        # A non-2xx response makes the task queue retry the task.
+        self.assertEqual(503, status)
+        self.assertFalse(data['success'])
+
+        timed_deploy = manifests.FilesetTimedDeploy.get_by_id('master')
+        timed_deploy.deploy_timestamp = int(time.time())
+        timed_deploy.put()
+        status, data = self.post('task.timed_deploy', {'branch': 'master'})
+        self.assertEqual(200, status)
+        self.assertEqual(
+            [{'branch': 'master', 'manifest_id': self.manifest_id}],
+            data['deployments'])
+
+        # Retries after the deploy was applied succeed without deploying.
+        status, data = self.post('task.timed_deploy', {'branch': 'master'})
+        self.assertEqual(200, status)
+        self.assertEqual([], data['deployments'])
+
+    def test_no_timed_deploy(self):
+        status, data = self.post('task.timed_deploy', {'branch': 'master'})
+        self.assertEqual(200, status)
+        self.assertEqual([], data['deployments'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,426 @@
+#!/usr/bin/env python
+
+"""Asyncio (ASGI) serving engine for fileset.
+
+An alternative to the webapp2 app in `main.py` for serving from App Engine's
+Python 3 runtime with any ASGI server, for example:
+
+    uvicorn fileset.server.asgi:app --workers 4
+
+The engine isn't independent of App Engine: config, manifests, domains and
+stats still use App Engine APIs (lib_config, datastore, memcache, app
+identity), so it needs the bundled services SDK (`appengine-python-standard`,
+with `app_engine_apis: true` in app.yaml) and runs on App Engine or the local
+development server only.
+
+Path resolution reuses the manifest, intl fallback and redirect logic from
+`manifests.py`, `intl.py` and `redirects.py`. Blocking datastore, memcache
+and storage RPCs run in a thread pool, never on the event loop: manifests and
+the domain routing table are cached with per-key coalescing so concurrent
+requests share a single load, and blob bodies are streamed in chunks so one
+process can hold many concurrent downloads.
+
+Google account authentication is not available, so branches that require
+login (`fileset_REQUIRE_AUTH` or `*.appspot.com` hosts) are answered with 403.
+"""
+
+import asyncio
+import logging
+import mimetypes
+import os
+import time
+import urllib.parse
+from concurrent import futures
+from fileset import config
+from fileset import filemeta
+from fileset.server import domains
+from fileset.server import intl
+from fileset.server import manifests
+from fileset.server import redirects
+from fileset.server import storage
+from fileset.server import utils
+
+# Size of the chunks read from storage when streaming blob bodies.
+CHUNK_SIZE = storage.CHUNK_SIZE
+
+# Seconds a branch's manifest is cached before it is looked up again. Manifests
+# addressed by id are immutable and cached without expiration.
+BRANCH_MANIFEST_TTL = 5
+
+# Maximum number of manifests addressed by id to keep in memory.
+MAX_MANIFESTS = 32
+
+
+class AsyncCache(object):
+    """In-memory cache that coalesces concurrent loads of the same key."""
+
+    def __init__(self, ttl=None, max_size=None):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._values = {}
+        self._pending = {}
+
+    async def get(self, key, loader):
+        """Returns the cached value for `key`, calling `await loader()` on miss."""
+        entry = self._values.get(key)
+        if entry and (entry[1] is None or entry[1] > time.time()):
+            return entry[0]
+
+        pending = self._pending.get(key)
+        if pending is None:
+            pending = asyncio.ensure_future(loader())
+            self._pending[key] = pending
+            try:
+                value = await pending
+            finally:
+                del self._pending[key]
+            self._set(key, value)
+            return value
+        # Another request is already loading the key, share its result.
+        return await asyncio.shield(pending)
+
+    def _set(self, key, value):
+        if value is None:
+            return
+        if self.max_size and len(self._values) >= self.max_size:
+            # Evict the entry that was inserted first.
+            self._values.pop(next(iter(self._values)))
+        expires = time.time() + self.ttl if self.ttl else None
+        self._values[key] = (value, expires)
+
+
+class _HostRequest(object):
+    """Minimal request object accepted by the helpers in `utils`."""
+
+    def __init__(self, host):
+        self.host = host
+
+
+class Request(object):
+    """Parsed view of an ASGI http scope."""
+
+    def __init__(self, scope):
+        self.scope = scope
+        self.method = scope['method']
+        self.path = scope['path']
+        self.query_string = scope.get('query_string', b'').decode('latin-1')
+        self.query = urllib.parse.parse_qs(self.query_string)
+        self.headers = {}
+        for key, value in scope.get('headers', []):
+            self.headers[key.decode('latin-1').lower()] = value.decode('latin-1')
+        self.scheme = scope.get('scheme', 'http')
+        self.host = self.headers.get('host', '')
+
+    def get(self, name, default=''):
+        values = self.query.get(name)
+        return values[0] if values else default
+
+    @property
+    def path_qs(self):
+        if self.query_string:
+            return '{}?{}'.format(self.path, self.query_string)
+        return self.path
+
+
+class Response(object):
+
+    def __init__(self, status=200, headers=None, body=b'', sha=None):
+        self.status = status
+        self.headers = headers or {}
+        self.body = body
+        # If set, the body is streamed from the blob with this SHA.
+        self.sha = sha
+
+
+class App(object):
+    """ASGI application that serves fileset manifests."""
+
+    def __init__(self, max_workers=64):
+        self.executor = futures.ThreadPoolExecutor(max_workers=max_workers)
+        self.redirects = redirects.RedirectMiddleware(None)
+        self.branch_manifests = AsyncCache(ttl=BRANCH_MANIFEST_TTL)
+        self.id_manifests = AsyncCache(max_size=MAX_MANIFESTS)
+        self.error_pages = AsyncCache(max_size=128)
+        self.routes = AsyncCache(ttl=domains.REFRESH_SECONDS)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.handle_lifespan(receive, send)
+        if scope['type'] != 'http':
+            return
+
+        request = Request(scope)
+        response = await self.handle_request(request)
+        await self.send_response(request, response, send)
+
+    async def handle_lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await self.warm()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def warm(self):
+        """Loads the default branch manifest and redirects before serving."""
+        try:
+            await self.get_routes()
+            await self.get_branch_manifest(utils.DEFAULT_BRANCH)
+            self.redirects.redirects
+        except Exception:
+            logging.exception('warmup failed')
+
+    async def run_sync(self, func, *args):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.executor, func, *args)
+
+    async def handle_request(self, request):
+        if request.method not in ('GET', 'HEAD'):
+            return self.text_response(405)
+
+        domain = utils.get_domain(_HostRequest(request.host))
+        env = utils.get_env(_HostRequest(request.host))
+        # Only Env.PROD requests are routed by domain.
+        routes = {}
+        if env == utils.Env.PROD:
+            routes = await self.get_routes()
+
+        # Redirect to CANONICAL_DOMAIN.
+        if redirects.CANONICAL_DOMAIN:
+            if (env == utils.Env.PROD
+                    and domain != redirects.CANONICAL_DOMAIN
+                    and not routes.get(domain.lower())):
+                return self.redirect('{}://{}{}'.format(
+                    request.scheme, redirects.CANONICAL_DOMAIN,
+                    request.path_qs))
+
+        # Check for https (except on devappserver).
+        upgrade_requests = request.headers.get('upgrade-insecure-requests')
+        if redirects.REQUIRE_HTTPS or upgrade_requests == '1':
+            if env != utils.Env.DEV and request.scheme != 'https':
+                return self.redirect(
+                    'https://{}{}'.format(domain, request.path_qs))
+
+        if redirects.REQUIRE_AUTH or env == utils.Env.STAGING:
+            return self.text_response(403)
+
+        code, redirect_uri = self.redirects.get_redirect(
+            request.path, request.query_string)
+        if redirect_uri:
+            return self.redirect(redirect_uri, code=code)
+
+        return await self.serve_path(request, request.path, routes)
+
+    async def serve_path(self, request, path, routes):
+        path = urllib.parse.unquote_plus(path)
+        _, ext = os.path.splitext(path)
+        if not ext:
+            path = utils.safe_join(path, 'index.html')
+
+        headers = {}
+        if path.endswith('.html'):
+            # Use case-insensitive paths.
+            path = path.lower()
+            headers.update(config.RESPONSE_HEADERS.get('html') or {})
+
+        manifest = await self.get_manifest(request, routes)
+        if not manifest:
+            return await self.serve_error(request, 404, routes=routes)
+
+        # Treat 404.html as a special file.
+        if path.endswith('/404.html'):
+            return await self.serve_error(request, 404, manifest=manifest)
+
+        sha = None
+        if path.endswith('.html') and config.INTL_REDIRECTS:
+            locale, base_path = intl.parse_intl_path(path)
+            if locale or base_path not in manifest.localized_paths:
+                # The response doesn't depend on the user's language, so it
+                # can be cached by a CDN.
+                sha = manifest.paths.get(path)
+                headers['Cache-Control'] = config.INTL_CACHE_CONTROL
+                if locale:
+                    headers['Content-Language'] = (
+                        intl.get_content_language(locale))
+            else:
+                sha, path = self.negotiate_path(request, manifest, path)
+                headers['Cache-Control'] = intl.PRIVATE_CACHE_CONTROL
+                utils.add_vary(headers, 'Accept-Language')
+                locale, _ = intl.parse_intl_path(path)
+                if sha and locale:
+                    headers['Location'] = intl.get_redirect_url(
+                        locale, urllib.parse.quote(request.path),
+                        request.query_string)
+                    return Response(302, headers=headers)
+        elif path.endswith('.html'):
+            sha, path = self.negotiate_path(request, manifest, path)
+        else:
+            sha = manifest.paths.get(path)
+
+        if not sha:
+            return await self.serve_error(request, 404, manifest=manifest)
+
+        meta = manifest.get_meta(path)
+        size = meta.get('size')
+        if config.PRELOAD_LINKS and meta.get('preload'):
+            headers['Link'] = ', '.join(
+                utils.get_preload_links(meta['preload']))
+        encodings = meta.get('encodings')
+        if encodings:
+            utils.add_vary(headers, 'Accept-Encoding')
+            encoding = utils.get_accepted_encoding(
+                request.headers.get('accept-encoding'),
+                [name for name in filemeta.ENCODINGS if name in encodings])
+            if encoding:
+                headers['Content-Encoding'] = encoding
+                sha = encodings[encoding]['sha']
+                size = encodings[encoding].get('size')
+
+        etag = '"{sha}"'.format(sha=sha)
+        if request.headers.get('if-none-match') == etag:
+            return Response(304, headers={'ETag': etag})
+        headers['ETag'] = etag
+        content_type = meta.get('content_type')
+        if not content_type:
+            content_type, _ = mimetypes.guess_type(path)
+        headers['Content-Type'] = content_type or 'application/octet-stream'
+        if size is not None:
+            headers['Content-Length'] = size
+        return Response(200, headers=headers, sha=sha)
+
+    def negotiate_path(self, request, manifest, path):
+        """Returns the SHA and path of the best localized variant of a path."""
+        intl_paths = intl.generate_intl_paths(
+            path,
+            hl=request.get('hl'),
+            accept_language=request.headers.get('accept-language'),
+            country=request.headers.get('x-appengine-country'))
+        for intl_path in intl_paths:
+            sha = manifest.paths.get(intl_path)
+            if sha:
+                return sha, intl_path
+        return None, path
+
+    async def serve_error(self, request, error_code, manifest=None,
+                          routes=None):
+        _, ext = os.path.splitext(request.path)
+        if not ext or ext == '.html':
+            html_path = '/{}.html'.format(error_code)
+            # Branches without a manifest use the default branch's error
+            # pages, except for routed domains, which are separate sites.
+            if not manifest and not utils.is_routed(
+                    _HostRequest(request.host), routes=routes or {}):
+                manifest = await self.get_branch_manifest(utils.DEFAULT_BRANCH)
+            if manifest and html_path in manifest.paths:
+                sha = manifest.paths[html_path]
+                content = await self.error_pages.get(
+                    sha, lambda: self.run_sync(
+                        storage.get_backend().read, sha))
+                return Response(
+                    error_code, headers={'Content-Type': 'text/html'},
+                    body=content)
+        return self.text_response(error_code)
+
+    async def get_manifest(self, request, routes):
+        """Returns the manifest for the given request."""
+        branch = utils.get_branch(_HostRequest(request.host), routes=routes)
+        if branch.startswith('manifest-') and branch[9:].isdigit():
+            manifest_id = int(branch[9:])
+            return await self.id_manifests.get(
+                manifest_id, lambda: self.run_sync(manifests.get, manifest_id))
+        return await self.get_branch_manifest(branch)
+
+    async def get_routes(self):
+        """Returns the domain routing table.
+
+        `domains.get_routes()` refreshes the table from memcache (or the
+        datastore) under a lock, so it's called in the thread pool.
+        """
+        return await self.routes.get(
+            'routes', lambda: self.run_sync(domains.get_routes))
+
+    async def get_branch_manifest(self, branch):
+        return await self.branch_manifests.get(
+            branch, lambda: self.run_sync(manifests.get_branch_manifest, branch))
+
+    async def send_response(self, request, response, send):
+        fp = None
+        if (response.sha is not None and request.method != 'HEAD'
+                and response.status != 304):
+            # Open the blob before sending the headers, so that a storage error
+            # can still be answered with an error status.
+            try:
+                fp = await self.run_sync(
+                    storage.get_backend().open, response.sha)
+            except Exception:
+                logging.exception('failed to open blob %s', response.sha)
+                response = self.text_response(500)
+
+        # Send 103 Early Hints (if the server supports the ASGI extension) so
+        # the browser can fetch subresources while the blob is read.
+        extensions = request.scope.get('extensions') or {}
+        link = response.headers.get('Link')
+        if (link and response.status == 200
+                and 'http.response.early_hint' in extensions):
+            await send({
+                'type': 'http.response.early_hint',
+                'links': [value.strip().encode('latin-1')
+                          for value in link.split(',')],
+            })
+        headers = [(key.lower().encode('latin-1'), str(value).encode('latin-1'))
+                   for key, value in response.headers.items()]
+        await send({
+            'type': 'http.response.start',
+            'status': response.status,
+            'headers': headers,
+        })
+        if request.method == 'HEAD' or response.status == 304:
+            await send({'type': 'http.response.body', 'body': b''})
+            return
+        if fp is None:
+            await send({'type': 'http.response.body', 'body': response.body})
+            return
+        await self.stream_blob(fp, send)
+
+    async def stream_blob(self, fp, send):
+        """Streams an open blob as the response body.
+
+        The headers are already sent, so if reading the blob or sending a chunk
+        fails, the error is logged and the body is left incomplete: the ASGI
+        server then closes the connection, and the client sees a truncated
+        response rather than one that looks complete.
+        """
+        try:
+            while True:
+                chunk = await self.run_sync(fp.read, CHUNK_SIZE)
+                more_body = len(chunk) == CHUNK_SIZE
+                await send({
+                    'type': 'http.response.body',
+                    'body': chunk,
+                    'more_body': more_body,
+                })
+                if not more_body:
+                    break
+        except Exception:
+            logging.exception('failed to stream blob')
+        finally:
+            try:
+                await self.run_sync(fp.close)
+            except Exception:
+                logging.exception('failed to close blob')
+
+    def redirect(self, redirect_uri, code=302):
+        return Response(code, headers={
+            'Location': redirect_uri,
+            'Cache-Control': 'no-cache',
+        })
+
+    def text_response(self, status):
+        return Response(status, headers={'Content-Type': 'text/plain'},
+                        body='{}\n'.format(status).encode('utf-8'))
+
+
+app = App()
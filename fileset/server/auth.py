@@ -1,11 +1,65 @@
 #!/usr/bin/env python
 
+"""API tokens.
+
+Signed tokens have the format `fs1.<kid>.<scope>.<exp>.<sig>`, where `kid`
+identifies the signing key, `scope` limits the API methods the token may
+call, `exp` is the expiry as a unix timestamp and `sig` is the HMAC-SHA256
+of the rest of the token. They are verified with the signing keys and a
+small list of revoked tokens, both kept in memory by each instance and
+refreshed from memcache every `REFRESH_SECONDS`, so checking a token doesn't
+need any RPCs.
+
+Tokens created before signed tokens were introduced are random strings
+stored in the datastore. They are still accepted, with the "admin" scope.
+"""
+
+import base64
 import datetime
+import hashlib
+import hmac
+import re
+import threading
+import time
 from google.appengine.api import memcache
 from google.appengine.api import users
 from google.appengine.ext import ndb
+from fileset import config
+from fileset.server import stats
 from fileset.thirdparty import secrets
 
+SIGNED_TOKEN_PREFIX = 'fs1'
+
+# Scopes in increasing order of access. Each scope includes the ones before it.
+SCOPE_READ = 'read'
+SCOPE_DEPLOY = 'deploy'
+SCOPE_ADMIN = 'admin'
+SCOPES = (SCOPE_READ, SCOPE_DEPLOY, SCOPE_ADMIN)
+
+SIGNED_TOKEN_RE = re.compile(
+    r'^fs1\.([0-9a-f]+)\.([a-z]+)\.([0-9]+)\.([A-Za-z0-9_-]+)$')
+
+STATE_KEY = 'fs-auth-state'
+REFRESH_SECONDS = 10
+
+# Seconds before the state in memcache expires and is rebuilt from the
+# datastore. Concurrent changes may publish their snapshots out of order, so
+# this bounds how long a change can be missing.
+STATE_SECONDS = 6 * REFRESH_SECONDS
+
+# Minimum seconds between refreshes triggered by an unknown key id, so that a
+# key created on another instance is usable right away.
+MIN_REFRESH_SECONDS = 1
+
+# All signing keys and revoked tokens share a parent so that they can be read
+# with a strongly consistent ancestor query right after they change.
+PARENT_KEY = ndb.Key('FilesetAuthState', 'default')
+
+_lock = threading.Lock()
+_state = None
+_loaded = 0
+_expires = 0
+
 
 class Error(Exception):
     pass
@@ -18,6 +72,18 @@ class FilesetAuthToken(ndb.Model):
     last_used = ndb.DateTimeProperty()
 
 
+class FilesetSigningKey(ndb.Model):
+    # Keyed by the key id.
+    secret = ndb.StringProperty(indexed=False)
+    created = ndb.DateTimeProperty(auto_now_add=True)
+
+
+class FilesetRevokedToken(ndb.Model):
+    # Keyed by the token's signature.
+    expires = ndb.DateTimeProperty()
+    created = ndb.DateTimeProperty(auto_now_add=True)
+
+
 def create_auth_token(description):
     if not users.is_current_user_admin():
         raise Error('only admins can create auth tokens')
@@ -33,10 +99,40 @@ def create_auth_token(description):
     return token
 
 
-def is_token_valid(token):
+def create_signed_token(scope=SCOPE_DEPLOY, ttl_days=None):
+    if not users.is_current_user_admin():
+        raise Error('only admins can create auth tokens')
+    if scope not in SCOPES:
+        raise Error('invalid scope: {}'.format(scope))
+    if ttl_days is None:
+        ttl_days = config.AUTH_TOKEN_TTL_DAYS
+
+    keys = _get_state()['keys']
+    if not keys:
+        _create_signing_key()
+        keys = _get_state()['keys']
+    # Sign with the newest key.
+    kid = max(keys, key=lambda kid: keys[kid][1])
+    expires = int(time.time() + ttl_days * 24 * 60 * 60)
+    payload = '{}.{}.{}.{}'.format(SIGNED_TOKEN_PREFIX, kid, scope, expires)
+    return '{}.{}'.format(payload, _sign(keys[kid][0], payload))
+
+
+def is_token_valid(token, scope=SCOPE_ADMIN):
+    """Returns whether a token is valid and grants `scope`."""
+    if token.startswith(SIGNED_TOKEN_PREFIX + '.'):
+        token_scope = get_signed_token_scope(token)
+        if token_scope is None:
+            stats.incr('signed_token_rejects')
+            return False
+        stats.incr('signed_token_accepts')
+        return SCOPES.index(token_scope) >= SCOPES.index(scope)
+
     memcache_key = 'fs-token-valid:{}'.format(token)
     if memcache.get(memcache_key) == '1':
+        stats.incr('token_cache_hits')
         return True
+    stats.incr('token_cache_misses')
 
     ent = FilesetAuthToken.get_by_id(token)
     is_valid = bool(ent)
@@ -53,7 +149,33 @@ def is_token_valid(token):
     return is_valid
 
 
+def get_signed_token_scope(token):
+    """Returns the scope of a valid signed token, or None."""
+    match = SIGNED_TOKEN_RE.match(token)
+    if not match:
+        return None
+    kid, scope, expires, sig = match.groups()
+    if scope not in SCOPES or int(expires) < time.time():
+        return None
+
+    state = _get_state()
+    if kid not in state['keys']:
+        state = _get_state(refresh=True)
+        if kid not in state['keys']:
+            return None
+    payload = token[:-len(sig) - 1]
+    expected = _sign(state['keys'][kid][0], payload)
+    if not hmac.compare_digest(str(expected), str(sig)):
+        return None
+    if sig in state['revoked']:
+        return None
+    return scope
+
+
 def delete_token(token):
+    if token.startswith(SIGNED_TOKEN_PREFIX + '.'):
+        return revoke_signed_token(token)
+
     memcache_key = 'fs-token-valid:{}'.format(token)
     memcache.delete(memcache_key)
 
@@ -61,5 +183,87 @@ def delete_token(token):
     key.delete()
 
 
+def revoke_signed_token(token):
+    match = SIGNED_TOKEN_RE.match(token)
+    if not match:
+        raise Error('invalid token')
+    _, _, expires, sig = match.groups()
+    expires = datetime.datetime.utcfromtimestamp(int(expires))
+    FilesetRevokedToken(id=sig, parent=PARENT_KEY, expires=expires).put()
+    _publish()
+
+
+def delete_signing_key(kid):
+    """Deletes a signing key, which revokes every token signed with it."""
+    ndb.Key(FilesetSigningKey, kid, parent=PARENT_KEY).delete()
+    _publish()
+
+
+def _create_signing_key():
+    kid = secrets.token_hex(4)
+    FilesetSigningKey(
+        id=kid, parent=PARENT_KEY, secret=secrets.token_hex(32)).put()
+    _publish()
+
+
+def _get_state(refresh=False):
+    """Returns a dict with the signing keys and the revoked signatures.
+
+    `keys` maps key id => (secret, created timestamp) and `revoked` maps the
+    signatures of revoked (but unexpired) tokens => expiry timestamp.
+    """
+    global _state, _loaded, _expires
+    now = time.time()
+    if refresh and now - _loaded < MIN_REFRESH_SECONDS:
+        refresh = False
+    if _state is not None and now < _expires and not refresh:
+        return _state
+    with _lock:
+        if _state is None or time.time() >= _expires or refresh:
+            state = memcache.get(STATE_KEY)
+            if state is None:
+                state = _load_state()
+                # Don't overwrite a newer state published by `_publish()`.
+                memcache.add(STATE_KEY, state, time=STATE_SECONDS)
+            _state = state
+            _loaded = time.time()
+            _expires = _loaded + REFRESH_SECONDS
+    return _state
+
+
+def _load_state():
+    now = datetime.datetime.utcnow()
+    epoch = datetime.datetime(1970, 1, 1)
+    keys = {}
+    for ent in FilesetSigningKey.query(ancestor=PARENT_KEY):
+        created = (ent.created - epoch).total_seconds()
+        keys[ent.key.id()] = (ent.secret, created)
+    revoked = {}
+    for ent in FilesetRevokedToken.query(ancestor=PARENT_KEY):
+        # Expired tokens are rejected anyway.
+        if ent.expires and ent.expires > now:
+            revoked[ent.key.id()] = (ent.expires - epoch).total_seconds()
+    return {
+        'keys': keys,
+        'revoked': revoked,
+    }
+
+
+def _publish():
+    global _expires
+    state = _load_state()
+    memcache.set(STATE_KEY, state, time=STATE_SECONDS)
+    # Refresh this instance right away.
+    _expires = 0
+    return state
+
+
+def _sign(secret, payload):
+    digest = hmac.new(
+        secret.encode('utf-8'), payload.encode('utf-8'),
+        hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest).rstrip(b'=').decode('ascii')
+
+
 def _generate_token():
     return secrets.token_hex(32)
@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+
+import time
+import unittest
+from fileset.server import testing
+
+testing.setup_sdk()
+
+from fileset.server import auth
+from google.appengine.api import memcache
+
+
+class Clock(object):
+    """Stands in for the `time` module."""
+
+    def __init__(self):
+        self.now = time.time()
+
+    def time(self):
+        return self.now
+
+
+class AuthTest(testing.TestCase):
+
+    def setUp(self):
+        super(AuthTest, self).setUp()
+        self.testbed.setup_env(
+            app_id=testing.APP_ID, http_host=testing.HOST,
+            user_email='admin@example.com', user_id='1', user_is_admin='1',
+            overwrite=True)
+        self.clock = Clock()
+        self.patch(auth, 'time', self.clock)
+        self.patch(auth, '_state', None)
+        self.patch(auth, '_loaded', 0)
+        self.patch(auth, '_expires', 0)
+
+    def _replace_sig(self, token, sig):
+        return '{}.{}'.format(token.rsplit('.', 1)[0], sig)
+
+    def _publish_from_other_instance(self):
+        """Publishes the datastore state without refreshing this instance."""
+        memcache.set(auth.STATE_KEY, auth._load_state())
+
+    def test_scopes(self):
+        read_token = auth.create_signed_token(scope=auth.SCOPE_READ)
+        deploy_token = auth.create_signed_token()
+        admin_token = auth.create_signed_token(scope=auth.SCOPE_ADMIN)
+        self.assertTrue(auth.is_token_valid(read_token, auth.SCOPE_READ))
+        self.assertFalse(auth.is_token_valid(read_token, auth.SCOPE_DEPLOY))
+        self.assertFalse(auth.is_token_valid(read_token, auth.SCOPE_ADMIN))
+        self.assertTrue(auth.is_token_valid(deploy_token, auth.SCOPE_READ))
+        self.assertTrue(auth.is_token_valid(deploy_token, auth.SCOPE_DEPLOY))
+        self.assertFalse(auth.is_token_valid(deploy_token, auth.SCOPE_ADMIN))
+        self.assertTrue(auth.is_token_valid(admin_token, auth.SCOPE_ADMIN))
+        self.assertEqual(
+            auth.SCOPE_DEPLOY, auth.get_signed_token_scope(deploy_token))
+        # Every token is signed with the same key.
+        self.assertEqual(1, auth.FilesetSigningKey.query().count())
+
+    def test_create_requires_admin(self):
+        self.testbed.setup_env(user_is_admin='0', overwrite=True)
+        with self.assertRaises(auth.Error):
+            auth.create_signed_token()
+        with self.assertRaises(auth.Error):
+            auth.create_auth_token('description')
+        self.testbed.setup_env(user_is_admin='1', overwrite=True)
+        with self.assertRaises(auth.Error):
+            auth.create_signed_token(scope='owner')
+
+    def test_expiry(self):
+        token = auth.create_signed_token(ttl_days=1)
+        self.assertTrue(auth.is_token_valid(token, auth.SCOPE_DEPLOY))
+        self.clock.now += 24 * 3600 + 1
+        self.assertFalse(auth.is_token_valid(token, auth.SCOPE_DEPLOY))
+        expired_token = auth.create_signed_token(ttl_days=-1)
+        self.assertFalse(auth.is_token_valid(expired_token, auth.SCOPE_READ))
+
+    def test_tampered(self):
+        token = auth.create_signed_token(scope=auth.SCOPE_READ)
+        prefix, kid, scope, expires, sig = token.split('.')
+        # A different scope or expiry invalidates the signature.
+        forged = '.'.join([prefix, kid, auth.SCOPE_ADMIN, expires, sig])
+        self.assertFalse(auth.is_token_valid(forged, auth.SCOPE_ADMIN))
+        forged = '.'.join([prefix, kid, scope, str(int(expires) + 1), sig])
+        self.assertFalse(auth.is_token_valid(forged, auth.SCOPE_READ))
+        # So does a changed signature.
+        tampered_sig = ('A' if sig[0] != 'A' else 'B') + sig[1:]
+        self.assertFalse(auth.is_token_valid(
+            self._replace_sig(token, tampered_sig), auth.SCOPE_READ))
+        self.assertFalse(auth.is_token_valid(
+            self._replace_sig(token, sig[:-1]), auth.SCOPE_READ))
+        self.assertFalse(auth.is_token_valid(
+            token + '.extra', auth.SCOPE_READ))
+        self.assertTrue(auth.is_token_valid(token, auth.SCOPE_READ))
+
+    def test_unknown_kid(self):
+        token = auth.create_signed_token()
+        _, kid, scope, expires, sig = token.split('.')
+        unknown_kid = 'ffffffff' if kid != 'ffffffff' else 'eeeeeeee'
+        forged = '.'.join(['fs1', unknown_kid, scope, expires, sig])
+        self.assertFalse(auth.is_token_valid(forged, auth.SCOPE_DEPLOY))
+        # Keys deleted on other instances are picked up within
+        # REFRESH_SECONDS.
+        auth.FilesetSigningKey.query().get().key.delete()
+        self._publish_from_other_instance()
+        self.assertTrue(auth.is_token_valid(token, auth.SCOPE_DEPLOY))
+        self.clock.now += auth.REFRESH_SECONDS
+        self.assertFalse(auth.is_token_valid(token, auth.SCOPE_DEPLOY))
+
+    def test_refresh_throttling(self):
+        auth.create_signed_token()
+        self.assertTrue(auth._get_state()['keys'])
+        loaded = auth._loaded
+        # A key created on another instance.
+        auth.FilesetSigningKey(
+            id='abcdef01', parent=auth.PARENT_KEY, secret='secret').put()
+        self._publish_from_other_instance()
+        payload = 'fs1.abcdef01.deploy.{}'.format(int(self.clock.now) + 60)
+        token = '{}.{}'.format(payload, auth._sign('secret', payload))
+
+        # The state was just loaded, so the unknown key id doesn't refresh it.
+        self.assertFalse(auth.is_token_valid(token, auth.SCOPE_DEPLOY))
+        self.assertEqual(loaded, auth._loaded)
+        # Afterwards, an unknown key id refreshes the state right away,
+        # without waiting for REFRESH_SECONDS.
+        self.clock.now += auth.MIN_REFRESH_SECONDS
+        self.assertTrue(auth.is_token_valid(token, auth.SCOPE_DEPLOY))
+        self.assertEqual(self.clock.now, auth._loaded)
+        # Known key ids don't refresh the state.
+        self.clock.now += auth.MIN_REFRESH_SECONDS
+        self.assertTrue(auth.is_token_valid(token, auth.SCOPE_DEPLOY))
+        self.assertEqual(self.clock.now - auth.MIN_REFRESH_SECONDS,
+                         auth._loaded)
+        # Bogus key ids refresh the state at most once per MIN_REFRESH_SECONDS.
+        forged = token.replace('abcdef01', '01234567')
+        self.assertFalse(auth.is_token_valid(forged, auth.SCOPE_DEPLOY))
+        self.assertEqual(self.clock.now, auth._loaded)
+        self.assertFalse(auth.is_token_valid(forged, auth.SCOPE_DEPLOY))
+        self.assertEqual(self.clock.now, auth._loaded)
+
+    def test_revoke(self):
+        token = auth.create_signed_token()
+        other_token = auth.create_signed_token(scope=auth.SCOPE_READ)
+        self.assertTrue(auth.is_token_valid(token, auth.SCOPE_DEPLOY))
+        auth.delete_token(token)
+        # Revoked on this instance, so rejected right away.
+        self.assertFalse(auth.is_token_valid(token, auth.SCOPE_DEPLOY))
+        self.assertTrue(auth.is_token_valid(other_token, auth.SCOPE_READ))
+        with self.assertRaises(auth.Error):
+            auth.revoke_signed_token('fs1.invalid')
+
+    def test_revocation_cache(self):
+        token = auth.create_signed_token()
+        self.assertTrue(auth.is_token_valid(token, auth.SCOPE_DEPLOY))
+        # Revoked on another instance.
+        sig = token.rsplit('.', 1)[1]
+        auth.FilesetRevokedToken(
+            id=sig, parent=auth.PARENT_KEY,
+            expires=auth.datetime.datetime.utcnow()
+            + auth.datetime.timedelta(days=1)).put()
+        self._publish_from_other_instance()
+        # Instances check revocations in memory, and refresh them every
+        # REFRESH_SECONDS.
+        self.assertTrue(auth.is_token_valid(token, auth.SCOPE_DEPLOY))
+        self.clock.now += auth.REFRESH_SECONDS
+        self.assertFalse(auth.is_token_valid(token, auth.SCOPE_DEPLOY))
+
+        # The state is rebuilt from the datastore when memcache loses it.
+        memcache.flush_all()
+        self.patch(auth, '_state', None)
+        self.assertFalse(auth.is_token_valid(token, auth.SCOPE_DEPLOY))
+        self.assertIn(sig, memcache.get(auth.STATE_KEY)['revoked'])
+
+    def test_delete_signing_key(self):
+        token = auth.create_signed_token()
+        kid = token.split('.')[1]
+        auth.delete_signing_key(kid)
+        self.assertFalse(auth.is_token_valid(token, auth.SCOPE_DEPLOY))
+        # A new key is created for new tokens.
+        new_token = auth.create_signed_token()
+        self.assertNotEqual(kid, new_token.split('.')[1])
+        self.assertTrue(auth.is_token_valid(new_token, auth.SCOPE_DEPLOY))
+
+    def test_legacy_token(self):
+        token = auth.create_auth_token('ci')
+        self.assertEqual(
+            'admin@example.com',
+            auth.FilesetAuthToken.get_by_id(token).created_by)
+        # Random tokens from before signed tokens keep the admin scope.
+        self.assertTrue(auth.is_token_valid(token, auth.SCOPE_ADMIN))
+        self.assertTrue(auth.is_token_valid(token, auth.SCOPE_READ))
+        # Valid tokens are cached in memcache.
+        self.assertEqual(
+            '1', memcache.get('fs-token-valid:{}'.format(token)))
+        auth.FilesetAuthToken.get_by_id(token).key.delete()
+        self.assertTrue(auth.is_token_valid(token, auth.SCOPE_ADMIN))
+
+        auth.delete_token(token)
+        self.assertFalse(auth.is_token_valid(token, auth.SCOPE_ADMIN))
+        self.assertFalse(auth.is_token_valid('0' * 64, auth.SCOPE_READ))
+
+
+if __name__ == '__main__':
+    unittest.main()
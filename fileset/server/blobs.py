@@ -1,51 +1,305 @@
 #!/usr/bin/env python
 
+import datetime
 import hashlib
-import os
-import cloudstorage as gcs
-from google.appengine.api import app_identity
+import json
+import logging
+import threading
+import time
+from fileset import config
+from fileset.server import lru
+from fileset.server import singleflight
+from fileset.server import stats
+from fileset.server import storage
 from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+CONFIRMED_KEY_PREFIX = 'fs-blob-confirmed:'
+EXISTS_KEY_PREFIX = 'fs-blob-exists:'
+
+# Content type of cached blobs served without a known content type.
+DEFAULT_CONTENT_TYPE = 'application/octet-stream'
+
+# Confirmations (see `FilesetBlobConfirmation`) are recorded at most this
+# often per blob.
+CONFIRM_INTERVAL_SECONDS = 24 * 3600
+
+# Confirmations are buffered in process and written by a task, in batches of
+# up to CONFIRM_BATCH_SIZE at most every CONFIRM_FLUSH_SECONDS, so that
+# `blob.exists` never writes to the datastore. Until a batch is written, the
+# garbage collector reads its confirmations from memcache.
+CONFIRM_BATCH_SIZE = 500
+CONFIRM_FLUSH_SECONDS = 10
+CONFIRM_TASK_URL = '/_fs/api/task.confirm_blobs'
+
+# Misses are cached briefly, since a missing blob is usually uploaded right
+# after the client checks for it (and `write()` overwrites the entry).
+NEGATIVE_CACHE_SECONDS = 30
+
+# Upper bound on the number of SHAs remembered in process. Each SHA costs
+# roughly 100 bytes, so the default caps the cache at ~20MB.
+MAX_LOCAL_EXISTS = 200000
+
+# Blobs are immutable, but unreferenced blobs can be garbage collected, so
+# in-process entries expire rather than living for the lifetime of the
+# instance (`delete()` only clears memcache and the local instance). Keep this
+# well under the garbage collection cron's interval.
+LOCAL_EXISTS_SECONDS = 60
+
+# Map of SHA => expiration timestamp for blobs known to exist.
+_exists_cache = {}
+
+# Map of SHA => (content, content_type) for small blobs. Blobs are
+# immutable, so entries never go stale.
+_content_cache = lru.LruCache(
+    config.BLOB_CACHE_MAX_BYTES, weigh=lambda value: len(value[0]))
+
+# Coalesces concurrent reads of the same blob within this instance.
+_read_flights = singleflight.Group('blobs.read')
+
+# Map of SHA => timestamp of confirmations that weren't written yet.
+_pending_confirmations = {}
+_confirm_lock = threading.Lock()
+_last_confirm_flush = 0
+
+
+stats.register_gauge('blob_exists_cache_entries', lambda: len(_exists_cache))
+stats.register_gauge('blob_cache_entries', lambda: len(_content_cache))
+stats.register_gauge('blob_cache_bytes', lambda: _content_cache.weight)
 
 
 class Error(Exception):
     pass
 
 
-def get_gcs_path(sha):
-    bucket = app_identity.get_default_gcs_bucket_name()
-    return os.path.join('/', bucket, 'blobs', sha)
+class FilesetBlobConfirmation(ndb.Model):
+    """The last time a client was told that a blob exists.
+
+    Clients don't upload blobs that exist, so a deploy can reference an old
+    blob that no manifest references yet. The garbage collector keeps blobs
+    confirmed within the retention window, like blobs uploaded within it.
+    """
+    _use_cache = False
+    _use_memcache = False
+
+    confirmed = ndb.DateTimeProperty(indexed=False)
 
 
 def exists(sha):
-    memcache_key = 'fs-blob-exists:{}'.format(sha)
-    if memcache.get(memcache_key) == '1':
-        return True
+    """Returns whether a blob exists, and records when it was confirmed."""
+    found = _exists(sha)
+    if found:
+        confirm(sha)
+    return found
+
+
+def confirm(sha):
+    """Records that a blob was confirmed to exist.
+
+    The confirmation is only written to the datastore by a later
+    `flush_confirmations()`.
+    """
+    if sha in _pending_confirmations:
+        return
+    now = time.time()
+    if memcache.add(CONFIRMED_KEY_PREFIX + sha, now,
+                    time=CONFIRM_INTERVAL_SECONDS):
+        with _confirm_lock:
+            _pending_confirmations[sha] = now
+
 
-    gcs_path = get_gcs_path(sha)
+def flush_confirmations(force=False):
+    """Enqueues tasks that write the buffered confirmations.
+
+    Unless `force` is set, nothing is enqueued until a full batch is buffered
+    or CONFIRM_FLUSH_SECONDS passed since the last flush.
+    """
+    global _last_confirm_flush
+    with _confirm_lock:
+        if not _pending_confirmations:
+            return
+        if (not force
+                and len(_pending_confirmations) < CONFIRM_BATCH_SIZE
+                and time.time() - _last_confirm_flush < CONFIRM_FLUSH_SECONDS):
+            return
+        pending = sorted(_pending_confirmations.items())
+        _pending_confirmations.clear()
+        _last_confirm_flush = time.time()
+
+    # Imported here since only `blob.exists` needs it.
+    from google.appengine.api import taskqueue
+    tasks = []
+    for i in range(0, len(pending), CONFIRM_BATCH_SIZE):
+        tasks.append(taskqueue.Task(
+            url=CONFIRM_TASK_URL,
+            payload=json.dumps(pending[i:i + CONFIRM_BATCH_SIZE]),
+            headers={'Content-Type': 'application/json'}))
     try:
-        gcs.stat(gcs_path)
-        exists = True
-    except gcs.NotFoundError:
-        exists = False
+        taskqueue.Queue().add(tasks)
+    except Exception:
+        # The garbage collector still sees the confirmations in memcache.
+        logging.exception('failed to enqueue %s blob confirmations',
+                          len(pending))
+
+
+def save_confirmations(confirmations):
+    """Writes a batch of `(sha, timestamp)` confirmations."""
+    ndb.put_multi([
+        FilesetBlobConfirmation(
+            id=sha, confirmed=datetime.datetime.fromtimestamp(timestamp))
+        for sha, timestamp in confirmations])
+
+
+def get_confirmed(shas):
+    """Returns a map of SHA => the last time the blob was confirmed."""
+    keys = [ndb.Key(FilesetBlobConfirmation, sha) for sha in shas]
+    confirmed = dict((ent.key.id(), ent.confirmed)
+                     for ent in ndb.get_multi(keys) if ent)
+    # Recent confirmations may not have been written yet.
+    timestamps = memcache.get_multi(
+        list(shas), key_prefix=CONFIRMED_KEY_PREFIX)
+    for sha, timestamp in timestamps.items():
+        if not isinstance(timestamp, (int, float)):
+            continue
+        last_confirmed = datetime.datetime.fromtimestamp(timestamp)
+        if sha not in confirmed or last_confirmed > confirmed[sha]:
+            confirmed[sha] = last_confirmed
+    return confirmed
+
+
+def _exists(sha):
+    expires = _exists_cache.get(sha)
+    if expires and expires > time.time():
+        stats.incr('blob_exists_cache_hits')
+        return True
+
+    memcache_key = EXISTS_KEY_PREFIX + sha
+    value = memcache.get(memcache_key)
+    if value == '1':
+        stats.incr('blob_exists_cache_hits')
+        _remember_exists(sha)
+        return True
+    if value == '0':
+        stats.incr('blob_exists_cache_hits')
+        return False
+
+    stats.incr('blob_exists_cache_misses')
+    exists = storage.get_backend().exists(sha)
+    if exists:
+        memcache.set(memcache_key, '1')
+        _remember_exists(sha)
+    else:
+        memcache.set(memcache_key, '0', time=NEGATIVE_CACHE_SECONDS)
     return exists
 
 
+def prefill_exists_cache(marker=None, max_keys=1000):
+    """Seeds the existence caches by listing blobs in storage.
+
+    Lists up to `max_keys` blobs after `marker` and returns a tuple of
+    `(num_blobs, next_marker)`, where `next_marker` is None once the end of the
+    listing has been reached.
+    """
+    shas = [stat.sha for stat in storage.get_backend().list(
+        marker=marker, max_keys=max_keys)]
+
+    if shas:
+        memcache.set_multi(
+            dict((sha, '1') for sha in shas), key_prefix=EXISTS_KEY_PREFIX)
+        for sha in shas:
+            _remember_exists(sha)
+
+    next_marker = shas[-1] if len(shas) >= max_keys else None
+    return len(shas), next_marker
+
+
+def _remember_exists(sha):
+    if len(_exists_cache) >= MAX_LOCAL_EXISTS:
+        _exists_cache.clear()
+    _exists_cache[sha] = time.time() + LOCAL_EXISTS_SECONDS
+
+
 def write(sha, content, content_type):
     file_sha = hashlib.sha1(content).hexdigest()
     if sha != file_sha:
         raise Error('sha does not match: "{}" != "{}"'.format(sha, file_sha))
 
-    gcs_path = get_gcs_path(sha)
-    with gcs.open(gcs_path, 'w', content_type=content_type) as fp:
-        fp.write(content)
+    storage.get_backend().write(sha, content, content_type)
 
-    memcache_key = 'fs-blob-exists:{}'.format(sha)
+    memcache_key = EXISTS_KEY_PREFIX + sha
     memcache.set(memcache_key, '1')
+    _remember_exists(sha)
 
 
-def read(sha):
-    gcs_path = get_gcs_path(sha)
-    gcs_file = gcs.open(gcs_path)
-    content = gcs_file.read()
-    gcs_file.close()
+def stat(sha):
+    return storage.get_backend().stat(sha)
+
+
+def delete(sha):
+    storage.get_backend().delete(sha)
+    ndb.Key(FilesetBlobConfirmation, sha).delete()
+    memcache.delete_multi(
+        [EXISTS_KEY_PREFIX + sha, CONFIRMED_KEY_PREFIX + sha])
+    _exists_cache.pop(sha, None)
+    _pending_confirmations.pop(sha, None)
+    _content_cache.delete(sha)
+
+
+def read(sha, content_type=None):
+    """Returns the content of a blob.
+
+    Small blobs are cached in process with `content_type` (e.g. from the
+    manifest's metadata), without another RPC to stat the blob.
+    """
+    cached = _content_cache.get(sha)
+    if cached is not None:
+        return cached[0]
+    content = _read_flights.do(sha, storage.get_backend().read, sha)
+    if content is not None and len(content) <= config.BLOB_CACHE_MAX_BLOB_SIZE:
+        _content_cache.set(sha, (content, content_type))
     return content
+
+
+def prefetch(shas):
+    """Loads small blobs into the in-process blob cache.
+
+    Returns the number of blobs that were loaded.
+    """
+    num_loaded = 0
+    for sha in shas:
+        if sha in _content_cache:
+            continue
+        blob_stat = stat(sha)
+        if not blob_stat or blob_stat.size > config.BLOB_CACHE_MAX_BLOB_SIZE:
+            continue
+        content = storage.get_backend().read(sha)
+        if content is not None:
+            _content_cache.set(sha, (content, blob_stat.content_type))
+            num_loaded += 1
+    return num_loaded
+
+
+def serve(handler, sha, content_type=None):
+    """Serves the blob as the body of a webapp2 handler's response.
+
+    `content_type` (e.g. from the manifest's metadata) overrides the content
+    type stored with the blob. Returns True if the body was written from the
+    in-process cache, or False if it was handed off to the storage backend
+    (which streams it after the handler returns).
+    """
+    stats.record_blob_request(sha)
+    cached = _content_cache.get(sha)
+    # Range requests are left to the storage backend, which answers them with
+    # a 206 or 416 (GCS through the blobstore, the local backend itself).
+    if cached is not None and 'Range' not in handler.request.headers:
+        stats.incr('blob_cache_hits')
+        content, cached_content_type = cached
+        handler.response.headers['Content-Type'] = (
+            content_type or cached_content_type or DEFAULT_CONTENT_TYPE)
+        handler.response.out.write(content)
+        return True
+    stats.incr('blob_cache_misses')
+    storage.get_backend().serve(handler, sha)
+    if content_type:
+        handler.response.headers['Content-Type'] = content_type
+    return False
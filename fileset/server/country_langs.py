@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+
+"""De-facto languages by country, keyed by lowercase ISO 3166 code.
+
+Generated by scripts/generate_country_langs.py from babel 2.18.0.
+Do not edit.
+"""
+
+COUNTRY_LANGS = {
+    'ad': ('ca',),
+    'ae': ('ar',),
+    'af': ('fa', 'ps'),
+    'ag': ('en',),
+    'ai': ('en',),
+    'al': ('sq',),
+    'am': ('hy',),
+    'ao': ('pt',),
+    'ar': ('es',),
+    'as': ('sm', 'en'),
+    'at': ('de',),
+    'au': ('en',),
+    'aw': ('nl', 'pap'),
+    'ax': ('sv',),
+    'az': ('az', 'az_Cyrl'),
+    'ba': ('bs_Cyrl', 'bs', 'hr', 'sr_Latn', 'sr'),
+    'bb': ('en',),
+    'bd': ('bn',),
+    'be': ('nl', 'fr', 'de'),
+    'bf': ('fr',),
+    'bg': ('bg',),
+    'bh': ('ar',),
+    'bi': ('rn', 'fr', 'en'),
+    'bj': ('fr',),
+    'bl': ('fr',),
+    'bm': ('en',),
+    'bn': ('ms', 'ms_Arab'),
+    'bo': ('es', 'qu', 'ay'),
+    'bq': ('nl',),
+    'br': ('pt',),
+    'bs': ('en',),
+    'bt': ('dz',),
+    'bw': ('en', 'tn'),
+    'by': ('be', 'ru'),
+    'bz': ('en',),
+    'ca': ('en', 'fr'),
+    'cc': ('en',),
+    'cd': ('fr',),
+    'cf': ('sg', 'fr'),
+    'cg': ('fr',),
+    'ch': ('de', 'gsw', 'fr', 'it'),
+    'ci': ('fr',),
+    'ck': ('en',),
+    'cl': ('es',),
+    'cm': ('fr', 'en'),
+    'cn': ('zh',),
+    'co': ('es',),
+    'cq': ('en',),
+    'cr': ('es',),
+    'cu': ('es',),
+    'cv': ('pt',),
+    'cw': ('pap', 'nl'),
+    'cx': ('en',),
+    'cy': ('el', 'tr'),
+    'cz': ('cs',),
+    'de': ('de',),
+    'dg': ('en',),
+    'dj': ('fr', 'ar'),
+    'dk': ('da',),
+    'dm': ('en',),
+    'do': ('es',),
+    'dz': ('ar', 'fr'),
+    'ea': ('es',),
+    'ec': ('es', 'qu'),
+    'ee': ('et',),
+    'eg': ('ar',),
+    'eh': ('ar',),
+    'er': ('ti', 'en', 'ar'),
+    'es': ('es',),
+    'et': ('am',),
+    'fi': ('fi', 'sv'),
+    'fj': ('en', 'hif', 'fj'),
+    'fk': ('en',),
+    'fm': ('en',),
+    'fo': ('fo',),
+    'fr': ('fr',),
+    'ga': ('fr',),
+    'gb': ('en',),
+    'gd': ('en',),
+    'ge': ('ka',),
+    'gf': ('fr',),
+    'gg': ('en',),
+    'gh': ('en',),
+    'gi': ('en',),
+    'gl': ('kl',),
+    'gm': ('en',),
+    'gn': ('fr',),
+    'gp': ('fr',),
+    'gq': ('es', 'fr', 'pt'),
+    'gr': ('el',),
+    'gs': ('en',),
+    'gt': ('es',),
+    'gu': ('en', 'ch'),
+    'gw': ('pt',),
+    'gy': ('en',),
+    'hk': ('zh_Hant', 'en'),
+    'hn': ('es',),
+    'hr': ('hr',),
+    'ht': ('ht', 'fr'),
+    'hu': ('hu',),
+    'ic': ('es',),
+    'id': ('id',),
+    'ie': ('en', 'ga'),
+    'il': ('he', 'ar'),
+    'im': ('en', 'gv'),
+    'in': ('hi', 'en'),
+    'io': ('en',),
+    'iq': ('ar',),
+    'ir': ('fa',),
+    'is': ('is',),
+    'it': ('it',),
+    'je': ('en',),
+    'jm': ('en',),
+    'jo': ('ar',),
+    'jp': ('ja',),
+    'ke': ('sw', 'en'),
+    'kg': ('ky', 'ru'),
+    'kh': ('km',),
+    'ki': ('en', 'gil'),
+    'km': ('ar', 'zdj', 'wni', 'fr'),
+    'kn': ('en',),
+    'kp': ('ko',),
+    'kr': ('ko',),
+    'kw': ('ar',),
+    'ky': ('en',),
+    'kz': ('ru', 'kk'),
+    'la': ('lo',),
+    'lb': ('ar',),
+    'lc': ('en',),
+    'li': ('de', 'gsw'),
+    'lk': ('si', 'ta'),
+    'lr': ('en',),
+    'ls': ('st', 'en'),
+    'lt': ('lt',),
+    'lu': ('fr', 'lb', 'de'),
+    'lv': ('lv',),
+    'ly': ('ar',),
+    'ma': ('ar', 'fr', 'tzm'),
+    'mc': ('fr',),
+    'md': ('ro',),
+    'me': ('sr_Latn',),
+    'mf': ('fr',),
+    'mg': ('mg', 'fr', 'en'),
+    'mh': ('en', 'mh'),
+    'mk': ('mk',),
+    'ml': ('fr',),
+    'mm': ('my',),
+    'mn': ('mn',),
+    'mo': ('zh_Hant', 'yue', 'pt'),
+    'mp': ('en',),
+    'mq': ('fr',),
+    'mr': ('ar',),
+    'ms': ('en',),
+    'mt': ('mt', 'en'),
+    'mu': ('fr', 'en'),
+    'mv': ('dv',),
+    'mw': ('ny', 'en'),
+    'mx': ('es',),
+    'my': ('ms',),
+    'mz': ('pt',),
+    'na': ('en',),
+    'nc': ('fr',),
+    'ne': ('fr',),
+    'nf': ('en',),
+    'ng': ('en', 'yo'),
+    'ni': ('es',),
+    'nl': ('nl',),
+    'no': ('no', 'nb', 'nn'),
+    'np': ('ne',),
+    'nr': ('en', 'na'),
+    'nu': ('niu', 'en'),
+    'nz': ('en', 'mi'),
+    'om': ('ar',),
+    'pa': ('es',),
+    'pe': ('es', 'qu'),
+    'pf': ('fr', 'ty'),
+    'pg': ('tpi', 'en', 'ho'),
+    'ph': ('en', 'fil'),
+    'pk': ('ur', 'en'),
+    'pl': ('pl',),
+    'pm': ('fr',),
+    'pn': ('en',),
+    'pr': ('es', 'en'),
+    'ps': ('ar',),
+    'pt': ('pt',),
+    'pw': ('pau', 'en'),
+    'py': ('gn', 'es'),
+    'qa': ('ar',),
+    're': ('fr',),
+    'ro': ('ro',),
+    'rs': ('sr_Latn', 'sr'),
+    'ru': ('ru',),
+    'rw': ('rw', 'en', 'fr'),
+    'sa': ('ar',),
+    'sb': ('en',),
+    'sc': ('fr', 'en'),
+    'sd': ('en', 'ar'),
+    'se': ('sv',),
+    'sg': ('en', 'zh', 'ms', 'ta'),
+    'sh': ('en',),
+    'si': ('sl',),
+    'sj': ('nb',),
+    'sk': ('sk',),
+    'sl': ('en',),
+    'sm': ('it',),
+    'sn': ('wo', 'fr'),
+    'so': ('so', 'ar'),
+    'sr': ('nl',),
+    'ss': ('en',),
+    'st': ('pt',),
+    'sv': ('es',),
+    'sx': ('en', 'nl'),
+    'sy': ('ar',),
+    'sz': ('en', 'ss'),
+    'tc': ('en',),
+    'td': ('ar', 'fr'),
+    'tg': ('fr',),
+    'th': ('th',),
+    'tj': ('tg',),
+    'tk': ('tkl', 'en'),
+    'tl': ('tet', 'pt'),
+    'tm': ('tk',),
+    'tn': ('ar', 'fr'),
+    'to': ('to', 'en'),
+    'tr': ('tr',),
+    'tt': ('en',),
+    'tv': ('tvl', 'en'),
+    'tw': ('zh_Hant', 'nan_Hant', 'hak_Hant'),
+    'tz': ('sw', 'en'),
+    'ua': ('uk', 'ru'),
+    'ug': ('sw', 'en'),
+    'um': ('en',),
+    'us': ('en',),
+    'uy': ('es',),
+    'uz': ('uz', 'uz_Cyrl'),
+    'va': ('it',),
+    'vc': ('en',),
+    've': ('es',),
+    'vg': ('en',),
+    'vi': ('en',),
+    'vn': ('vi',),
+    'vu': ('bi', 'en', 'fr'),
+    'wf': ('fr',),
+    'ws': ('sm', 'en'),
+    'xk': ('sq', 'sr_Latn', 'sr'),
+    'ye': ('ar',),
+    'yt': ('fr',),
+    'za': ('en',),
+    'zm': ('en',),
+    'zw': ('sn', 'en', 'nd'),
+}
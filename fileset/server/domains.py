@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+
+"""Domain to branch routing for serving several sites from one app.
+
+Env.PROD requests for a domain in the routing table are served from the
+domain's branch instead of DEFAULT_BRANCH, so many small sites can share one
+deployment's instances and caches. The table is small, so each instance keeps
+the whole table in memory and refreshes it from memcache every
+`REFRESH_SECONDS`. Changes made through the API are visible to all instances
+within that time.
+"""
+
+import re
+import threading
+import time
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+ROUTES_KEY = 'fs-domains'
+REFRESH_SECONDS = 10
+
+# All domains share a parent so that the table can be read with a strongly
+# consistent ancestor query right after it changes.
+PARENT_KEY = ndb.Key('FilesetDomainTable', 'default')
+
+DOMAIN_RE = re.compile(r'^[a-z0-9]([a-z0-9-]*[a-z0-9])?(\.[a-z0-9]([a-z0-9-]*[a-z0-9])?)+$')
+
+_lock = threading.Lock()
+_routes = None
+_expires = 0
+
+
+class Error(Exception):
+    pass
+
+
+class FilesetDomain(ndb.Model):
+    # Keyed by the lowercase domain, e.g. "www.example.com".
+    branch = ndb.StringProperty(required=True)
+    updated = ndb.DateTimeProperty(auto_now=True)
+
+
+def get_branch(domain):
+    """Returns the branch that serves `domain`, or None."""
+    return get_routes().get(domain.lower())
+
+
+def get_routes():
+    """Returns a map of domain => branch."""
+    global _routes, _expires
+    if _routes is not None and time.time() < _expires:
+        return _routes
+    with _lock:
+        if _routes is None or time.time() >= _expires:
+            routes = memcache.get(ROUTES_KEY)
+            if routes is None:
+                routes = _load_routes()
+                # Don't overwrite a newer table published by `_publish()`.
+                memcache.add(ROUTES_KEY, routes)
+            _routes = routes
+            _expires = time.time() + REFRESH_SECONDS
+    return _routes
+
+
+def set_route(domain, branch):
+    domain = domain.lower()
+    if not DOMAIN_RE.match(domain):
+        raise Error('invalid domain: {}'.format(domain))
+    if not branch:
+        raise Error('branch is required')
+    FilesetDomain(id=domain, parent=PARENT_KEY, branch=branch).put()
+    return _publish()
+
+
+def delete_route(domain):
+    ndb.Key(FilesetDomain, domain.lower(), parent=PARENT_KEY).delete()
+    return _publish()
+
+
+def _load_routes():
+    query = FilesetDomain.query(ancestor=PARENT_KEY)
+    return dict((ent.key.id(), ent.branch) for ent in query)
+
+
+def _publish():
+    global _expires
+    routes = _load_routes()
+    memcache.set(ROUTES_KEY, routes)
+    # Refresh this instance right away.
+    _expires = 0
+    return routes
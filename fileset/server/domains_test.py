@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+
+import hashlib
+import unittest
+from fileset.server import testing
+
+testing.setup_sdk()
+
+from fileset.server import blobs
+from fileset.server import domains
+from fileset.server import main
+from fileset.server import manifests
+from fileset.server import storage
+from fileset.server import utils
+from google.appengine.api import memcache
+import webapp2
+
+COMMIT = {'sha': 'commit', 'message': ''}
+
+
+class Request(object):
+
+    def __init__(self, host):
+        self.host = host
+
+
+class DomainsTestCase(testing.TestCase):
+
+    def setUp(self):
+        super(DomainsTestCase, self).setUp()
+        # Domains are only routed on Env.PROD.
+        self.testbed.setup_env(
+            app_id=testing.APP_ID, http_host=testing.HOST,
+            server_software='Google App Engine/1.0', overwrite=True)
+        self.patch(domains, '_routes', None)
+        self.patch(domains, '_expires', 0)
+
+
+class RoutesTest(DomainsTestCase):
+
+    def test_set_route(self):
+        self.assertEqual({}, domains.get_routes())
+        routes = domains.set_route('WWW.Example.com', 'site')
+        self.assertEqual({'www.example.com': 'site'}, routes)
+        # Published to other instances, and visible to this one right away.
+        self.assertEqual(routes, memcache.get(domains.ROUTES_KEY))
+        self.assertEqual('site', domains.get_branch('www.example.COM'))
+
+    def test_delete_route(self):
+        domains.set_route('a.example.com', 'a')
+        domains.set_route('b.example.com', 'b')
+        routes = domains.delete_route('A.example.com')
+        self.assertEqual({'b.example.com': 'b'}, routes)
+        self.assertEqual(routes, memcache.get(domains.ROUTES_KEY))
+        self.assertIsNone(domains.get_branch('a.example.com'))
+
+    def test_other_instance(self):
+        domains.get_routes()
+        # Another instance changes the table.
+        memcache.set(domains.ROUTES_KEY, {'www.example.com': 'site'})
+        self.assertIsNone(domains.get_branch('www.example.com'))
+        self.patch(domains, '_expires', 0)
+        self.assertEqual('site', domains.get_branch('www.example.com'))
+
+    def test_invalid(self):
+        with self.assertRaises(domains.Error):
+            domains.set_route('not a domain', 'site')
+        with self.assertRaises(domains.Error):
+            domains.set_route('www.example.com', '')
+        self.assertEqual({}, domains.get_routes())
+
+    def test_get_branch(self):
+        domains.set_route('www.example.com', 'site')
+        request = Request('WWW.example.com:443')
+        self.assertEqual('site', utils.get_branch(request))
+        self.assertTrue(utils.is_routed(request))
+        request = Request('other.example.com')
+        self.assertEqual(utils.DEFAULT_BRANCH, utils.get_branch(request))
+        self.assertFalse(utils.is_routed(request))
+        # Callers may pass the routing table they already loaded.
+        routes = {'other.example.com': 'other'}
+        self.assertEqual('other', utils.get_branch(request, routes=routes))
+        self.assertTrue(utils.is_routed(request, routes=routes))
+
+    def test_get_branch_staging(self):
+        domains.set_route('www.example.com', 'site')
+        host = 'feature-dot-{}.appspot.com'.format(testing.APP_ID)
+        self.assertEqual('feature', utils.get_branch(Request(host)))
+        self.assertFalse(utils.is_routed(Request(host)))
+
+
+class ServeErrorTest(DomainsTestCase):
+
+    def setUp(self):
+        super(ServeErrorTest, self).setUp()
+        self.patch(storage, '_backend',
+                   storage.LocalBackend(self.make_tempdir()))
+        self.patch(blobs, '_content_cache', blobs.lru.LruCache(10))
+        self.patch(manifests, '_manifest_cache', manifests.lru.LruCache(10))
+        content = b'default 404'
+        sha = hashlib.sha1(content).hexdigest()
+        blobs.write(sha, content, 'text/html')
+        manifest_id = manifests.save(COMMIT, {'/404.html': sha})
+        manifests.set_branch_manifest(utils.DEFAULT_BRANCH, manifest_id)
+
+    def _get(self, host, path='/missing/'):
+        request = webapp2.Request.blank(path, base_url='https://' + host)
+        return request.get_response(main.app)
+
+    def test_default_branch_error_page(self):
+        response = self._get('other.example.com')
+        self.assertEqual(404, response.status_int)
+        self.assertEqual(b'default 404', response.body)
+
+    def test_routed_domain_without_manifest(self):
+        domains.set_route('www.example.com', 'site')
+        response = self._get('www.example.com')
+        self.assertEqual(404, response.status_int)
+        self.assertEqual('text/plain', response.content_type)
+        self.assertEqual(b'404\n', response.body)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+
+"""Incremental mark-and-sweep garbage collection for blobs and manifests.
+
+Every run first marks the live set: manifests that are referenced by a branch,
+by a pending timed deploy, or that were created within the retention window,
+plus every SHA those manifests reference (including the pre-compressed
+variants in their metadata). It then sweeps a bounded number of
+batches, alternating between two phases:
+
+    * "blobs": lists the blob storage and deletes blobs that are neither
+      marked nor uploaded or confirmed to exist (by `blob.exists`, for a
+      deploy that skips uploading them) within the retention window.
+    * "manifests": queries manifests older than the retention window and
+      deletes the ones that are not marked (with their pages, for manifests
+      uploaded in pages), as well as abandoned upload sessions.
+
+The listing marker and query cursor are saved after every batch, so a run that
+hits its deadline or delete limit resumes where it left off on the next cron.
+A run never deletes more than `max_deletes` blobs and manifests.
+"""
+
+import datetime
+import logging
+import time
+from fileset import config
+from fileset.server import blobs
+from fileset.server import manifests
+from fileset.server import storage
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+
+PHASE_BLOBS = 'blobs'
+PHASE_MANIFESTS = 'manifests'
+
+# Seconds a single run may spend sweeping before it saves its state and stops.
+TIME_BUDGET = 240
+
+
+class FilesetGcState(ndb.Model):
+    phase = ndb.StringProperty(default=PHASE_BLOBS)
+    blob_marker = ndb.StringProperty(indexed=False)
+    manifest_cursor = ndb.StringProperty(indexed=False)
+    last_completed = ndb.DateTimeProperty()
+    updated = ndb.DateTimeProperty(auto_now=True)
+
+
+def get_state():
+    return FilesetGcState.get_or_insert('gc')
+
+
+def mark(cutoff):
+    """Returns a tuple of `(live_manifest_keys, live_shas)`."""
+    keys = set()
+    for branch_manifest in manifests.FilesetBranchManifest.query():
+        keys.add(branch_manifest.manifest)
+    query = manifests.FilesetTimedDeploy.query(
+        manifests.FilesetTimedDeploy.deployed == None)
+    for timed_deploy in query:
+        keys.add(timed_deploy.manifest)
+    query = manifests.FilesetManifest.query(
+        manifests.FilesetManifest.created >= cutoff)
+    for key in query.iter(keys_only=True):
+        keys.add(key)
+
+    # Fetch manifests in small batches and without caching, to keep memory
+    # bounded when many manifests are within the retention window.
+    shas = set()
+    keys_list = list(keys)
+    for i in range(0, len(keys_list), 20):
+        batch = ndb.get_multi(
+            keys_list[i:i + 20], use_cache=False, use_memcache=False)
+        for manifest in batch:
+            if manifest and manifest.paths:
+                shas.update(manifest.paths.itervalues())
+                shas.update(_get_encoding_shas(manifest.meta))
+            elif manifest and manifest.num_pages:
+                for paths, meta in manifests.iter_pages(manifest):
+                    shas.update(paths.itervalues())
+                    shas.update(_get_encoding_shas(meta))
+    return keys, shas
+
+
+def _get_encoding_shas(meta):
+    """Yields the SHAs of the pre-compressed variants in a manifest's meta."""
+    for file_meta in (meta or {}).itervalues():
+        for variant in (file_meta.get('encodings') or {}).itervalues():
+            yield variant['sha']
+
+
+def run(dry_run=None, batch_size=None, max_deletes=None):
+    """Runs one bounded garbage collection pass and returns its stats."""
+    if dry_run is None:
+        dry_run = config.GC_DRY_RUN
+    batch_size = batch_size or config.GC_BATCH_SIZE
+    max_deletes = max_deletes or config.GC_MAX_DELETES
+
+    cutoff = (datetime.datetime.now()
+              - datetime.timedelta(days=config.GC_RETENTION_DAYS))
+    live_keys, live_shas = mark(cutoff)
+    stats = {
+        'dry_run': dry_run,
+        'live_manifests': len(live_keys),
+        'live_blobs': len(live_shas),
+        'deleted_blobs': 0,
+        'deleted_manifests': 0,
+        'deleted_sessions': 0,
+        'inspected': 0,
+    }
+
+    state = get_state()
+    deadline = time.time() + TIME_BUDGET
+    while time.time() < deadline and _get_num_deletes(stats) < max_deletes:
+        if state.phase == PHASE_BLOBS:
+            done = _sweep_blobs(state, live_shas, cutoff, batch_size,
+                                max_deletes, dry_run, stats)
+            if done:
+                state.phase = PHASE_MANIFESTS
+                state.blob_marker = None
+        else:
+            done = _sweep_manifests(state, live_keys, cutoff, batch_size,
+                                    max_deletes, dry_run, stats)
+            if done:
+                state.phase = PHASE_BLOBS
+                state.manifest_cursor = None
+                state.last_completed = datetime.datetime.now()
+        state.put()
+        if done and state.phase == PHASE_BLOBS:
+            # A full cycle finished; the next cycle starts on the next cron so
+            # that it marks a fresh live set.
+            break
+
+    stats['phase'] = state.phase
+    logging.info('gc: %s', stats)
+    return stats
+
+
+def _get_num_deletes(stats):
+    return stats['deleted_blobs'] + stats['deleted_manifests']
+
+
+def _sweep_blobs(state, live_shas, cutoff, batch_size, max_deletes, dry_run,
+                 stats):
+    cutoff_timestamp = time.mktime(cutoff.timetuple())
+    listing = storage.get_backend().list(
+        marker=state.blob_marker, max_keys=batch_size)
+    candidates = set(stat.sha for stat in listing
+                     if stat.sha not in live_shas
+                     and stat.created < cutoff_timestamp)
+    # Confirmations are read right before deleting, to keep blobs that a
+    # deploy was just told exist.
+    if candidates:
+        confirmed = blobs.get_confirmed(candidates)
+        candidates -= set(sha for sha, last_confirmed in confirmed.items()
+                          if last_confirmed >= cutoff)
+    for stat in listing:
+        sha = stat.sha
+        if sha in candidates:
+            if _get_num_deletes(stats) >= max_deletes:
+                return False
+            if dry_run:
+                logging.info('gc (dry run): would delete blob %s', sha)
+            else:
+                blobs.delete(sha)
+            stats['deleted_blobs'] += 1
+        stats['inspected'] += 1
+        state.blob_marker = sha
+    return len(listing) < batch_size
+
+
+def _sweep_manifests(state, live_keys, cutoff, batch_size, max_deletes,
+                     dry_run, stats):
+    query = manifests.FilesetManifest.query(
+        manifests.FilesetManifest.created < cutoff)
+    start_cursor = None
+    if state.manifest_cursor:
+        start_cursor = Cursor(urlsafe=state.manifest_cursor)
+    # Every manifest of a page may be deleted, so pages are limited to the
+    # number of deletes left.
+    page_size = min(batch_size, max_deletes - _get_num_deletes(stats))
+    keys, cursor, more = query.fetch_page(
+        page_size, start_cursor=start_cursor, keys_only=True)
+    stats['inspected'] += len(keys)
+    dead_keys = [key for key in keys if key not in live_keys]
+    if dead_keys:
+        if dry_run:
+            logging.info('gc (dry run): would delete manifests %s',
+                         [key.id() for key in dead_keys])
+        else:
+            ndb.delete_multi(dead_keys)
+            for key in dead_keys:
+                manifests.delete_pages(key.id())
+        stats['deleted_manifests'] += len(dead_keys)
+    state.manifest_cursor = cursor.urlsafe() if cursor else None
+    if not more:
+        _sweep_sessions(cutoff, batch_size, dry_run, stats)
+    return not more
+
+
+def _sweep_sessions(cutoff, batch_size, dry_run, stats):
+    """Deletes manifest upload sessions that were never committed."""
+    query = manifests.FilesetManifestSession.query(
+        manifests.FilesetManifestSession.created < cutoff)
+    keys = query.fetch(batch_size, keys_only=True)
+    for key in keys:
+        if dry_run:
+            logging.info('gc (dry run): would delete session %s', key.id())
+            continue
+        manifests.delete_pages(key.id())
+        key.delete()
+    stats['deleted_sessions'] += len(keys)
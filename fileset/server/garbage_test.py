@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+
+import datetime
+import json
+import os
+import time
+import unittest
+from fileset.server import testing
+
+testing.setup_sdk()
+
+from fileset.server import blobs
+from fileset.server import garbage
+from fileset.server import manifests
+from fileset.server import storage
+from google.appengine.api import memcache
+
+DAY = 24 * 3600
+
+
+def _sha(value):
+    return '{:040x}'.format(value)
+
+
+class GarbageTest(testing.TestCase):
+
+    def setUp(self):
+        super(GarbageTest, self).setUp()
+        self.backend = storage.LocalBackend(self.make_tempdir())
+        self.patch(storage, '_backend', self.backend)
+        self.patch(blobs, '_exists_cache', {})
+        self.patch(blobs, '_pending_confirmations', {})
+        self.cutoff = (datetime.datetime.now()
+                       - datetime.timedelta(days=garbage.config.GC_RETENTION_DAYS))
+
+    def _write_blob(self, sha, age_days):
+        self.backend.write(sha, b'content', 'text/plain')
+        timestamp = time.time() - age_days * DAY
+        os.utime(self.backend.get_path(sha), (timestamp, timestamp))
+
+    def _save_manifest(self, paths, age_days, meta=None):
+        manifest_id = manifests.save({'sha': 'commit'}, paths, meta=meta)
+        manifest = manifests.FilesetManifest.get_by_id(manifest_id)
+        manifest.created = (datetime.datetime.now()
+                            - datetime.timedelta(days=age_days))
+        manifest.put()
+        return manifest_id
+
+    def _set_branch(self, branch, manifest_id):
+        manifests.FilesetBranchManifest(
+            id=branch,
+            manifest=manifests.FilesetManifest.get_by_id(manifest_id).key,
+        ).put()
+
+    def _exists(self, sha):
+        return self.backend.exists(sha)
+
+    def test_mark(self):
+        branch_id = self._save_manifest({'/a': _sha(1)}, 60, meta={
+            '/a': {'encodings': {'gzip': {'sha': _sha(2)}}},
+        })
+        self._set_branch('master', branch_id)
+        timed_id = self._save_manifest({'/b': _sha(3)}, 60)
+        manifests.FilesetTimedDeploy(
+            id='staging', branch='staging', deploy_timestamp=0,
+            manifest=manifests.FilesetManifest.get_by_id(timed_id).key).put()
+        recent_id = self._save_manifest({'/c': _sha(4)}, 1)
+        self._save_manifest({'/d': _sha(5)}, 60)
+        # Paged manifests are marked from their pages.
+        self.patch(manifests, 'PAGE_SIZE', 1)
+        paged_id = self._save_manifest({'/e': _sha(6), '/f': _sha(7)}, 1)
+
+        keys, shas = garbage.mark(self.cutoff)
+        self.assertEqual(
+            set([branch_id, timed_id, recent_id, paged_id]),
+            set(key.id() for key in keys))
+        self.assertEqual(
+            set([_sha(1), _sha(2), _sha(3), _sha(4), _sha(6), _sha(7)]), shas)
+
+    def test_sweep_blobs(self):
+        manifest_id = self._save_manifest({'/a': _sha(1)}, 60)
+        self._set_branch('master', manifest_id)
+        self._write_blob(_sha(1), 60)
+        self._write_blob(_sha(2), 60)
+        self._write_blob(_sha(3), 1)
+
+        stats = garbage.run(dry_run=False)
+        self.assertEqual(1, stats['deleted_blobs'])
+        self.assertTrue(self._exists(_sha(1)))
+        self.assertFalse(self._exists(_sha(2)))
+        # Blobs uploaded within the retention window are kept.
+        self.assertTrue(self._exists(_sha(3)))
+
+    def test_dry_run(self):
+        self._write_blob(_sha(1), 60)
+        self._save_manifest({'/a': _sha(1)}, 60)
+        stats = garbage.run(dry_run=True)
+        self.assertEqual(1, stats['deleted_blobs'])
+        self.assertEqual(1, stats['deleted_manifests'])
+        self.assertTrue(self._exists(_sha(1)))
+        self.assertEqual(1, manifests.FilesetManifest.query().count())
+
+    def test_max_deletes(self):
+        for i in range(5):
+            self._write_blob(_sha(i), 60)
+
+        stats = garbage.run(dry_run=False, batch_size=10, max_deletes=2)
+        self.assertEqual(2, stats['deleted_blobs'])
+        self.assertEqual(garbage.PHASE_BLOBS, stats['phase'])
+        self.assertEqual(3, len(self.backend.list()))
+
+        # The next runs resume after the last deleted blob.
+        stats = garbage.run(dry_run=False, batch_size=10, max_deletes=2)
+        self.assertEqual(2, stats['deleted_blobs'])
+        self.assertEqual([_sha(4)],
+                         [stat.sha for stat in self.backend.list()])
+        stats = garbage.run(dry_run=False, batch_size=10, max_deletes=2)
+        self.assertEqual(1, stats['deleted_blobs'])
+        self.assertEqual([], self.backend.list())
+
+    def test_blob_marker_resume(self):
+        for i in range(5):
+            self._write_blob(_sha(i), 60)
+        state = garbage.get_state()
+        state.blob_marker = _sha(2)
+        state.put()
+        stats = garbage.run(dry_run=False, batch_size=2)
+        # Blobs up to the saved marker were already inspected.
+        self.assertEqual(2, stats['deleted_blobs'])
+        self.assertEqual([_sha(0), _sha(1), _sha(2)],
+                         [stat.sha for stat in self.backend.list()])
+        # The blob sweep finished, so the next cycle starts from the top.
+        state = garbage.get_state()
+        self.assertIsNone(state.blob_marker)
+        self.assertIsNotNone(state.last_completed)
+
+    def test_sweep_manifests(self):
+        live_id = self._save_manifest({'/a': _sha(1)}, 60)
+        self._set_branch('master', live_id)
+        dead_ids = [self._save_manifest({'/b': _sha(2)}, 60) for _ in range(3)]
+        recent_id = self._save_manifest({'/c': _sha(3)}, 1)
+        self.patch(manifests, 'PAGE_SIZE', 1)
+        paged_id = self._save_manifest({'/d': _sha(4), '/e': _sha(5)}, 60)
+        self.assertEqual(2, manifests.FilesetManifestPage.query().count())
+
+        state = garbage.get_state()
+        state.phase = garbage.PHASE_MANIFESTS
+        state.put()
+        stats = garbage.run(dry_run=False, batch_size=2)
+        self.assertEqual(4, stats['deleted_manifests'])
+        remaining = set(key.id() for key in
+                        manifests.FilesetManifest.query().iter(keys_only=True))
+        self.assertEqual(set([live_id, recent_id]), remaining)
+        self.assertNotIn(paged_id, remaining)
+        for dead_id in dead_ids:
+            self.assertNotIn(dead_id, remaining)
+        self.assertEqual(0, manifests.FilesetManifestPage.query().count())
+
+    def test_manifest_cursor_resume(self):
+        for _ in range(4):
+            self._save_manifest({'/a': _sha(1)}, 60)
+        state = garbage.get_state()
+        state.phase = garbage.PHASE_MANIFESTS
+        state.put()
+
+        stats = garbage.run(dry_run=False, batch_size=10, max_deletes=3)
+        self.assertEqual(3, stats['deleted_manifests'])
+        self.assertEqual(garbage.PHASE_MANIFESTS, stats['phase'])
+        self.assertIsNotNone(garbage.get_state().manifest_cursor)
+        self.assertEqual(1, manifests.FilesetManifest.query().count())
+
+        stats = garbage.run(dry_run=False, batch_size=10, max_deletes=3)
+        self.assertEqual(1, stats['deleted_manifests'])
+        self.assertEqual(0, manifests.FilesetManifest.query().count())
+        self.assertIsNone(garbage.get_state().manifest_cursor)
+
+    def test_sweep_sessions(self):
+        session_id = manifests.begin_session({'sha': 'commit'})
+        manifests.append_page(session_id, 0, {'/a': _sha(1)})
+        session = manifests.FilesetManifestSession.get_by_id(session_id)
+        session.created = self.cutoff - datetime.timedelta(days=1)
+        session.put()
+        recent_id = manifests.begin_session({'sha': 'commit'})
+
+        state = garbage.get_state()
+        state.phase = garbage.PHASE_MANIFESTS
+        state.put()
+        stats = garbage.run(dry_run=False)
+        self.assertEqual(1, stats['deleted_sessions'])
+        self.assertIsNone(manifests.FilesetManifestSession.get_by_id(session_id))
+        self.assertIsNotNone(
+            manifests.FilesetManifestSession.get_by_id(recent_id))
+        self.assertEqual(0, manifests.FilesetManifestPage.query().count())
+
+    def test_confirmation_window(self):
+        for i in range(3):
+            self._write_blob(_sha(i), 60)
+        # Confirmed by blob.exists, and not yet written to the datastore.
+        self.assertTrue(blobs.exists(_sha(0)))
+        # Confirmed and written.
+        self.assertTrue(blobs.exists(_sha(1)))
+        blobs.flush_confirmations(force=True)
+        for task in self.get_tasks(blobs.CONFIRM_TASK_URL):
+            blobs.save_confirmations(json.loads(task.payload))
+        memcache.delete(blobs.CONFIRMED_KEY_PREFIX + _sha(1))
+        # Confirmed before the retention window.
+        blobs.FilesetBlobConfirmation(
+            id=_sha(2),
+            confirmed=self.cutoff - datetime.timedelta(days=1)).put()
+
+        stats = garbage.run(dry_run=False)
+        self.assertEqual(1, stats['deleted_blobs'])
+        self.assertTrue(self._exists(_sha(0)))
+        self.assertTrue(self._exists(_sha(1)))
+        self.assertFalse(self._exists(_sha(2)))
+        self.assertIsNone(blobs.FilesetBlobConfirmation.get_by_id(_sha(2)))
+
+
+class ConfirmTest(testing.TestCase):
+
+    def setUp(self):
+        super(ConfirmTest, self).setUp()
+        self.backend = storage.LocalBackend(self.make_tempdir())
+        self.patch(storage, '_backend', self.backend)
+        self.patch(blobs, '_exists_cache', {})
+        self.patch(blobs, '_pending_confirmations', {})
+        self.patch(blobs, '_last_confirm_flush', time.time())
+
+    def test_exists_doesnt_write(self):
+        for i in range(3):
+            self.backend.write(_sha(i), b'content', 'text/plain')
+            self.assertTrue(blobs.exists(_sha(i)))
+            blobs.flush_confirmations()
+        self.assertFalse(blobs.exists(_sha(9)))
+        self.assertEqual(0, blobs.FilesetBlobConfirmation.query().count())
+        self.assertEqual([], self.get_tasks())
+        # Confirmed blobs are visible to the garbage collector right away.
+        self.assertEqual(
+            set([_sha(0), _sha(1), _sha(2)]),
+            set(blobs.get_confirmed([_sha(i) for i in range(10)])))
+
+    def test_flush_batches(self):
+        self.patch(blobs, 'CONFIRM_BATCH_SIZE', 2)
+        for i in range(3):
+            self.backend.write(_sha(i), b'content', 'text/plain')
+            blobs.exists(_sha(i))
+        # Blobs are only confirmed once per interval.
+        blobs.exists(_sha(0))
+        blobs.flush_confirmations()
+        tasks = self.get_tasks(blobs.CONFIRM_TASK_URL)
+        self.assertEqual(2, len(tasks))
+        confirmations = []
+        for task in tasks:
+            confirmations.extend(json.loads(task.payload))
+        self.assertEqual([_sha(0), _sha(1), _sha(2)],
+                         sorted(sha for sha, _ in confirmations))
+
+        blobs.save_confirmations(confirmations)
+        self.assertEqual(3, blobs.FilesetBlobConfirmation.query().count())
+        memcache.flush_all()
+        self.assertEqual(
+            set([_sha(0), _sha(1), _sha(2)]),
+            set(blobs.get_confirmed([_sha(i) for i in range(3)])))
+
+
+if __name__ == '__main__':
+    unittest.main()
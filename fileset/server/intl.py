@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+
+"""Internationalized path fallbacks.
+
+Shared by the webapp2 handler in `main.py` and the asyncio engine in
+`asgi.py`, so functions here only take plain values (no request objects).
+"""
+
+import collections
+import re
+from fileset import config
+from fileset.server import country_langs
+try:
+    from urllib.parse import parse_qsl
+    from urllib.parse import urlencode
+except ImportError:
+    from urllib import urlencode
+    from urlparse import parse_qsl
+
+DEFAULT_LANG = 'en'
+DEFAULT_COUNTRY = 'US'
+ES_419_COUNTRIES = frozenset([
+    'AR',
+    'BO',
+    'CL',
+    'CO',
+    'CR',
+    'DO',
+    'EC',
+    'FK',
+    'GF',
+    'GT',
+    'GY',
+    'HN',
+    'MX',
+    'NI',
+    'PA',
+    'PE',
+    'PR',
+    'PY',
+    'SR',
+    'SV',
+    'UY',
+    'VE',
+])
+
+# Cache-Control for responses that depend on the user's language and country
+# (with INTL_REDIRECTS), so that shared caches don't store them.
+PRIVATE_CACHE_CONTROL = 'private, max-age=0'
+
+# Matches the `{locale}` part of localized paths, e.g. "fr", "fr_ca",
+# "es-419" or "zh-hant-tw", so that other path segments (e.g. "/intl/assets/")
+# aren't mistaken for locales.
+LOCALE_PATTERN = r'[a-zA-Z]{2,3}(?:[_-][a-zA-Z0-9]{2,8})*'
+
+# Matches localized paths, built from INTL_PATH_FORMAT on first use.
+_intl_path_re = None
+
+LANG_FALLBACKS = {
+    'zh-cn': ('zh-hans', 'zh-hant', 'zh'),
+    'zh-hk': ('zh-hant', 'zh'),
+    'zh-tw': ('zh-hant', 'zh'),
+}
+
+
+def generate_intl_paths(path, hl='', accept_language=None, country=None):
+    """Generates a list of paths based on user's country & preferred langs.
+
+    For example, if a user is based in Canada and their browser's language
+    settings are:
+        - fr
+        - en
+
+    Then requests for /foo/ would yield the following paths:
+        - /intl/fr_ca/foo/
+        - /intl/en_ca/foo/
+        - /intl/fr/foo/
+        - /intl/en/foo/
+        - /foo/
+
+    If ?hl= query param is in the URL, the hl value will be prioritized
+    above other paths. For example, for /foo/?hl=de-DE:
+        - /intl/de-de_ca/foo/
+        - /intl/de_ca/foo/
+        - /intl/fr_ca/foo/
+        - /intl/en_ca/foo/
+        - /intl/de-de/foo/
+        - /intl/de/foo/
+        - /intl/fr/foo/
+        - /intl/en/foo/
+        - /foo/
+
+    In cases where a user prefers "en" but also has other languages in their
+    Accept-Language header, the root path is yielded in place of en, e.g.:
+
+        Accept-Language: en; fr
+
+    Would yield:
+        - /intl/en/foo/
+        - /foo/
+        - /intl/fr/foo/
+    """
+    country = (country or DEFAULT_COUNTRY).lower()
+    fallback_langs = get_fallback_langs(
+        hl=hl, accept_language=accept_language, country=country)
+
+    # Yield `/intl/<lang>_<country>/` paths (with country).
+    for lang in fallback_langs:
+        locale = '{}_{}'.format(lang, country)
+        yield config.INTL_PATH_FORMAT.format(locale=locale, path=path)
+        # For language variants like "zh-hant", try "zh_hant_<country>".
+        if '-' in lang:
+            locale = '{}_{}'.format(lang.replace('-', '_'), country)
+            yield config.INTL_PATH_FORMAT.format(locale=locale, path=path)
+
+    # Yield `/intl/<lang>/` paths (no country).
+    for lang in fallback_langs:
+        locale = lang
+        yield config.INTL_PATH_FORMAT.format(locale=locale, path=path)
+        # For dashed language variants like "pt-br", yield "pt_br".
+        if '-' in lang:
+            locale = lang.replace('-', '_')
+            yield config.INTL_PATH_FORMAT.format(locale=locale, path=path)
+        # For the default lang, yield the root path.
+        if lang == DEFAULT_LANG:
+            yield path
+
+
+def get_fallback_langs(hl='', accept_language=None, country=None):
+    """Returns an ordered list of languages to serve to the user.
+
+    The languages are determined by the following (in order):
+
+        - The ?hl= query parameter
+        - The browser's Accept-Language header
+        - The country's de-facto languages
+        - The site's default language ("en")
+    """
+    # Use OrderedDict so that duplicates are automatically removed, while
+    # preserving order.
+    fallback_langs = collections.OrderedDict()
+
+    # Add language from ?hl= query parameter.
+    hl = (hl or '').lower()
+    if hl:
+        fallback_langs[hl] = True
+        if '-' in hl:
+            hl_lang = hl.split('-', 1)[0]
+            fallback_langs[hl_lang] = True
+
+    # Add languages from the Accept-Language header.
+    if accept_language:
+        for value in parse_accept_language(accept_language):
+            accept_lang = value.lower()
+            fallback_langs[accept_lang] = True
+
+            # Some langs (e.g. "zh-tw") should fall back to special language
+            # variants (e.g. "zh-hant").
+            for fallback_lang in LANG_FALLBACKS.get(accept_lang, []):
+                fallback_langs[fallback_lang] = True
+
+    # Add the user's country's de-facto languages.
+    if country:
+        country_langs = get_country_langs(country)
+        for country_lang in country_langs:
+            lang = country_lang.lower()
+            fallback_langs[lang] = True
+
+    # Add "en" as the final fallback.
+    if DEFAULT_LANG not in fallback_langs:
+        fallback_langs[DEFAULT_LANG] = True
+
+    return list(fallback_langs.keys())
+
+
+def parse_accept_language(value):
+    """Returns the language ranges of an Accept-Language header, in order.
+
+    Quality values are ignored, matching the behavior of webob's parser that
+    was used previously.
+    """
+    for part in value.split(','):
+        lang = part.split(';', 1)[0].strip()
+        if lang:
+            yield lang
+
+
+def get_country_langs(country):
+    """Returns the de-facto languages for a country."""
+    # Special overrides for Chinese-speaking countries.
+    if country == 'cn':
+        return ('zh-cn', 'zh-hans', 'zh-hant', 'zh')
+    if country == 'hk':
+        return ('zh-hk', 'zh-hant', 'zh')
+    if country == 'tw':
+        return ('zh-tw', 'zh-hant', 'zh')
+
+    # De-facto languages from babel's CLDR data, generated ahead of time by
+    # scripts/generate_country_langs.py so that babel isn't imported here.
+    langs = list(country_langs.COUNTRY_LANGS.get(country.lower(), ()))
+
+    # Add es-419 for Latin American countries.
+    if country in ES_419_COUNTRIES:
+        langs.append('es-419')
+
+    return langs
+
+
+def parse_intl_path(path):
+    """Returns `(locale, path)` for a localized path, or `(None, path)`."""
+    global _intl_path_re
+    if _intl_path_re is None:
+        pattern = re.escape(config.INTL_PATH_FORMAT)
+        pattern = pattern.replace(
+            re.escape('{locale}'), '(?P<locale>{})'.format(LOCALE_PATTERN))
+        pattern = pattern.replace(re.escape('{path}'), r'(?P<path>/.*)')
+        _intl_path_re = re.compile('^{}$'.format(pattern))
+    match = _intl_path_re.match(path)
+    if not match:
+        return None, path
+    return match.group('locale'), match.group('path')
+
+
+def get_localized_paths(paths):
+    """Returns the set of paths that have at least one localized variant."""
+    localized_paths = set()
+    for path in paths:
+        locale, base_path = parse_intl_path(path)
+        if locale:
+            localized_paths.add(base_path)
+    return localized_paths
+
+
+def get_content_language(locale):
+    """Returns the Content-Language for a locale, e.g. "fr_ca" => "fr-CA"."""
+    parts = re.split('[_-]', locale)
+    tags = [parts[0].lower()]
+    for part in parts[1:]:
+        if len(part) == 2:
+            tags.append(part.upper())
+        elif len(part) == 4:
+            tags.append(part.title())
+        else:
+            tags.append(part.lower())
+    return '-'.join(tags)
+
+
+def get_redirect_url(locale, path, query_string=''):
+    """Returns the localized URL to redirect a request to.
+
+    The ?hl= query param is dropped, since the locale is part of the URL.
+    """
+    url = config.INTL_PATH_FORMAT.format(locale=locale, path=path)
+    params = [(key, value) for key, value in parse_qsl(
+        query_string or '', keep_blank_values=True) if key != 'hl']
+    if params:
+        url = '{}?{}'.format(url, urlencode(params))
+    return url
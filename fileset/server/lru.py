@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+
+import collections
+import threading
+
+
+class LruCache(object):
+    """Thread-safe LRU cache bounded by the total weight of its values.
+
+    By default every value weighs 1, so `max_weight` is the number of entries.
+    Pass `weigh` to bound the cache by an estimate of memory use instead.
+    Values heavier than `max_weight` aren't cached, unless `keep_oversized`
+    is set, in which case such a value evicts all others and is cached alone.
+    """
+
+    def __init__(self, max_weight, weigh=None, keep_oversized=False):
+        self.max_weight = max_weight
+        self.weigh = weigh or (lambda value: 1)
+        self.keep_oversized = keep_oversized
+        self.weight = 0
+        self._lock = threading.Lock()
+        self._values = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._values)
+
+    def __contains__(self, key):
+        return key in self._values
+
+    def values(self):
+        with self._lock:
+            return [entry[0] for entry in self._values.values()]
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._values.pop(key, None)
+            if entry is None:
+                return default
+            # Re-insert the entry to mark it as most recently used.
+            self._values[key] = entry
+            return entry[0]
+
+    def set(self, key, value):
+        weight = self.weigh(value)
+        if weight > self.max_weight and not self.keep_oversized:
+            return
+        with self._lock:
+            old_entry = self._values.pop(key, None)
+            if old_entry is not None:
+                self.weight -= old_entry[1]
+            self._values[key] = (value, weight)
+            self.weight += weight
+            while self.weight > self.max_weight and len(self._values) > 1:
+                _, (_, evicted_weight) = self._values.popitem(last=False)
+                self.weight -= evicted_weight
+
+    def delete(self, key):
+        with self._lock:
+            entry = self._values.pop(key, None)
+            if entry is not None:
+                self.weight -= entry[1]
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+            self.weight = 0
@@ -2,64 +2,22 @@
 
 import appengine_config
 
-import collections
-import logging
+import mimetypes
 import os
+import time
 import urllib
 from fileset import config
+from fileset import filemeta
 from fileset.server import blobs
+from fileset.server import intl
 from fileset.server import manifests
 from fileset.server import redirects
+from fileset.server import stats
+from fileset.server import timing
 from fileset.server import utils
-from google.appengine.ext.blobstore import blobstore
 from google.appengine.ext.webapp import blobstore_handlers
-from webob import acceptparse
 import webapp2
 
-# Babel dependency was added in a later release. To prevent projects from
-# breaking when they upgrade, use a conditional import to ensure backwards
-# compatibility.
-try:
-    import babel
-    from babel import languages
-except ImportError:
-    babel = None
-    logging.error('babel not imported. update the following line in app.yaml:')
-    logging.error(
-        '- ^extensions/(?!(__init__.py|babel|cloudstorage|fileset)).*')
-
-DEFAULT_LANG = 'en'
-ES_419_COUNTRIES = frozenset([
-    'AR',
-    'BO',
-    'CL',
-    'CO',
-    'CR',
-    'DO',
-    'EC',
-    'FK',
-    'GF',
-    'GT',
-    'GY',
-    'HN',
-    'MX',
-    'NI',
-    'PA',
-    'PE',
-    'PR',
-    'PY',
-    'SR',
-    'SV',
-    'UY',
-    'VE',
-])
-
-LANG_FALLBACKS = {
-    'zh-cn': ('zh-hans', 'zh-hant', 'zh'),
-    'zh-hk': ('zh-hant', 'zh'),
-    'zh-tw': ('zh-hant', 'zh'),
-}
-
 
 class MainHandler(blobstore_handlers.BlobstoreDownloadHandler):
 
@@ -86,7 +44,9 @@ class MainHandler(blobstore_handlers.BlobstoreDownloadHandler):
                 for key, value in html_headers.iteritems():
                     self.response.headers[key] = value
 
-        manifest = self.get_manifest()
+        timer = timing.get_timer(self.request.environ)
+        with timer.stage('manifest'):
+            manifest = self.get_manifest()
         if not manifest:
             return self.serve_error(404)
 
@@ -96,18 +56,72 @@ class MainHandler(blobstore_handlers.BlobstoreDownloadHandler):
 
         # Get the SHA of the file to serve from the manifest.
         sha = None
-        if path.endswith('.html'):
-            # Check intl fallbacks based on user's country and preferred langs.
-            for intl_path in self.generate_intl_paths(path):
-                sha = manifest.paths.get(intl_path)
-                if sha:
-                    break
+        cache_control = None
+        if path.endswith('.html') and config.INTL_REDIRECTS:
+            locale, base_path = intl.parse_intl_path(path)
+            if locale or base_path not in manifest.localized_paths:
+                # The response doesn't depend on the user's language, so it
+                # can be cached by a CDN.
+                sha = manifest.paths.get(path)
+                cache_control = config.INTL_CACHE_CONTROL
+                if locale:
+                    self.response.headers['Content-Language'] = (
+                        intl.get_content_language(locale))
+            else:
+                sha, path = self.negotiate_path(manifest, path)
+                cache_control = intl.PRIVATE_CACHE_CONTROL
+                utils.add_vary(self.response.headers, 'Accept-Language')
+                locale, _ = intl.parse_intl_path(path)
+                if sha and locale:
+                    stats.incr('intl_redirects')
+                    self.response.headers['Cache-Control'] = cache_control
+                    return self.redirect(intl.get_redirect_url(
+                        locale, self.request.path, self.request.query_string))
+        elif path.endswith('.html'):
+            sha, path = self.negotiate_path(manifest, path)
         else:
             sha = manifest.paths.get(path)
 
         if not sha:
             return self.serve_error(404, manifest=manifest)
 
+        # Responses for a manifest addressed by id never change (unless they
+        # were negotiated for the user with INTL_REDIRECTS).
+        if (self.is_immutable_manifest()
+                and cache_control != intl.PRIVATE_CACHE_CONTROL):
+            self.response.headers['Cache-Control'] = (
+                config.MANIFEST_CACHE_CONTROL)
+        elif cache_control:
+            self.response.headers['Cache-Control'] = cache_control
+
+        # Metadata is only available for manifests uploaded by newer clients.
+        meta = manifest.get_meta(path)
+        content_type = (meta.get('content_type')
+                        or mimetypes.guess_type(path)[0])
+        size = meta.get('size')
+
+        # WSGI has no way to send informational responses, so 103 Early Hints
+        # are left to CDNs and frontends that derive them from this header
+        # (asgi.py sends them itself where the ASGI server supports it).
+        if config.PRELOAD_LINKS and meta.get('preload'):
+            self.response.headers['Link'] = ', '.join(
+                utils.get_preload_links(meta['preload']))
+
+        # Serve a pre-compressed variant if the client accepts it. Range
+        # requests always get the original file.
+        encodings = meta.get('encodings')
+        if encodings:
+            utils.add_vary(self.response.headers, 'Accept-Encoding')
+            encoding = None
+            if not self.request.headers.get('Range'):
+                encoding = utils.get_accepted_encoding(
+                    self.request.headers.get('Accept-Encoding'),
+                    [name for name in filemeta.ENCODINGS if name in encodings])
+            if encoding:
+                self.response.headers['Content-Encoding'] = encoding
+                sha = encodings[encoding]['sha']
+                size = encodings[encoding].get('size')
+
         etag = '"{sha}"'.format(sha=sha)
         request_etag = self.request.headers.get('If-None-Match')
         if etag == request_etag:
@@ -115,17 +129,37 @@ class MainHandler(blobstore_handlers.BlobstoreDownloadHandler):
             return
         self.response.headers['ETag'] = etag
 
-        if self.request.method != 'HEAD':
-            gcs_path = blobs.get_gcs_path(sha)
-            blob_key = blobstore.create_gs_key('/gs' + gcs_path)
-            self.send_blob(blob_key)
+        if size is not None and self.request.range is not None:
+            if self.request.range.range_for_length(size) is None:
+                self.response.status = 416
+                self.response.headers['Content-Range'] = 'bytes */{}'.format(
+                    size)
+                return
+
+        # Answer HEAD requests from the manifest, without touching storage.
+        if self.request.method == 'HEAD':
+            if content_type:
+                self.response.headers['Content-Type'] = content_type
+            if size is not None:
+                self.response.headers['Content-Length'] = str(size)
+            return
+
+        # Bodies handed off to storage (e.g. GCS via send_blob) are sent after
+        # the handler returns, so only their dispatch is timed.
+        start = time.time()
+        written = blobs.serve(self, sha, content_type=content_type)
+        timer.record('blob' if written else 'blob_dispatch', time.time() - start)
 
     def serve_error(self, error_code, manifest=None):
         self.response.status = error_code
+        if error_code == 404:
+            stats.incr('not_found')
         _, ext = os.path.splitext(self.request.path)
         if not ext or ext == '.html':
             html_path = '/{}.html'.format(error_code)
-            if not manifest:
+            # Branches without a manifest use the default branch's error
+            # pages, except for routed domains, which are separate sites.
+            if not manifest and not utils.is_routed(self.request):
                 manifest = manifests.get_branch_manifest(utils.DEFAULT_BRANCH)
             if manifest and html_path in manifest.paths:
                 self.response.headers['Content-Type'] = 'text/html'
@@ -133,7 +167,9 @@ class MainHandler(blobstore_handlers.BlobstoreDownloadHandler):
                     # The blobstore download handler raises an error whenever
                     # the status code is anything other than 200, so write the
                     # contents of the {code}.html file directly to response.
-                    content = self.read_path(html_path, manifest=manifest)
+                    timer = timing.get_timer(self.request.environ)
+                    with timer.stage('blob'):
+                        content = self.read_path(html_path, manifest=manifest)
                     self.response.out.write(content)
                 return
 
@@ -146,151 +182,67 @@ class MainHandler(blobstore_handlers.BlobstoreDownloadHandler):
             manifest = self.get_manifest()
         if manifest and path in manifest.paths:
             sha = manifest.paths[path]
-            return blobs.read(sha)
+            content_type = (manifest.get_meta(path).get('content_type')
+                            or mimetypes.guess_type(path)[0])
+            return blobs.read(sha, content_type=content_type)
         return None
 
     def get_manifest(self):
         """Returns the manifest for the given request."""
+        manifest_id = self.get_manifest_id()
+        if manifest_id is not None:
+            return manifests.get(manifest_id)
+        branch = utils.get_branch(self.request)
+        return manifests.get_branch_manifest(branch)
+
+    def get_manifest_id(self):
+        """Returns the manifest id for `manifest-<id>` hosts, or None."""
         branch = utils.get_branch(self.request)
         if branch.startswith('manifest-') and branch[9:].isdigit():
-            manifest_id = int(branch[9:])
-            manifest = manifests.get(manifest_id)
-        else:
-            manifest = manifests.get_branch_manifest(branch)
-        return manifest
+            return int(branch[9:])
+        return None
+
+    def is_immutable_manifest(self):
+        return self.get_manifest_id() is not None
+
+    def negotiate_path(self, manifest, path):
+        """Returns the SHA and path of the best localized variant of a path."""
+        # Check intl fallbacks based on user's country and preferred langs.
+        timer = timing.get_timer(self.request.environ)
+        sha = None
+        with timer.stage('intl'):
+            probes = 0
+            for intl_path in self.generate_intl_paths(path):
+                probes += 1
+                sha = manifest.paths.get(intl_path)
+                if sha:
+                    path = intl_path
+                    break
+        stats.incr('intl_lookups')
+        stats.incr('intl_probes', probes)
+        return sha, path
 
     def generate_intl_paths(self, path):
         """Generates a list of paths based on user's country & preferred langs.
 
-        For example, if a user is based in Canada and their browser's language
-        settings are:
-            - fr
-            - en
-
-        Then requests for /foo/ would yield the following paths:
-            - /intl/fr_ca/foo/
-            - /intl/en_ca/foo/
-            - /intl/fr/foo/
-            - /intl/en/foo/
-            - /foo/
-
-        If ?hl= query param is in the URL, the hl value will be prioritized
-        above other paths. For example, for /foo/?hl=de-DE:
-            - /intl/de-de_ca/foo/
-            - /intl/de_ca/foo/
-            - /intl/fr_ca/foo/
-            - /intl/en_ca/foo/
-            - /intl/de-de/foo/
-            - /intl/de/foo/
-            - /intl/fr/foo/
-            - /intl/en/foo/
-            - /foo/
-
-        In cases where a user prefers "en" but also has other languages in their
-        Accept-Language header, the root path is yielded in place of en, e.g.:
-
-            Accept-Language: en; fr
-
-        Would yield:
-            - /intl/en/foo/
-            - /foo/
-            - /intl/fr/foo/
+        See `intl.generate_intl_paths` for details.
         """
-        hl = self.request.get('hl', '').lower()
-        country_header = self.request.headers.get('X-AppEngine-Country') or 'US'
-        country = country_header.lower()
-        fallback_langs = self.get_fallback_langs(country=country)
-
-        # Yield `/intl/<lang>_<country>/` paths (with country).
-        for lang in fallback_langs:
-            locale = '{}_{}'.format(lang, country)
-            yield config.INTL_PATH_FORMAT.format(locale=locale, path=path)
-            # For language variants like "zh-hant", try "zh_hant_<country>".
-            if '-' in lang:
-                locale = '{}_{}'.format(lang.replace('-', '_'), country)
-                yield config.INTL_PATH_FORMAT.format(locale=locale, path=path)
-
-        # Yield `/intl/<lang>/` paths (no country).
-        for lang in fallback_langs:
-            locale = lang
-            yield config.INTL_PATH_FORMAT.format(locale=locale, path=path)
-            # For dashed language variants like "pt-br", yield "pt_br".
-            if '-' in lang:
-                locale = lang.replace('-', '_')
-                yield config.INTL_PATH_FORMAT.format(locale=locale, path=path)
-            # For the default lang, yield the root path.
-            if lang == DEFAULT_LANG:
-                yield path
+        return intl.generate_intl_paths(
+            path,
+            hl=self.request.get('hl', ''),
+            accept_language=self.request.headers.get('Accept-Language'),
+            country=self.request.headers.get('X-AppEngine-Country'))
 
     def get_fallback_langs(self, country=None):
-        """Returns an ordered list of languages to serve to the user.
-
-        The languages are determined by the following (in order):
-
-            - The ?hl= query parameter
-            - The browser's Accept-Language header
-            - The country's de-facto languages
-            - The site's default language ("en")
-        """
-        # Use OrderedDict so that duplicates are automatically removed, while
-        # preserving order.
-        fallback_langs = collections.OrderedDict()
-
-        # Add language from ?hl= query parameter.
-        hl = self.request.get('hl', '').lower()
-        if hl:
-            fallback_langs[hl] = True
-            if '-' in hl:
-                hl_lang = hl.split('-', 1)[0]
-                fallback_langs[hl_lang] = True
-
-        # Add languages from the Accept-Language header.
-        accept_lang_value = self.request.headers.get('Accept-Language')
-        if accept_lang_value:
-            for value, _ in acceptparse.Accept.parse(accept_lang_value):
-                accept_lang = value.lower()
-                fallback_langs[accept_lang] = True
-
-                # Some langs (e.g. "zh-tw") should fall back to special language
-                # variants (e.g. "zh-hant").
-                for fallback_lang in LANG_FALLBACKS.get(accept_lang, []):
-                    fallback_langs[fallback_lang] = True
-
-        # Add the user's country's de-facto languages.
-        if country:
-            country_langs = self.get_country_langs(country)
-            for country_lang in country_langs:
-                lang = country_lang.lower()
-                fallback_langs[lang] = True
-
-        # Add "en" as the final fallback.
-        if DEFAULT_LANG not in fallback_langs:
-            fallback_langs[DEFAULT_LANG] = True
-
-        return fallback_langs.keys()
+        """Returns an ordered list of languages to serve to the user."""
+        return intl.get_fallback_langs(
+            hl=self.request.get('hl', ''),
+            accept_language=self.request.headers.get('Accept-Language'),
+            country=country)
 
     def get_country_langs(self, country):
         """Returns the de-facto languages for a country."""
-        # Special overrides for Chinese-speaking countries.
-        if country == 'cn':
-            return ('zh-cn', 'zh-hans', 'zh-hant', 'zh')
-        if country == 'hk':
-            return ('zh-hk', 'zh-hant', 'zh')
-        if country == 'tw':
-            return ('zh-tw', 'zh-hant', 'zh')
-
-        # If babel is enabled, return the de-facto langauges for the country.
-        if babel:
-            country_langs = languages.get_official_languages(
-                country, de_facto=True)
-        else:
-            country_langs = []
-
-        # Add es-419 for Latin American countries.
-        if country in ES_419_COUNTRIES:
-            country_langs.append('es-419')
-
-        return country_langs
+        return intl.get_country_langs(country)
 
 
 app = redirects.RedirectMiddleware(webapp2.WSGIApplication([
@@ -1,28 +1,142 @@
 #!/usr/bin/env python
 
 import datetime
+import json
 import logging
+import re
 import time
+import zlib
+from fileset import config
+from fileset import merkle
+from fileset.server import intl
+from fileset.server import lru
+from fileset.server import singleflight
+from fileset.server import stats
+from google.appengine.api import memcache
 from google.appengine.ext import ndb
 
+# Pages of manifests uploaded in a session are stored as separate entities,
+# which are limited to 1MB each. Pages are loaded a few at a time to keep
+# memory bounded.
+MAX_PAGE_BYTES = 1000 * 1000
+PAGE_BATCH_SIZE = 10
+
+# Manifests saved by the server with more paths are stored in pages.
+PAGE_SIZE = 5000
+
+# Seconds before a timed deploy at which its manifest is loaded into caches.
+PREWARM_SECONDS = 30
+
+# Branch manifests are published to memcache so that instances pick up a
+# branch switch with a single round trip instead of each one querying the
+# datastore. The branch key points at the manifest (with a version counter)
+# and the manifest itself is stored as compressed JSON, split into chunks.
+BRANCH_KEY_PREFIX = 'fs-branch:'
+BRANCH_VERSION_KEY_PREFIX = 'fs-branch-version:'
+BRANCH_LEASE_KEY_PREFIX = 'fs-branch-lease:'
+MANIFEST_CHUNK_KEY = 'fs-manifest:{}:{}'
+
+# Memcache values are limited to 1MB.
+CHUNK_SIZE = 1000 * 1000
+
+# Seconds before a branch pointer expires and is reloaded from the datastore,
+# bounding how long a stale pointer (e.g. from a failed memcache write) can be
+# served.
+BRANCH_POINTER_SECONDS = 60
+
+# Seconds an instance may hold the lease to load a branch manifest from the
+# datastore. Other instances wait for it to be published instead of also
+# querying the datastore.
+LEASE_SECONDS = 10
+LEASE_WAIT_SECONDS = 0.05
+LEASE_WAIT_TRIES = 20
+
+# Manifests are immutable once saved, so manifests loaded by id and the
+# branch manifests published to memcache share one in-process cache, bounded
+# by the total number of paths. A manifest larger than the whole budget is
+# still kept (alone), since the branch serving it needs it on every request.
+_manifest_cache = lru.LruCache(
+    config.MANIFEST_CACHE_MAX_PATHS,
+    weigh=lambda manifest: len(manifest.paths or ()),
+    keep_oversized=True)
+
+# Map of manifest id => merkle.Tree, for clients comparing manifests.
+_tree_cache = lru.LruCache(4)
+
+# Coalesces concurrent loads of the same manifest within this instance.
+_get_flights = singleflight.Group('manifests.get')
+_tree_flights = singleflight.Group('manifests.get_tree')
+_branch_flights = singleflight.Group('manifests.get_branch_manifest')
+
+
+def _get_memory_footprint():
+    return sum(stats.estimate_paths_size(manifest.paths)
+               for manifest in _manifest_cache.values())
+
+
+stats.register_gauge('manifest_cache_entries', lambda: len(_manifest_cache))
+stats.register_gauge('manifest_cache_paths', lambda: _manifest_cache.weight)
+stats.register_gauge('manifest_bytes_estimate', _get_memory_footprint)
+
+
+class Error(Exception):
+    pass
+
 
 class FilesetManifest(ndb.Model):
     commit = ndb.JsonProperty()
     paths = ndb.JsonProperty()
+    # Map of path => metadata sent by the client (see `filemeta.clean()`), for
+    # paths that have any. Older manifests don't have metadata.
+    meta = ndb.JsonProperty(compressed=True)
+    # For manifests uploaded in a session, the number of FilesetManifestPage
+    # entities that hold the paths and metadata instead of the properties
+    # above (see `load_pages()`).
+    num_pages = ndb.IntegerProperty()
     created = ndb.DateTimeProperty(auto_now_add=True)
 
+    _localized_paths = None
+
     @property
     def id(self):
         if not self.key:
             return None
         return self.key.id()
 
+    @property
+    def localized_paths(self):
+        """The set of paths that have localized variants (see intl.py)."""
+        if self._localized_paths is None:
+            self._localized_paths = intl.get_localized_paths(self.paths or ())
+        return self._localized_paths
+
+    def get_meta(self, path):
+        """Returns the metadata for a path, or an empty dict."""
+        if not self.meta:
+            return {}
+        return self.meta.get(path) or {}
+
     def json(self):
         return {
             'paths': self.paths,
         }
 
 
+class FilesetManifestSession(ndb.Model):
+    # Keyed by the id reserved for the manifest. Deleted once committed.
+    commit = ndb.JsonProperty()
+    created = ndb.DateTimeProperty(auto_now_add=True)
+
+
+class FilesetManifestPage(ndb.Model):
+    # Keyed by "<manifest id>:<page index>". Pages are root entities so that
+    # they can be written in parallel.
+    manifest_id = ndb.IntegerProperty(required=True)
+    # JSON of {"paths": ..., "meta": ...}.
+    data = ndb.BlobProperty(compressed=True)
+    created = ndb.DateTimeProperty(auto_now_add=True)
+
+
 class FilesetBranchManifest(ndb.Model):
     # Keyed by the name of the branch.
     manifest = ndb.KeyProperty(kind='FilesetManifest', required=True)
@@ -37,17 +151,188 @@ class FilesetTimedDeploy(ndb.Model):
 
 
 def get(manifest_id):
-    return FilesetManifest.get_by_id(manifest_id)
+    manifest = _manifest_cache.get(manifest_id)
+    if manifest is not None:
+        stats.incr('manifest_cache_hits')
+    else:
+        stats.incr('manifest_cache_misses')
+        manifest = _get_flights.do(manifest_id, _get_by_id, manifest_id)
+        if manifest is not None:
+            _manifest_cache.set(manifest_id, manifest)
+    return manifest
+
 
+def _get_by_id(manifest_id):
+    return load_pages(FilesetManifest.get_by_id(manifest_id))
 
-def save(commit, paths):
+
+def save(commit, paths, meta=None):
+    if len(paths) > PAGE_SIZE:
+        return _save_pages(commit, paths, meta)
     manifest = FilesetManifest()
     manifest.commit = commit
     manifest.paths = paths
+    manifest.meta = meta or None
     manifest.put()
     return manifest.id
 
 
+def _save_pages(commit, paths, meta):
+    manifest_id = begin_session(commit)
+    meta = meta or {}
+    sorted_paths = sorted(paths)
+    num_pages = 0
+    for i in range(0, len(sorted_paths), PAGE_SIZE):
+        page_paths = dict((path, paths[path])
+                          for path in sorted_paths[i:i + PAGE_SIZE])
+        page_meta = dict((path, meta[path])
+                         for path in page_paths if path in meta)
+        append_page(manifest_id, num_pages, page_paths, meta=page_meta)
+        num_pages += 1
+    return commit_session(manifest_id, num_pages)
+
+
+def get_tree(manifest_id):
+    """Returns the `merkle.Tree` of a manifest, or None."""
+    tree = _tree_cache.get(manifest_id)
+    if tree is None:
+        tree = _tree_flights.do(manifest_id, _build_tree, manifest_id)
+    return tree
+
+
+def _build_tree(manifest_id):
+    manifest = get(manifest_id)
+    if not manifest:
+        return None
+    tree = merkle.Tree(manifest.paths or {}, meta=manifest.meta)
+    _tree_cache.set(manifest_id, tree)
+    return tree
+
+
+def derive(base_manifest_id, commit, paths, meta=None, deleted=()):
+    """Saves a new manifest by applying changes to an existing manifest.
+
+    `paths` and `meta` are added or replace the base manifest's entries, and
+    `deleted` paths are removed. Deleted paths ending with "/" remove every
+    path under that directory.
+    """
+    base = get(base_manifest_id)
+    if not base:
+        raise Error('unknown manifest: {}'.format(base_manifest_id))
+    new_paths = dict(base.paths or {})
+    new_meta = dict(base.meta or {})
+    dirnames = tuple(path for path in deleted if path.endswith('/'))
+    if dirnames:
+        for path in list(new_paths):
+            if path.startswith(dirnames):
+                del new_paths[path]
+                new_meta.pop(path, None)
+    for path in deleted:
+        new_paths.pop(path, None)
+        new_meta.pop(path, None)
+    new_paths.update(paths)
+    for path in paths:
+        new_meta.pop(path, None)
+    new_meta.update(meta or {})
+    return save(commit, new_paths, meta=new_meta)
+
+
+def begin_session(commit):
+    """Starts a paged manifest upload and returns the manifest's id."""
+    manifest_id = FilesetManifest.allocate_ids(1)[0]
+    FilesetManifestSession(id=manifest_id, commit=commit).put()
+    return manifest_id
+
+
+def append_page(manifest_id, page, paths, meta=None):
+    """Stores a page of a session's paths (and metadata).
+
+    Pages can be appended in any order and in parallel. Appending a page with
+    the same index again replaces it, so retries are safe.
+    """
+    if not FilesetManifestSession.get_by_id(manifest_id):
+        raise Error('unknown session: {}'.format(manifest_id))
+    if not isinstance(page, int) or page < 0:
+        raise Error('invalid page: {}'.format(page))
+    data = json.dumps({'paths': paths, 'meta': meta or None},
+                      separators=(',', ':'))
+    # Pages are compressed when stored, so check the compressed size.
+    if len(zlib.compress(data)) > MAX_PAGE_BYTES:
+        raise Error('page {} is too large, use smaller pages'.format(page))
+    FilesetManifestPage(
+        id=_get_page_id(manifest_id, page), manifest_id=manifest_id,
+        data=data).put()
+
+
+def commit_session(manifest_id, num_pages):
+    """Saves a manifest from the pages appended to a session."""
+    session = FilesetManifestSession.get_by_id(manifest_id)
+    if not session:
+        raise Error('unknown session: {}'.format(manifest_id))
+
+    # Verify that every page exists, a few pages at a time.
+    keys = _get_page_keys(manifest_id, num_pages)
+    for i in range(0, len(keys), PAGE_BATCH_SIZE):
+        batch = ndb.get_multi(
+            keys[i:i + PAGE_BATCH_SIZE], use_cache=False, use_memcache=False)
+        for key, page in zip(keys[i:i + PAGE_BATCH_SIZE], batch):
+            if page is None:
+                raise Error('missing page: {}'.format(key.id()))
+
+    manifest = FilesetManifest(id=manifest_id)
+    manifest.commit = session.commit
+    manifest.num_pages = num_pages
+    manifest.put()
+    session.key.delete()
+    logging.info('committed manifest: id=%s, pages=%s', manifest_id, num_pages)
+    return manifest_id
+
+
+def iter_pages(manifest):
+    """Yields `(paths, meta)` for each page of a paged manifest."""
+    keys = _get_page_keys(manifest.id, manifest.num_pages or 0)
+    for i in range(0, len(keys), PAGE_BATCH_SIZE):
+        batch = ndb.get_multi(
+            keys[i:i + PAGE_BATCH_SIZE], use_cache=False, use_memcache=False)
+        for page in batch:
+            if page is None:
+                continue
+            data = json.loads(page.data)
+            yield data['paths'], data.get('meta')
+
+
+def load_pages(manifest):
+    """Fills in the paths and metadata of a paged manifest."""
+    if not manifest or not manifest.num_pages or manifest.paths is not None:
+        return manifest
+    paths = {}
+    meta = {}
+    for page_paths, page_meta in iter_pages(manifest):
+        paths.update(page_paths)
+        meta.update(page_meta or {})
+    manifest.paths = paths
+    manifest.meta = meta or None
+    return manifest
+
+
+def delete_pages(manifest_id):
+    """Deletes the pages of a manifest or of an abandoned session."""
+    query = FilesetManifestPage.query(
+        FilesetManifestPage.manifest_id == manifest_id)
+    keys = query.fetch(keys_only=True)
+    ndb.delete_multi(keys)
+    return len(keys)
+
+
+def _get_page_id(manifest_id, page):
+    return '{}:{}'.format(manifest_id, page)
+
+
+def _get_page_keys(manifest_id, num_pages):
+    return [ndb.Key(FilesetManifestPage, _get_page_id(manifest_id, page))
+            for page in range(num_pages)]
+
+
 def set_branch_manifest(branch, manifest_id, deploy_timestamp=None):
     timestamp = int(time.time())
     if deploy_timestamp and deploy_timestamp > timestamp:
@@ -64,6 +349,14 @@ def _set_branch_manifest(branch, manifest_id):
     logging.info(
         'saved branch manifest: branch=%s, manifest=%s',
         branch, manifest_id)
+    _publish_branch_manifest_by_id(branch, manifest_id)
+
+
+def _publish_branch_manifest_by_id(branch, manifest_id):
+    manifest = get(manifest_id)
+    if not manifest or not publish_branch_manifest(branch, manifest):
+        # Let instances fall back to the datastore.
+        memcache.delete(BRANCH_KEY_PREFIX + branch)
 
 
 def _create_timed_deploy(branch, manifest_id, deploy_timestamp):
@@ -82,28 +375,238 @@ def _create_timed_deploy(branch, manifest_id, deploy_timestamp):
     logging.info(
         'saved timed deploy: branch=%s, manifest=%s, deploy_timstamp=%s',
         branch, manifest_id, deploy_timestamp)
+    _schedule_timed_deploy(branch, manifest_id, deploy_timestamp)
+
+
+def _schedule_timed_deploy(branch, manifest_id, deploy_timestamp):
+    """Enqueues tasks that prewarm and apply a timed deploy on time.
+
+    The cron job remains as a fallback in case the tasks can't be enqueued.
+    """
+    # Imported here since only deploys need it, keeping it off cold starts.
+    from google.appengine.api import taskqueue
+
+    # Task names can only contain letters, digits, "-" and "_". Named tasks
+    # dedupe retried RPCs; a new manifest or timestamp gets a new name.
+    name = 'fs-{}-{}-{}'.format(
+        re.sub('[^a-zA-Z0-9_-]', '_', branch), manifest_id, deploy_timestamp)
+    now = time.time()
+    tasks = [
+        taskqueue.Task(
+            name=name + '-deploy',
+            url='/_fs/api/task.timed_deploy',
+            countdown=max(0, deploy_timestamp - now),
+            payload=json.dumps({'branch': branch}),
+            headers={'Content-Type': 'application/json'}),
+    ]
+    prewarm_timestamp = deploy_timestamp - PREWARM_SECONDS
+    if prewarm_timestamp > now:
+        tasks.append(taskqueue.Task(
+            name=name + '-prewarm',
+            url='/_fs/api/task.prewarm_manifest',
+            countdown=prewarm_timestamp - now,
+            payload=json.dumps({'manifest_id': manifest_id}),
+            headers={'Content-Type': 'application/json'}))
+    try:
+        taskqueue.Queue().add(tasks)
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
+    except Exception:
+        logging.exception('failed to schedule timed deploy, using cron')
+
+
+def prewarm_manifest(manifest_id):
+    """Publishes a manifest to memcache before it goes live.
+
+    When the branch switches, only the small branch pointer has to be
+    written and instances fetch the already published chunks.
+    """
+    manifest = get(manifest_id)
+    if not manifest:
+        return False
+    publish_manifest(manifest)
+    return True
 
 
 def get_branch_manifest(branch):
+    return _branch_flights.do(branch, _get_branch_manifest, branch)
+
+
+def _get_branch_manifest(branch):
+    pointer = memcache.get(BRANCH_KEY_PREFIX + branch)
+    if pointer:
+        manifest = _get_published_manifest(pointer)
+        if manifest:
+            return manifest
+
+    # Only one instance at a time loads the manifest from the datastore and
+    # publishes it, others wait for it to show up in memcache.
+    lease_key = BRANCH_LEASE_KEY_PREFIX + branch
+    if memcache.add(lease_key, 1, time=LEASE_SECONDS):
+        try:
+            manifest = _get_branch_manifest_from_datastore(branch)
+            if manifest:
+                # A deploy may have published a newer manifest since it was
+                # read, so don't overwrite the pointer.
+                publish_branch_manifest(branch, manifest, overwrite=False)
+            return manifest
+        finally:
+            memcache.delete(lease_key)
+
+    for _ in range(LEASE_WAIT_TRIES):
+        time.sleep(LEASE_WAIT_SECONDS)
+        pointer = memcache.get(BRANCH_KEY_PREFIX + branch)
+        if pointer:
+            manifest = _get_published_manifest(pointer)
+            if manifest:
+                return manifest
+    return _get_branch_manifest_from_datastore(branch)
+
+
+def _get_branch_manifest_from_datastore(branch):
+    stats.incr('branch_datastore_loads')
     branch_manifest = FilesetBranchManifest.get_by_id(branch)
     if not branch_manifest:
         return None
-    return branch_manifest.manifest.get()
+    return load_pages(branch_manifest.manifest.get())
+
+
+def _get_published_manifest(pointer):
+    """Returns the manifest a memcache branch pointer refers to, or None."""
+    manifest_id = pointer['manifest_id']
+    manifest = _manifest_cache.get(manifest_id)
+    if manifest is not None:
+        # Manifests are immutable, so a pointer republished for the same
+        # manifest doesn't need to be fetched again.
+        stats.incr('branch_cache_hits')
+        return manifest
+    stats.incr('branch_cache_misses')
+
+    keys = [MANIFEST_CHUNK_KEY.format(manifest_id, i)
+            for i in range(pointer['num_chunks'])]
+    chunks = memcache.get_multi(keys)
+    if len(chunks) != len(keys):
+        # Some chunks were evicted.
+        return None
+    manifest = _deserialize(manifest_id, b''.join(chunks[key] for key in keys))
+    _manifest_cache.set(manifest_id, manifest)
+    return manifest
 
 
-def handle_timed_deploys():
+def publish_manifest(manifest):
+    """Stores a manifest in memcache and returns the number of chunks.
+
+    Returns None if any chunk couldn't be stored.
+    """
+    data = _serialize(manifest)
+    chunks = {}
+    for i, offset in enumerate(range(0, len(data), CHUNK_SIZE)):
+        key = MANIFEST_CHUNK_KEY.format(manifest.id, i)
+        chunks[key] = data[offset:offset + CHUNK_SIZE]
+    failed_keys = memcache.set_multi(chunks)
+    if failed_keys:
+        logging.warning('failed to publish {} of {} chunks of manifest {}'.format(
+            len(failed_keys), len(chunks), manifest.id))
+        return None
+    return len(chunks)
+
+
+def publish_branch_manifest(branch, manifest, overwrite=True):
+    """Publishes a branch's manifest so that all instances pick it up.
+
+    Deploys overwrite the branch pointer. With `overwrite=False` (for
+    manifests read from the datastore, which may be older than the published
+    one), the pointer is only written if there is none. Returns whether the
+    pointer was written, which it isn't if the manifest couldn't be published.
+    """
+    num_chunks = publish_manifest(manifest)
+    if num_chunks is None:
+        return False
+    version = memcache.incr(
+        BRANCH_VERSION_KEY_PREFIX + branch, initial_value=0)
+    pointer = {
+        'version': version,
+        'manifest_id': manifest.id,
+        'num_chunks': num_chunks,
+    }
+    if overwrite:
+        return memcache.set(BRANCH_KEY_PREFIX + branch, pointer,
+                            time=BRANCH_POINTER_SECONDS)
+    return memcache.add(BRANCH_KEY_PREFIX + branch, pointer,
+                        time=BRANCH_POINTER_SECONDS)
+
+
+def _serialize(manifest):
+    data = json.dumps({
+        'commit': manifest.commit,
+        'paths': manifest.paths,
+        'meta': manifest.meta,
+    }, separators=(',', ':'))
+    return zlib.compress(data.encode('utf-8'))
+
+
+def _deserialize(manifest_id, data):
+    data = json.loads(zlib.decompress(data).decode('utf-8'))
+    manifest = FilesetManifest(id=manifest_id)
+    manifest.commit = data['commit']
+    manifest.paths = data['paths']
+    manifest.meta = data.get('meta')
+    return manifest
+
+
+def handle_timed_deploys(branch=None):
+    """Applies due timed deploys, optionally only the one for `branch`."""
+    if branch:
+        branches = [branch]
+    else:
+        timestamp = int(time.time()) + 1
+        query = FilesetTimedDeploy.gql(
+            'WHERE deploy_timestamp < :1 AND deployed = NULL ORDER BY deploy_timestamp',
+            timestamp)
+        branches = [key.id() for key in query.fetch(keys_only=True)]
+
     deployments = []
-    timestamp = int(time.time()) + 1
-    query = FilesetTimedDeploy.gql(
-        'WHERE deploy_timestamp < :1 AND deployed = NULL ORDER BY deploy_timestamp',
-        timestamp)
-    results = query.fetch()
-    for timed_deploy in results:
-        _set_branch_manifest(timed_deploy.branch, timed_deploy.manifest.id())
-        timed_deploy.deployed = datetime.datetime.now()
-        timed_deploy.put()
-        deployments.append({
-            'branch': timed_deploy.branch,
-            'manifest_id': timed_deploy.manifest.id(),
-        })
+    for branch in branches:
+        manifest_id = _apply_timed_deploy(branch)
+        if manifest_id is not None:
+            _publish_branch_manifest_by_id(branch, manifest_id)
+            deployments.append({
+                'branch': branch,
+                'manifest_id': manifest_id,
+            })
     return deployments
+
+
+def get_timed_deploy_delay(branch):
+    """Returns the seconds until a branch's pending timed deploy is due.
+
+    Returns None if the branch has no pending timed deploy, and 0 or less if
+    it's due.
+    """
+    timed_deploy = FilesetTimedDeploy.get_by_id(branch)
+    if not timed_deploy or timed_deploy.deployed:
+        return None
+    return timed_deploy.deploy_timestamp - int(time.time())
+
+
+@ndb.transactional(xg=True)
+def _apply_timed_deploy(branch):
+    """Switches the branch and marks its timed deploy done in one transaction.
+
+    Returns the deployed manifest id, or None if nothing was due (e.g. the
+    deploy was already applied by the task queue or the cron fallback).
+    """
+    timed_deploy = FilesetTimedDeploy.get_by_id(branch)
+    if not timed_deploy or timed_deploy.deployed:
+        return None
+    if timed_deploy.deploy_timestamp > int(time.time()):
+        return None
+
+    branch_manifest = FilesetBranchManifest(id=branch)
+    branch_manifest.manifest = timed_deploy.manifest
+    timed_deploy.deployed = datetime.datetime.now()
+    ndb.put_multi([branch_manifest, timed_deploy])
+    logging.info(
+        'saved branch manifest: branch=%s, manifest=%s',
+        branch, timed_deploy.manifest.id())
+    return timed_deploy.manifest.id()
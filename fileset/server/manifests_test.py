@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+
+import time
+import unittest
+from fileset.server import testing
+
+testing.setup_sdk()
+
+from fileset.server import manifests
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+COMMIT = {'sha': 'commit', 'message': ''}
+
+
+def _sha(value):
+    return '{:040x}'.format(value)
+
+
+class ManifestsTestCase(testing.TestCase):
+
+    def setUp(self):
+        super(ManifestsTestCase, self).setUp()
+        self.patch(manifests, '_manifest_cache', manifests.lru.LruCache(
+            manifests.config.MANIFEST_CACHE_MAX_PATHS,
+            weigh=lambda manifest: len(manifest.paths or ()),
+            keep_oversized=True))
+        self.patch(manifests, '_tree_cache', manifests.lru.LruCache(4))
+
+    def _get_branch_manifest_id(self, branch):
+        branch_manifest = manifests.FilesetBranchManifest.get_by_id(branch)
+        return branch_manifest.manifest.id() if branch_manifest else None
+
+
+class TimedDeployTest(ManifestsTestCase):
+
+    def setUp(self):
+        super(TimedDeployTest, self).setUp()
+        self.old_id = manifests.save(COMMIT, {'/index.html': _sha(1)})
+        self.new_id = manifests.save(COMMIT, {'/index.html': _sha(2)})
+        manifests.set_branch_manifest('master', self.old_id)
+
+    def _schedule(self, seconds=3600):
+        deploy_timestamp = int(time.time()) + seconds
+        manifests.set_branch_manifest(
+            'master', self.new_id, deploy_timestamp=deploy_timestamp)
+        return deploy_timestamp
+
+    def _make_due(self):
+        timed_deploy = manifests.FilesetTimedDeploy.get_by_id('master')
+        timed_deploy.deploy_timestamp = int(time.time()) - 1
+        timed_deploy.put()
+
+    def test_schedule(self):
+        deploy_timestamp = self._schedule()
+        timed_deploy = manifests.FilesetTimedDeploy.get_by_id('master')
+        self.assertEqual(deploy_timestamp, timed_deploy.deploy_timestamp)
+        self.assertIsNone(timed_deploy.deployed)
+        self.assertEqual(self.old_id, self._get_branch_manifest_id('master'))
+        urls = sorted(task.url for task in self.get_tasks())
+        self.assertEqual(
+            ['/_fs/api/task.prewarm_manifest', '/_fs/api/task.timed_deploy'],
+            urls)
+        self.assertTrue(
+            0 < manifests.get_timed_deploy_delay('master') <= 3600)
+
+    def test_not_due(self):
+        self._schedule()
+        self.assertEqual([], manifests.handle_timed_deploys(branch='master'))
+        self.assertEqual([], manifests.handle_timed_deploys())
+        self.assertEqual(self.old_id, self._get_branch_manifest_id('master'))
+        self.assertIsNone(
+            manifests.FilesetTimedDeploy.get_by_id('master').deployed)
+
+    def test_apply(self):
+        self._schedule()
+        self._make_due()
+        self.assertEqual(0, manifests.get_timed_deploy_delay('master') + 1)
+        deployments = manifests.handle_timed_deploys(branch='master')
+        self.assertEqual(
+            [{'branch': 'master', 'manifest_id': self.new_id}], deployments)
+        self.assertEqual(self.new_id, self._get_branch_manifest_id('master'))
+        self.assertIsNotNone(
+            manifests.FilesetTimedDeploy.get_by_id('master').deployed)
+        self.assertIsNone(manifests.get_timed_deploy_delay('master'))
+        # The new manifest is published to all instances.
+        self.assertEqual(
+            self.new_id, manifests.get_branch_manifest('master').id)
+
+    def test_task_and_cron(self):
+        self._schedule()
+        self._make_due()
+        # Whichever of the task and the cron runs first applies the deploy,
+        # the other one finds nothing to do.
+        self.assertEqual(1, len(manifests.handle_timed_deploys()))
+        self.assertEqual([], manifests.handle_timed_deploys(branch='master'))
+        self.assertEqual([], manifests.handle_timed_deploys())
+        self.assertEqual(self.new_id, self._get_branch_manifest_id('master'))
+
+    def test_apply_is_atomic(self):
+        self._schedule()
+        self._make_due()
+
+        def fail(entity):
+            raise ValueError('failed to mark the timed deploy done')
+
+        self.patch(manifests.FilesetTimedDeploy, '_pre_put_hook', fail)
+        with self.assertRaises(ValueError):
+            manifests.handle_timed_deploys(branch='master')
+        # The branch didn't switch without the deploy being marked done.
+        ndb.get_context().clear_cache()
+        self.assertEqual(self.old_id, self._get_branch_manifest_id('master'))
+        self.assertIsNone(
+            manifests.FilesetTimedDeploy.get_by_id('master').deployed)
+
+    def test_reschedule(self):
+        self._schedule()
+        newer_id = manifests.save(COMMIT, {'/index.html': _sha(3)})
+        manifests.set_branch_manifest(
+            'master', newer_id, deploy_timestamp=int(time.time()) + 60)
+        self._make_due()
+        deployments = manifests.handle_timed_deploys(branch='master')
+        self.assertEqual(
+            [{'branch': 'master', 'manifest_id': newer_id}], deployments)
+
+
+class PublishTest(ManifestsTestCase):
+
+    def _make_manifest(self, manifest_id, num_paths):
+        manifest = manifests.FilesetManifest(id=manifest_id)
+        manifest.commit = COMMIT
+        manifest.paths = dict(
+            ('/{}.html'.format(i), _sha(i)) for i in range(num_paths))
+        return manifest
+
+    def test_publish(self):
+        manifest = self._make_manifest(1, 10)
+        self.assertTrue(manifests.publish_branch_manifest('master', manifest))
+        published = manifests.get_branch_manifest('master')
+        self.assertEqual(manifest.paths, published.paths)
+        # The published manifest is cached in process by its id.
+        self.assertIs(published, manifests.get_branch_manifest('master'))
+        self.assertIs(published, manifests._manifest_cache.get(1))
+
+    def test_publish_failure(self):
+        manifest = self._make_manifest(1, 10)
+        self.assertTrue(manifests.publish_branch_manifest('master', manifest))
+        self.patch(memcache, 'set_multi', lambda mapping: list(mapping)[:1])
+        self.assertIsNone(manifests.publish_manifest(manifest))
+        # The pointer isn't moved to a manifest with missing chunks.
+        self.assertFalse(manifests.publish_branch_manifest(
+            'master', self._make_manifest(2, 10)))
+        pointer = memcache.get(manifests.BRANCH_KEY_PREFIX + 'master')
+        self.assertEqual(1, pointer['manifest_id'])
+        self.assertEqual(1, pointer['version'])
+
+    def test_cache_bound(self):
+        self.patch(manifests, '_manifest_cache', manifests.lru.LruCache(
+            25, weigh=lambda manifest: len(manifest.paths or ()),
+            keep_oversized=True))
+        for i in range(5):
+            branch = 'branch-{}'.format(i)
+            manifests.publish_branch_manifest(
+                branch, self._make_manifest(i + 1, 10))
+            manifests.get_branch_manifest(branch)
+        # Branch manifests share the budget of manifests cached by id.
+        self.assertEqual(2, len(manifests._manifest_cache))
+        self.assertEqual(20, manifests._manifest_cache.weight)
+        # A branch manifest larger than the budget is still cached, alone.
+        manifests.publish_branch_manifest(
+            'large', self._make_manifest(10, 30))
+        manifests.get_branch_manifest('large')
+        self.assertEqual([10], [
+            manifest.id for manifest in manifests._manifest_cache.values()])
+
+
+if __name__ == '__main__':
+    unittest.main()
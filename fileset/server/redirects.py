@@ -2,11 +2,19 @@
 
 import logging
 import os
-import urllib
-import urlparse
+import threading
 import webob
+try:
+    from urllib import quote, urlencode
+    from urlparse import parse_qs, urlparse
+except ImportError:
+    # The asyncio engine in asgi.py runs on Python 3.
+    from urllib.parse import parse_qs, quote, urlencode, urlparse
 from fileset import config
+from fileset.server import domains
 from fileset.server import routetrie
+from fileset.server import stats
+from fileset.server import timing
 from fileset.server import utils
 from google.appengine.api import users
 
@@ -14,6 +22,7 @@ CANONICAL_DOMAIN = config.CANONICAL_DOMAIN
 REDIRECTS = config.REDIRECTS
 REQUIRE_AUTH = config.REQUIRE_AUTH
 REQUIRE_HTTPS = config.REQUIRE_HTTPS
+SERVER_TIMING = config.SERVER_TIMING
 
 
 class RedirectMiddleware(object):
@@ -45,22 +54,38 @@ class RedirectMiddleware(object):
 
     def __init__(self, app):
         self.app = app
-        self.redirects = routetrie.RouteTrie()
-        self.init_redirects()
+        self._redirects = None
+        self._redirects_lock = threading.Lock()
+
+    @property
+    def redirects(self):
+        """The redirects trie, built on first use to keep it off cold starts."""
+        if self._redirects is None:
+            with self._redirects_lock:
+                if self._redirects is None:
+                    self.init_redirects()
+        return self._redirects
 
     def __call__(self, environ, start_response):
+        timer = timing.Timer()
+        environ[timing.ENVIRON_KEY] = timer
+        stats.incr('requests')
         request = webob.Request(environ)
         try:
             response = self.handle_request(request)
         except Exception:
             logging.exception('middleware exception:')
             response = self.handle_error()
+        if 'middleware' not in timer.stages:
+            # Redirects and errors are answered by the middleware itself.
+            timer.record('middleware', timer.elapsed())
+        self.add_timing(request, response, timer)
         return response(environ, start_response)
 
     def handle_request(self, request):
         # Seeing a lot of requests for /%FF for some reason, which errors when
         # webob.Request tries to decode it. Redirect /%FF to /.
-        path_info = urllib.quote(os.environ.get('PATH_INFO', ''))
+        path_info = quote(os.environ.get('PATH_INFO', ''))
         if path_info.lower() == r'/%ff':
             return self.redirect('/')
 
@@ -69,7 +94,8 @@ class RedirectMiddleware(object):
 
         # Redirect to CANONICAL_DOMAIN.
         if CANONICAL_DOMAIN:
-            if env == utils.Env.PROD and domain != CANONICAL_DOMAIN:
+            if (env == utils.Env.PROD and domain != CANONICAL_DOMAIN
+                    and not domains.get_branch(domain)):
                 redirect_uri = '{}://{}{}'.format(
                     request.scheme, CANONICAL_DOMAIN, request.path_qs)
                 logging.info('redirecting: 302 {} => {}'.format(
@@ -98,32 +124,40 @@ class RedirectMiddleware(object):
                 return self.handle_forbidden()
 
         # Check for redirects file.
-        redirect_code, redirect_uri = self.get_redirect_url(request.path)
+        redirect_code, redirect_uri = self.get_redirect(
+            request.path, request.query_string)
         if redirect_uri:
-            # Preserve query string for relative paths.
-            if redirect_uri.startswith('/') and request.query_string:
-                if '?' in redirect_uri:
-                    parts = urlparse.urlparse(redirect_uri)
-                    params = urlparse.parse_qs(parts.query)
-                    params.update(urlparse.parse_qs(request.query_string))
-                    qsl = []
-                    for key, vals in params.iteritems():
-                        for val in vals:
-                            qsl.append((key, val))
-                    redirect_uri = '{}?{}'.format(
-                        parts.path, urllib.urlencode(qsl))
-                else:
-                    redirect_uri = '{}?{}'.format(
-                        redirect_uri, request.query_string)
-
+            stats.incr('redirects')
             logging.info(
                 'redirecting: {} {} => {}'.format(
                     redirect_code, request.path_qs, redirect_uri))
             return self.redirect(redirect_uri, code=redirect_code)
 
         # Render the WSGI response.
+        timer = timing.get_timer(request.environ)
+        timer.record('middleware', timer.elapsed())
         return request.get_response(self.app)
 
+    def add_timing(self, request, response, timer):
+        """Adds the Server-Timing header (if enabled) and logs the timings."""
+        try:
+            if self.should_send_timing(request):
+                response.headers['Server-Timing'] = timer.header_value()
+            timer.log(request, response.status_int)
+        except Exception:
+            logging.exception('failed to add server timing:')
+
+    def should_send_timing(self, request):
+        if SERVER_TIMING == 'always':
+            return True
+        if SERVER_TIMING == 'authorized':
+            if utils.get_env(request) != utils.Env.PROD:
+                # Env.STAGING already requires an authorized user.
+                return True
+            user = users.get_current_user()
+            return bool(user) and utils.is_authorized(user.email())
+        return False
+
     def handle_error(self):
         response = webob.Response()
         response.status = 500
@@ -148,8 +182,34 @@ class RedirectMiddleware(object):
 
     def init_redirects(self):
         """Initializes the redirects trie."""
+        trie = routetrie.RouteTrie()
         for code, path, url in REDIRECTS:
-            self.redirects.add(path, (code, url))
+            trie.add(path, (code, url))
+        self._redirects = trie
+
+    def get_redirect(self, path, query_string=''):
+        """Returns the `(code, url)` to redirect a request to, if any.
+
+        The request's query string is preserved for relative redirect URLs.
+        """
+        redirect_code, redirect_uri = self.get_redirect_url(path)
+        if not redirect_uri:
+            return None, None
+
+        # Preserve query string for relative paths.
+        if redirect_uri.startswith('/') and query_string:
+            if '?' in redirect_uri:
+                parts = urlparse(redirect_uri)
+                params = parse_qs(parts.query)
+                params.update(parse_qs(query_string))
+                qsl = []
+                for key, vals in params.items():
+                    for val in vals:
+                        qsl.append((key, val))
+                redirect_uri = '{}?{}'.format(parts.path, urlencode(qsl))
+            else:
+                redirect_uri = '{}?{}'.format(redirect_uri, query_string)
+        return redirect_code, redirect_uri
 
     def get_redirect_url(self, path):
         """Looks up a redirect URL from the redirects trie."""
@@ -163,7 +223,7 @@ class RedirectMiddleware(object):
 
         # Replace `$variable` placeholders in the URL.
         if '$' in url:
-            for key, value in params.iteritems():
+            for key, value in params.items():
                 if key.startswith(':') or key.startswith('*'):
                     url = url.replace('$' + key[1:], value)
 
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+
+"""Request coalescing for concurrent loads of the same key.
+
+The server runs with `threadsafe: true`, so several threads in one instance
+often load the same manifest or blob at the same time (e.g. right after a cold
+start). A `Group` lets the first caller for a key do the work while concurrent
+callers for the same key wait and share its result (or exception).
+"""
+
+import threading
+
+# Map of group name => Group, used to report stats.
+_groups = {}
+
+
+class _Call(object):
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class Group(object):
+
+    def __init__(self, name):
+        self.name = name
+        self._lock = threading.Lock()
+        self._calls = {}
+        # Number of calls that did the work, and number of calls that shared
+        # the result of another in-flight call.
+        self.calls = 0
+        self.coalesced = 0
+        _groups[name] = self
+
+    def do(self, key, func, *args, **kwargs):
+        """Calls `func`, unless a call for `key` is already in flight."""
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                self.coalesced += 1
+                is_leader = False
+            else:
+                call = _Call()
+                self._calls[key] = call
+                self.calls += 1
+                is_leader = True
+
+        if not is_leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func(*args, **kwargs)
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+
+
+def get_stats():
+    """Returns a map of group name => call counts."""
+    return dict((name, {'calls': group.calls, 'coalesced': group.coalesced})
+                for name, group in _groups.items())
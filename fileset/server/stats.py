@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+
+"""Runtime counters aggregated across instances.
+
+Counters are incremented in process, without any RPC. Every `FLUSH_SECONDS`
+the pending deltas are added to one randomly chosen shard of the memcache
+counters (so concurrent instances rarely contend on the same key), and a
+snapshot of the instance's own counters and gauges is written to memcache.
+Flushes issue asynchronous memcache RPCs that requests don't wait for, so
+they run alongside the rest of the request instead of delaying it.
+
+Counters are best effort: memcache may evict them, and deltas accumulated
+since the last flush are lost when an instance shuts down.
+"""
+
+import collections
+import itertools
+import os
+import random
+import sys
+import threading
+import time
+from fileset.server import singleflight
+from google.appengine.api import memcache
+
+NUM_SHARDS = 20
+FLUSH_SECONDS = 10
+COUNTER_KEY_PREFIX = 'fs-stats:{}:'
+INSTANCE_KEY_PREFIX = 'fs-stats-instance:'
+INSTANCES_KEY = 'fs-stats-instances'
+
+# Instance snapshots expire unless refreshed, so that stopped instances
+# disappear from the stats.
+INSTANCE_SNAPSHOT_SECONDS = 10 * 60
+MAX_INSTANCES = 100
+
+# Seconds between checks that the instance is still in the list of instances,
+# which memcache may evict.
+REGISTER_SECONDS = 5 * 60
+
+# Requests per blob are counted for up to MAX_HOT_BLOBS blobs per instance
+# (the least requested half is dropped when the limit is reached), and
+# snapshots include the SNAPSHOT_HOT_BLOBS most requested ones.
+MAX_HOT_BLOBS = 10000
+SNAPSHOT_HOT_BLOBS = 100
+
+_started = time.time()
+_lock = threading.Lock()
+_last_flush = time.time()
+_last_registered = 0
+
+# Deltas not yet flushed to memcache, and totals since the instance started.
+_pending = collections.defaultdict(int)
+_totals = collections.defaultdict(int)
+_hot_blobs = collections.Counter()
+
+# Map of name => function returning the current value of a gauge.
+_gauges = {}
+
+
+def incr(name, delta=1):
+    with _lock:
+        _pending[name] += delta
+        _totals[name] += delta
+    if time.time() - _last_flush >= FLUSH_SECONDS:
+        flush()
+
+
+def record_blob_request(sha):
+    with _lock:
+        _hot_blobs[sha] += 1
+        if len(_hot_blobs) > MAX_HOT_BLOBS:
+            most_common = _hot_blobs.most_common(MAX_HOT_BLOBS // 2)
+            _hot_blobs.clear()
+            _hot_blobs.update(dict(most_common))
+
+
+def register_gauge(name, func):
+    """Registers a function that reports an instance-level value."""
+    _gauges[name] = func
+
+
+def get_instance_id():
+    return os.environ.get('INSTANCE_ID', 'local')
+
+
+def snapshot():
+    """Returns this instance's counters and gauges."""
+    with _lock:
+        counters = dict(_totals)
+        hot_blobs = _hot_blobs.most_common(SNAPSHOT_HOT_BLOBS)
+    gauges = {}
+    for name, func in _gauges.items():
+        try:
+            gauges[name] = func()
+        except Exception as e:
+            gauges[name] = 'error: {}'.format(e)
+    return {
+        'instance_id': get_instance_id(),
+        'version': os.environ.get('CURRENT_VERSION_ID'),
+        'uptime': int(time.time() - _started),
+        'counters': counters,
+        'ratios': get_ratios(counters),
+        'gauges': gauges,
+        'singleflight': singleflight.get_stats(),
+        'hot_blobs': hot_blobs,
+    }
+
+
+def flush(force=False):
+    global _last_flush
+    with _lock:
+        if not force and time.time() - _last_flush < FLUSH_SECONDS:
+            return
+        _last_flush = time.time()
+        deltas = dict(_pending)
+        _pending.clear()
+
+    try:
+        client = memcache.Client()
+        rpcs = []
+        if deltas:
+            shard = random.randint(0, NUM_SHARDS - 1)
+            rpcs.append(client.offset_multi_async(
+                deltas, key_prefix=COUNTER_KEY_PREFIX.format(shard),
+                initial_value=0))
+        rpcs.append(client.set_multi_async(
+            {get_instance_id(): snapshot()}, key_prefix=INSTANCE_KEY_PREFIX,
+            time=INSTANCE_SNAPSHOT_SECONDS))
+        if force:
+            for rpc in rpcs:
+                rpc.get_result()
+        if force or time.time() - _last_registered >= REGISTER_SECONDS:
+            _register_instance(client)
+    except Exception:
+        # Stats must never break serving.
+        pass
+
+
+def _register_instance(client):
+    """Adds the instance to the list of instances, if it isn't there."""
+    global _last_registered
+    instance_id = get_instance_id()
+    for _ in range(5):
+        instance_ids = client.gets(INSTANCES_KEY)
+        if instance_ids is None:
+            if client.add(INSTANCES_KEY, [instance_id]):
+                break
+            continue
+        if instance_id in instance_ids:
+            break
+        instance_ids = (instance_ids + [instance_id])[-MAX_INSTANCES:]
+        if client.cas(INSTANCES_KEY, instance_ids):
+            break
+    else:
+        # Retried on the next flush.
+        return
+    _last_registered = time.time()
+
+
+def get_global_counters():
+    """Returns counters summed across all shards (i.e. all instances)."""
+    names = set(_totals)
+    keys = []
+    for shard in range(NUM_SHARDS):
+        prefix = COUNTER_KEY_PREFIX.format(shard)
+        keys.extend(prefix + name for name in names)
+    # Counters that this instance never incremented are discovered through
+    # the instance snapshots.
+    for instance in get_instance_snapshots():
+        for name in instance.get('counters', {}):
+            if name not in names:
+                names.add(name)
+                keys.extend(COUNTER_KEY_PREFIX.format(shard) + name
+                            for shard in range(NUM_SHARDS))
+
+    values = memcache.get_multi(keys)
+    counters = collections.defaultdict(int)
+    for key, value in values.items():
+        name = key.split(':', 2)[2]
+        counters[name] += int(value)
+    return dict(counters)
+
+
+def get_ratios(counters):
+    """Returns hit ratios and averages derived from a dict of counters."""
+    def ratio(numerator, *denominator):
+        total = sum(counters.get(name, 0) for name in denominator)
+        if not total:
+            return None
+        return round(float(counters.get(numerator, 0)) / total, 4)
+    return {
+        'manifest_cache_hit_ratio': ratio(
+            'manifest_cache_hits',
+            'manifest_cache_hits', 'manifest_cache_misses'),
+        'branch_cache_hit_ratio': ratio(
+            'branch_cache_hits',
+            'branch_cache_hits', 'branch_cache_misses'),
+        'blob_exists_cache_hit_ratio': ratio(
+            'blob_exists_cache_hits',
+            'blob_exists_cache_hits', 'blob_exists_cache_misses'),
+        'blob_cache_hit_ratio': ratio(
+            'blob_cache_hits', 'blob_cache_hits', 'blob_cache_misses'),
+        'token_cache_hit_ratio': ratio(
+            'token_cache_hits', 'token_cache_hits', 'token_cache_misses'),
+        'intl_probes_per_lookup': ratio('intl_probes', 'intl_lookups'),
+        'not_found_rate': ratio('not_found', 'requests'),
+        'redirect_rate': ratio('redirects', 'requests'),
+    }
+
+
+def get_instance_snapshots():
+    instance_ids = memcache.get(INSTANCES_KEY) or []
+    snapshots = memcache.get_multi(instance_ids, key_prefix=INSTANCE_KEY_PREFIX)
+    return [snapshots[instance_id] for instance_id in instance_ids
+            if instance_id in snapshots]
+
+
+def get_hot_blobs(num_blobs):
+    """Returns the SHAs most requested across recently active instances."""
+    counts = collections.Counter()
+    for instance in get_instance_snapshots():
+        for sha, count in instance.get('hot_blobs', ()):
+            counts[sha] += count
+    with _lock:
+        counts.update(dict(_hot_blobs.most_common(SNAPSHOT_HOT_BLOBS)))
+    return [sha for sha, _ in counts.most_common(num_blobs)]
+
+
+def estimate_paths_size(paths, sample_size=100):
+    """Estimates the memory used by a manifest's `paths` dict, in bytes.
+
+    Extrapolates from a sample of entries, so it's cheap for large manifests.
+    """
+    if not paths:
+        return 0
+    items = paths.iteritems() if hasattr(paths, 'iteritems') else paths.items()
+    sample = [sys.getsizeof(path) + sys.getsizeof(sha)
+              for path, sha in itertools.islice(items, sample_size)]
+    return sys.getsizeof(paths) + len(paths) * sum(sample) // len(sample)
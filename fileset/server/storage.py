@@ -0,0 +1,285 @@
+#!/usr/bin/env python
+
+"""Storage backends for blobs.
+
+Blobs are immutable and keyed by the SHA-1 of their content. A backend stores
+the bytes and knows how to serve them efficiently from a webapp2 handler:
+
+    * `GcsBackend` stores blobs in the app's default GCS bucket and serves them
+      through the blobstore (App Engine streams the body, the instance never
+      reads it).
+    * `LocalBackend` stores blobs on the local filesystem and serves them with
+      `wsgi.file_wrapper` (which servers such as gunicorn implement with
+      `sendfile`), falling back to mmap-backed chunks, and answers single
+      byte-range requests itself. It allows running and load-testing the
+      server outside of App Engine.
+
+The backend is selected with `fileset_STORAGE_BACKEND` in appengine_config.py.
+"""
+
+import collections
+import json
+import mmap
+import os
+import threading
+from fileset import config
+
+# Size of the chunks yielded when streaming blob bodies.
+CHUNK_SIZE = 1 << 20
+
+BlobStat = collections.namedtuple(
+    'BlobStat', ['sha', 'size', 'content_type', 'created'])
+
+
+class Backend(object):
+    """Interface for blob storage backends."""
+
+    def exists(self, sha):
+        return self.stat(sha) is not None
+
+    def stat(self, sha):
+        """Returns a `BlobStat` for the blob, or None if it doesn't exist."""
+        raise NotImplementedError()
+
+    def read(self, sha):
+        raise NotImplementedError()
+
+    def open(self, sha):
+        """Returns a file-like object for reading the blob in chunks."""
+        raise NotImplementedError()
+
+    def write(self, sha, content, content_type):
+        raise NotImplementedError()
+
+    def delete(self, sha):
+        raise NotImplementedError()
+
+    def list(self, marker=None, max_keys=1000):
+        """Returns up to `max_keys` `BlobStat`s, ordered by SHA, after `marker`."""
+        raise NotImplementedError()
+
+    def serve(self, handler, sha):
+        """Writes the blob as the body of the handler's response."""
+        raise NotImplementedError()
+
+
+class GcsBackend(Backend):
+    """Stores blobs in the app's default GCS bucket under `blobs/`."""
+
+    def __init__(self, bucket=None):
+        # Import lazily so that other backends don't depend on App Engine APIs.
+        import cloudstorage
+        self.gcs = cloudstorage
+        if bucket is None:
+            from google.appengine.api import app_identity
+            bucket = app_identity.get_default_gcs_bucket_name()
+        self.bucket = bucket
+
+    def get_path(self, sha):
+        return os.path.join('/', self.bucket, 'blobs', sha)
+
+    def stat(self, sha):
+        try:
+            stat = self.gcs.stat(self.get_path(sha))
+        except self.gcs.NotFoundError:
+            return None
+        return BlobStat(sha, stat.st_size, stat.content_type, stat.st_ctime)
+
+    def read(self, sha):
+        gcs_file = self.gcs.open(self.get_path(sha))
+        content = gcs_file.read()
+        gcs_file.close()
+        return content
+
+    def open(self, sha):
+        return self.gcs.open(self.get_path(sha), read_buffer_size=CHUNK_SIZE)
+
+    def write(self, sha, content, content_type):
+        path = self.get_path(sha)
+        with self.gcs.open(path, 'w', content_type=content_type) as fp:
+            fp.write(content)
+
+    def delete(self, sha):
+        try:
+            self.gcs.delete(self.get_path(sha))
+        except self.gcs.NotFoundError:
+            pass
+
+    def list(self, marker=None, max_keys=1000):
+        prefix = self.get_path('')
+        if marker:
+            marker = prefix + marker
+        results = []
+        for stat in self.gcs.listbucket(
+                prefix, marker=marker, max_keys=max_keys):
+            sha = stat.filename[len(prefix):]
+            results.append(
+                BlobStat(sha, stat.st_size, stat.content_type, stat.st_ctime))
+        return results
+
+    def serve(self, handler, sha):
+        from google.appengine.ext.blobstore import blobstore
+        blob_key = blobstore.create_gs_key('/gs' + self.get_path(sha))
+        handler.send_blob(blob_key)
+
+
+class LocalBackend(Backend):
+    """Stores blobs on the local filesystem.
+
+    Blobs are stored at `<root>/blobs/<sha>` and their content types at
+    `<root>/meta/<sha>.json`.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.blobs_dir = os.path.join(root, 'blobs')
+        self.meta_dir = os.path.join(root, 'meta')
+        for path in (self.blobs_dir, self.meta_dir):
+            if not os.path.isdir(path):
+                os.makedirs(path)
+
+    def get_path(self, sha):
+        # SHAs come from clients, so never allow them to escape the root.
+        if not sha or '/' in sha or sha.startswith('.'):
+            raise ValueError('invalid sha: {}'.format(sha))
+        return os.path.join(self.blobs_dir, sha)
+
+    def stat(self, sha):
+        try:
+            stat = os.stat(self.get_path(sha))
+        except OSError:
+            return None
+        return BlobStat(
+            sha, stat.st_size, self._read_content_type(sha), stat.st_mtime)
+
+    def read(self, sha):
+        with open(self.get_path(sha), 'rb') as fp:
+            return fp.read()
+
+    def open(self, sha):
+        return open(self.get_path(sha), 'rb')
+
+    def write(self, sha, content, content_type):
+        # Write to a temp file first so that readers never see partial blobs.
+        path = self.get_path(sha)
+        tmp_path = '{}.{}.tmp'.format(path, threading.current_thread().ident)
+        with open(tmp_path, 'wb') as fp:
+            fp.write(content)
+        meta_path = os.path.join(self.meta_dir, sha + '.json')
+        with open(meta_path, 'w') as fp:
+            json.dump({'content_type': content_type}, fp)
+        os.rename(tmp_path, path)
+
+    def delete(self, sha):
+        for path in (self.get_path(sha),
+                     os.path.join(self.meta_dir, sha + '.json')):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def list(self, marker=None, max_keys=1000):
+        shas = sorted(name for name in os.listdir(self.blobs_dir)
+                      if not name.endswith('.tmp'))
+        results = []
+        for sha in shas:
+            if marker and sha <= marker:
+                continue
+            stat = self.stat(sha)
+            if stat:
+                results.append(stat)
+            if len(results) >= max_keys:
+                break
+        return results
+
+    def serve(self, handler, sha):
+        path = self.get_path(sha)
+        fp = open(path, 'rb')
+        size = os.fstat(fp.fileno()).st_size
+        content_type = self._read_content_type(sha)
+        response = handler.response
+        if content_type:
+            response.headers['Content-Type'] = content_type
+        response.headers['Accept-Ranges'] = 'bytes'
+
+        byte_range = _get_range(handler.request, response)
+        if byte_range is not None:
+            start_end = byte_range.range_for_length(size)
+            if start_end is None:
+                fp.close()
+                response.status = 416
+                response.headers['Content-Range'] = 'bytes */{}'.format(size)
+                response.headers['Content-Length'] = '0'
+                return
+            start, end = start_end
+            response.status = 206
+            response.headers['Content-Range'] = 'bytes {}-{}/{}'.format(
+                start, end - 1, size)
+            # Setting `app_iter` clears Content-Length, so it's set after.
+            response.app_iter = _iter_mmap(fp, start, end)
+            response.headers['Content-Length'] = str(end - start)
+            return
+
+        file_wrapper = handler.request.environ.get('wsgi.file_wrapper')
+        if file_wrapper:
+            response.app_iter = file_wrapper(fp, CHUNK_SIZE)
+        else:
+            response.app_iter = _iter_mmap(fp, 0, size)
+        response.headers['Content-Length'] = str(size)
+
+    def _read_content_type(self, sha):
+        meta_path = os.path.join(self.meta_dir, sha + '.json')
+        try:
+            with open(meta_path) as fp:
+                return json.load(fp).get('content_type')
+        except (IOError, OSError, ValueError):
+            return None
+
+
+def _get_range(request, response):
+    """Returns the request's byte range, or None to send the whole blob."""
+    if request.range is None:
+        return None
+    # A range for another version of the resource doesn't apply.
+    if_range = request.headers.get('If-Range')
+    if if_range and if_range != response.headers.get('ETag'):
+        return None
+    return request.range
+
+
+def _iter_mmap(fp, start, end):
+    try:
+        if end <= start:
+            return
+        mapped = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            for offset in range(start, end, CHUNK_SIZE):
+                yield mapped[offset:min(offset + CHUNK_SIZE, end)]
+        finally:
+            mapped.close()
+    finally:
+        fp.close()
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_backend():
+    """Returns the configured storage backend."""
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                _backend = _create_backend(config.STORAGE_BACKEND)
+    return _backend
+
+
+def _create_backend(kind):
+    if kind == 'gcs':
+        return GcsBackend()
+    if kind == 'local':
+        if not config.STORAGE_ROOT:
+            raise ValueError('fileset_STORAGE_ROOT is required for "local"')
+        return LocalBackend(config.STORAGE_ROOT)
+    raise ValueError('unknown storage backend: {}'.format(kind))
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+
+import unittest
+from fileset.server import testing
+
+testing.setup_sdk()
+
+from fileset.server import storage
+import webapp2
+
+SHA = 'a' * 40
+CONTENT = b''.join(bytes(bytearray([i % 256])) for i in range(1000))
+
+
+class Handler(object):
+
+    def __init__(self, headers=None):
+        self.request = webapp2.Request.blank('/', headers=headers)
+        self.response = webapp2.Response()
+
+
+class LocalBackendTest(testing.TestCase):
+
+    def setUp(self):
+        super(LocalBackendTest, self).setUp()
+        self.backend = storage.LocalBackend(self.make_tempdir())
+        self.backend.write(SHA, CONTENT, 'application/octet-stream')
+        self.patch(storage, 'CHUNK_SIZE', 64)
+
+    def _serve(self, headers=None, etag=None):
+        handler = Handler(headers)
+        if etag:
+            handler.response.headers['ETag'] = etag
+        self.backend.serve(handler, SHA)
+        response = handler.response
+        return response, b''.join(response.app_iter)
+
+    def test_full(self):
+        response, body = self._serve()
+        self.assertEqual(200, response.status_int)
+        self.assertEqual(CONTENT, body)
+        self.assertEqual(str(len(CONTENT)), response.headers['Content-Length'])
+        self.assertEqual('bytes', response.headers['Accept-Ranges'])
+
+    def test_range(self):
+        response, body = self._serve({'Range': 'bytes=100-299'})
+        self.assertEqual(206, response.status_int)
+        self.assertEqual(CONTENT[100:300], body)
+        self.assertEqual('bytes 100-299/1000', response.headers['Content-Range'])
+        self.assertEqual('200', response.headers['Content-Length'])
+
+        response, body = self._serve({'Range': 'bytes=900-'})
+        self.assertEqual(206, response.status_int)
+        self.assertEqual(CONTENT[900:], body)
+
+        response, body = self._serve({'Range': 'bytes=-10'})
+        self.assertEqual(206, response.status_int)
+        self.assertEqual(CONTENT[-10:], body)
+        self.assertEqual('bytes 990-999/1000', response.headers['Content-Range'])
+
+    def test_unsatisfiable_range(self):
+        response, body = self._serve({'Range': 'bytes=5000-'})
+        self.assertEqual(416, response.status_int)
+        self.assertEqual('bytes */1000', response.headers['Content-Range'])
+        self.assertEqual(b'', body)
+
+    def test_if_range(self):
+        etag = '"{}"'.format(SHA)
+        response, body = self._serve(
+            {'Range': 'bytes=0-9', 'If-Range': etag}, etag=etag)
+        self.assertEqual(206, response.status_int)
+        self.assertEqual(CONTENT[:10], body)
+        response, body = self._serve(
+            {'Range': 'bytes=0-9', 'If-Range': '"other"'}, etag=etag)
+        self.assertEqual(200, response.status_int)
+        self.assertEqual(CONTENT, body)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+
+"""Shared setup for tests of the server modules.
+
+Tests run against the App Engine SDK's testbed stubs (datastore, memcache,
+task queue). Like the benchmarks, the SDK is located with the
+`APPENGINE_SDK` environment variable, e.g.:
+
+    APPENGINE_SDK=$(gcloud info --format='value(installation.sdk_root)')/platform/google_appengine \\
+        python -m unittest discover -s fileset/server -t . -p '*_test.py'
+
+Test modules call `setup_sdk()` before importing any `fileset.server` module,
+and are skipped when the SDK isn't available (Python 2.7's test loader
+reports the skip as an import error).
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import types
+import unittest
+
+APP_ID = 'fileset-test'
+HOST = 'localhost:8080'
+
+
+def setup_sdk():
+    """Makes the App Engine SDK importable, or skips the calling module."""
+    try:
+        from google.appengine.ext import testbed
+    except ImportError:
+        sdk_path = os.environ.get('APPENGINE_SDK')
+        if not sdk_path:
+            raise unittest.SkipTest('set APPENGINE_SDK to run server tests')
+        sys.path.insert(0, sdk_path)
+        import dev_appserver
+        dev_appserver.fix_sys_path()
+    # Keys created at import time (e.g. `domains.PARENT_KEY`) use the app id.
+    os.environ.setdefault('APPLICATION_ID', APP_ID)
+    # Config values are read from appengine_config.py at import time, tests
+    # use the defaults (and patch the module attributes they need).
+    if 'appengine_config' not in sys.modules:
+        sys.modules['appengine_config'] = types.ModuleType('appengine_config')
+
+
+class TestCase(unittest.TestCase):
+    """Activates the testbed service stubs around every test."""
+
+    def setUp(self):
+        from google.appengine.datastore import datastore_stub_util
+        from google.appengine.ext import ndb
+        from google.appengine.ext import testbed
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.addCleanup(self.testbed.deactivate)
+        self.testbed.setup_env(app_id=APP_ID, http_host=HOST, overwrite=True)
+        self.testbed.init_app_identity_stub()
+        # Queries see every write, like queries within a single request.
+        policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(
+            probability=1)
+        self.testbed.init_datastore_v3_stub(consistency_policy=policy)
+        self.testbed.init_memcache_stub()
+        self.testbed.init_taskqueue_stub()
+        self.testbed.init_user_stub()
+        self.taskqueue_stub = self.testbed.get_stub(
+            testbed.TASKQUEUE_SERVICE_NAME)
+        ndb.get_context().set_cache_policy(False)
+        ndb.get_context().clear_cache()
+
+    def patch(self, obj, name, value):
+        """Sets an attribute for the duration of the test."""
+        original = getattr(obj, name)
+        setattr(obj, name, value)
+        self.addCleanup(setattr, obj, name, original)
+
+    def make_tempdir(self):
+        path = tempfile.mkdtemp(prefix='fileset-test-')
+        self.addCleanup(shutil.rmtree, path, True)
+        return path
+
+    def get_tasks(self, url=None):
+        """Returns the tasks enqueued in the default queue."""
+        tasks = self.taskqueue_stub.get_filtered_tasks(queue_names=['default'])
+        if url:
+            tasks = [task for task in tasks if task.url == url]
+        return tasks
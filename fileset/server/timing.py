@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+
+"""Lightweight per-request timers for the serving path.
+
+`RedirectMiddleware` creates a `Timer` for every request and stores it in the
+WSGI environ, where `MainHandler` adds its own stages. Timings are emitted as a
+`Server-Timing` response header (see `fileset_SERVER_TIMING`) and as a
+sampled, structured log line (see `fileset_SERVER_TIMING_LOG_SAMPLE_RATE`).
+"""
+
+import collections
+import contextlib
+import json
+import logging
+import random
+import time
+from fileset import config
+
+ENVIRON_KEY = 'fileset.timer'
+
+
+class Timer(object):
+
+    def __init__(self):
+        self.start = time.time()
+        self.stages = collections.OrderedDict()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Context manager that adds the time spent in the block to `name`."""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.record(name, time.time() - start)
+
+    def record(self, name, seconds):
+        self.stages[name] = self.stages.get(name, 0) + seconds
+
+    def elapsed(self):
+        return time.time() - self.start
+
+    def header_value(self):
+        """Returns the value for a `Server-Timing` header."""
+        parts = ['{};dur={:.2f}'.format(name, seconds * 1000)
+                 for name, seconds in self.stages.items()]
+        parts.append('total;dur={:.2f}'.format(self.elapsed() * 1000))
+        return ', '.join(parts)
+
+    def log(self, request, status):
+        """Logs the timings if the request is sampled or slow."""
+        total_ms = self.elapsed() * 1000
+        is_slow = total_ms >= config.SERVER_TIMING_SLOW_MS
+        if not is_slow and random.random() >= config.SERVER_TIMING_LOG_SAMPLE_RATE:
+            return
+        fields = {
+            'path': request.path,
+            'host': request.host,
+            'status': status,
+            'total_ms': round(total_ms, 2),
+            'slow': is_slow,
+        }
+        for name, seconds in self.stages.items():
+            fields[name + '_ms'] = round(seconds * 1000, 2)
+        logging.info('server-timing: %s', json.dumps(fields, sort_keys=True))
+
+
+class _NullTimer(Timer):
+    """Timer used when a request didn't go through the middleware."""
+
+    def record(self, name, seconds):
+        pass
+
+
+def get_timer(environ):
+    return environ.get(ENVIRON_KEY) or _NullTimer()
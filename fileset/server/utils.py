@@ -2,6 +2,7 @@
 
 import os
 from fileset import config
+from fileset.server import domains
 from google.appengine.api import app_identity
 
 AUTHORIZED_ORGS = config.AUTHORIZED_ORGS
@@ -26,8 +27,21 @@ def get_env(request):
     return Env.PROD
 
 
-def get_branch(request):
+def get_branch(request, routes=None):
+    """Returns the branch to serve a request from.
+
+    `routes` is the domain routing table (see `domains.get_routes()`), for
+    callers that already loaded it.
+    """
     env = get_env(request)
+    if env == Env.PROD:
+        # Domains in the routing table are served from their own branch.
+        domain = get_domain(request)
+        if routes is None:
+            branch = domains.get_branch(domain)
+        else:
+            branch = routes.get(domain.lower())
+        return branch or DEFAULT_BRANCH
     if env != Env.STAGING:
         return DEFAULT_BRANCH
 
@@ -43,6 +57,16 @@ def get_branch(request):
     return branch
 
 
+def is_routed(request, routes=None):
+    """Returns whether a request is for a domain in the routing table."""
+    if get_env(request) != Env.PROD:
+        return False
+    domain = get_domain(request)
+    if routes is None:
+        return domains.get_branch(domain) is not None
+    return domain.lower() in routes
+
+
 def is_authorized(email):
     if email in AUTHORIZED_USERS:
         return True
@@ -50,6 +74,40 @@ def is_authorized(email):
     return org in AUTHORIZED_ORGS
 
 
+def get_accepted_encoding(accept_encoding, encodings):
+    """Returns the first of `encodings` allowed by an Accept-Encoding header."""
+    if not accept_encoding:
+        return None
+    accepted = set()
+    for part in accept_encoding.lower().split(','):
+        params = [param.strip() for param in part.split(';')]
+        if 'q=0' in params or 'q=0.0' in params:
+            continue
+        accepted.add(params[0])
+    for encoding in encodings:
+        if encoding in accepted:
+            return encoding
+    return None
+
+
+def add_vary(headers, name):
+    """Adds a request header name to the Vary header of a response."""
+    vary = headers.get('Vary')
+    headers['Vary'] = '{}, {}'.format(vary, name) if vary else name
+
+
+def get_preload_links(preload):
+    """Returns `Link` header values that preload a page's subresources."""
+    links = []
+    for asset in preload:
+        link = '<{}>; rel=preload; as={}'.format(asset['href'], asset['as'])
+        # Fonts are always fetched in CORS mode.
+        if asset['as'] == 'font':
+            link += '; crossorigin'
+        links.append(link)
+    return links
+
+
 def get_domain(request):
     """Returns the domain portion of the host value."""
     domain = request.host
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+
+"""Handler for App Engine warmup requests.
+
+App Engine sends `/_ah/warmup` to a new instance before routing user traffic
+to it (when `warmup` is listed under `inbound_services` in app.yaml). Modules
+are shared by all WSGI apps of an instance, so state loaded here is used by
+the serving app in `main.py`.
+"""
+
+import appengine_config
+
+import json
+import logging
+import time
+from fileset import config
+from fileset.server import blobs
+from fileset.server import domains
+from fileset.server import intl
+from fileset.server import main
+from fileset.server import manifests
+from fileset.server import stats
+from fileset.server import utils
+import webapp2
+
+
+def warm():
+    """Preloads the state used to serve requests and returns a summary."""
+    start = time.time()
+    result = {}
+
+    manifest = manifests.get_branch_manifest(utils.DEFAULT_BRANCH)
+    result['manifest_paths'] = len(manifest.paths) if manifest else 0
+    result['domains'] = len(domains.get_routes())
+
+    # Accessing the trie builds it.
+    main.app.redirects
+    result['redirects'] = len(config.REDIRECTS)
+
+    # Runs the intl fallbacks once, so the first localized request doesn't pay
+    # for loading the country languages table.
+    list(intl.generate_intl_paths('/index.html'))
+
+    shas = []
+    if manifest:
+        for path in ('/404.html', '/500.html'):
+            if path in manifest.paths:
+                shas.append(manifest.paths[path])
+    if config.WARMUP_PREFETCH_BLOBS:
+        shas.extend(stats.get_hot_blobs(config.WARMUP_PREFETCH_BLOBS))
+    result['blobs_prefetched'] = blobs.prefetch(shas)
+
+    result['seconds'] = round(time.time() - start, 3)
+    return result
+
+
+class WarmupHandler(webapp2.RequestHandler):
+
+    def get(self):
+        try:
+            result = warm()
+            logging.info('warmup: %s', json.dumps(result, sort_keys=True))
+        except Exception:
+            # The instance can still serve requests, just more slowly.
+            logging.exception('warmup failed')
+        self.response.headers['Content-Type'] = 'text/plain'
+        self.response.out.write('ok\n')
+
+
+app = webapp2.WSGIApplication([
+    webapp2.Route('/_ah/warmup', handler=WarmupHandler),
+])
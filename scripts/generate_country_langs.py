@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+
+"""Generates `fileset/server/country_langs.py` from babel's CLDR data.
+
+The server looks up the de-facto languages of the user's country on every
+localized request. Importing babel (and loading its CLDR data) at runtime
+slows down cold starts, so the map is generated ahead of time. Re-run this
+script after upgrading babel:
+
+    python scripts/generate_country_langs.py
+"""
+
+from __future__ import print_function
+
+import os
+from babel import core
+from babel import languages
+
+OUTPUT_PATH = os.path.join(
+    os.path.dirname(__file__), '..', 'fileset', 'server', 'country_langs.py')
+
+HEADER = '''#!/usr/bin/env python
+
+"""De-facto languages by country, keyed by lowercase ISO 3166 code.
+
+Generated by scripts/generate_country_langs.py from babel {version}.
+Do not edit.
+"""
+
+'''
+
+
+def get_country_langs():
+    country_langs = {}
+    for territory in sorted(core.get_global('territory_languages')):
+        langs = languages.get_official_languages(territory, de_facto=True)
+        if langs and territory.isalpha():
+            country_langs[territory.lower()] = tuple(
+                str(lang) for lang in langs)
+    return country_langs
+
+
+def main():
+    import babel
+    source = HEADER.format(version=babel.__version__)
+    source += 'COUNTRY_LANGS = {\n'
+    for country, langs in sorted(get_country_langs().items()):
+        source += '    {!r}: {!r},\n'.format(country, langs)
+    source += '}\n'
+    with open(OUTPUT_PATH, 'w') as fp:
+        fp.write(source)
+    print('wrote {}'.format(os.path.normpath(OUTPUT_PATH)))
+
+
+if __name__ == '__main__':
+    main()
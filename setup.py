@@ -18,6 +18,13 @@ setuptools.setup(
     install_requires=[
         'GoogleAppEngineCloudStorageClient',
         'babel',
+        'futures; python_version < "3"',
         'pytz',
+        'requests',
     ],
+    entry_points={
+        'console_scripts': [
+            'fileset=fileset.client.cli:main',
+        ],
+    },
 )